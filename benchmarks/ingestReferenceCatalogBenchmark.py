@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+#
+# LSST Data Management System
+#
+# Copyright 2008-2017  AURA/LSST.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <https://www.lsstcorp.org/LegalNotices/>.
+#
+"""Benchmark ingesting a reference catalog with one and with several processes
+
+A synthetic catalog of objects distributed uniformly over the sky is written as a set of
+text files, which are then ingested with IngestIndexedReferenceTask into a new repository
+for each number of processes.  With one process the ingest runs _ingest_serial; with more
+it runs _ingest_parallel, in which each file is read and indexed by a worker.  The wall time
+of each ingest and its speedup over the first number of processes are reported, and the
+shards of every ingest are checked to be the same as those of the first.
+
+Example:
+
+    python benchmarks/ingestReferenceCatalogBenchmark.py --files 16 --rowsPerFile 200000 \\
+        --processes 1 2 4 8
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+import lsst.daf.persistence as dafPersist
+import lsst.utils
+from lsst.meas.algorithms import IngestIndexedReferenceTask
+from lsst.meas.algorithms.shardManifest import get_shard_manifest_path, read_shard_manifest
+
+COLUMNS = ("processes", "files", "rows", "wallSec", "rowsPerSec", "speedup")
+
+
+def makeCatalogFiles(workDir, rng, nFiles, rowsPerFile):
+    """Write a synthetic all-sky reference catalog as a set of text files
+
+    @param[in] workDir  directory in which to write the files
+    @param[in] rng  numpy random number generator
+    @param[in] nFiles  number of files
+    @param[in] rowsPerFile  number of objects in each file
+    @return a list of the paths of the files
+    """
+    paths = []
+    for i in range(nFiles):
+        ra = rng.uniform(0.0, 360.0, rowsPerFile)
+        dec = np.degrees(np.arcsin(rng.uniform(-1.0, 1.0, rowsPerFile)))
+        mag = rng.uniform(12.0, 22.0, rowsPerFile)
+        magErr = rng.uniform(0.01, 0.2, rowsPerFile)
+        ident = np.arange(i*rowsPerFile + 1, (i + 1)*rowsPerFile + 1)
+        arr = np.rec.fromarrays([ident, ra, dec, mag, magErr], names="id,ra,dec,a,a_err")
+        path = os.path.join(workDir, "ref_%d.txt" % (i,))
+        np.savetxt(path, arr, delimiter=",", header="id,ra,dec,a,a_err",
+                   fmt=["%i", "%.10g", "%.10g", "%.4g", "%.4g"])
+        paths.append(path)
+    return paths
+
+
+def ingest(paths, inputDir, repoPath, depth, nProcesses, parser):
+    """Ingest a set of catalog files with the HTM indexer
+
+    @param[in] paths  paths of the catalog text files
+    @param[in] inputDir  path of the input repository
+    @param[in] repoPath  path of the output repository
+    @param[in] depth  HTM depth of the shards
+    @param[in] nProcesses  number of processes
+    @param[in] parser  parser of ReadTextCatalogTask
+    @return the wall time of the ingest, in seconds
+    """
+    config = IngestIndexedReferenceTask.ConfigClass()
+    config.dataset_config.indexer.name = "HTM"
+    config.dataset_config.indexer.active.depth = depth
+    config.file_reader.parser = parser
+    config.ra_name = "ra"
+    config.dec_name = "dec"
+    config.id_name = "id"
+    config.mag_column_list = ["a"]
+    config.mag_err_column_map = {"a": "a_err"}
+    config.n_processes = nProcesses
+    start = time.perf_counter()
+    IngestIndexedReferenceTask.parseAndRun(args=[inputDir, "--output", repoPath] + paths, config=config)
+    return time.perf_counter() - start
+
+
+def assertSameShards(repoPath, refRepoPath):
+    """Raise RuntimeError unless two repositories have the same reference catalog shards
+
+    @param[in] repoPath  path of the repository to check
+    @param[in] refRepoPath  path of the reference repository
+    """
+    butler = dafPersist.Butler(repoPath)
+    refButler = dafPersist.Butler(refRepoPath)
+    configPath = refButler.getUri("ref_cat_config", name="cal_ref_cat")
+    shardRows, _ = read_shard_manifest(get_shard_manifest_path(configPath))
+    for pixelId in shardRows:
+        dataId = dict(pixel_id=pixelId, name="cal_ref_cat")
+        catalog = butler.get("ref_cat", dataId=dataId, immediate=True)
+        refCatalog = refButler.get("ref_cat", dataId=dataId, immediate=True)
+        if not (np.array_equal(catalog["id"], refCatalog["id"]) and
+                np.array_equal(catalog["a_flux"], refCatalog["a_flux"])):
+            raise RuntimeError("Shard %d of %s differs from that of %s" % (pixelId, repoPath, refRepoPath))
+
+
+def run(args):
+    """Run the benchmark and print a table of results
+
+    @param[in] args  parsed command-line arguments
+    @return a list of dicts, one per row of the table
+    """
+    rng = np.random.RandomState(args.seed)
+    inputDir = args.input or os.path.join(lsst.utils.getPackageDir("obs_test"), "data", "input")
+    workDir = tempfile.mkdtemp(dir=args.workDir)
+    rows = []
+    try:
+        paths = makeCatalogFiles(workDir, rng, args.files, args.rowsPerFile)
+        nRows = args.files*args.rowsPerFile
+        print(" ".join("%12s" % name for name in COLUMNS))
+        refRepoPath = None
+        refWallSec = None
+        for nProcesses in args.processes:
+            repoPath = os.path.join(workDir, "repo_%d" % (nProcesses,))
+            wallSec = ingest(paths, inputDir, repoPath, args.depth, nProcesses, args.parser)
+            if refRepoPath is None:
+                refRepoPath = repoPath
+                refWallSec = wallSec
+            else:
+                assertSameShards(repoPath, refRepoPath)
+            row = dict(processes=nProcesses, files=args.files, rows=nRows, wallSec=wallSec,
+                       rowsPerSec=nRows/wallSec, speedup=refWallSec/wallSec)
+            rows.append(row)
+            print(" ".join("%12.6g" % (row[name],) for name in COLUMNS))
+            sys.stdout.flush()
+    finally:
+        if args.keep:
+            print("# catalogs and repositories kept in %s" % (workDir,))
+        else:
+            shutil.rmtree(workDir, ignore_errors=True)
+    if args.csv:
+        with open(args.csv, "w") as outFile:
+            outFile.write(",".join(COLUMNS) + "\n")
+            for row in rows:
+                outFile.write(",".join(str(row[name]) for name in COLUMNS) + "\n")
+    return rows
+
+
+def makeParser():
+    """Make the command-line argument parser"""
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--files", type=int, default=8, help="number of input files")
+    parser.add_argument("--rowsPerFile", type=int, default=100000, help="number of objects per file")
+    parser.add_argument("--processes", type=int, nargs="+", default=[1, 2, 4],
+                        help="numbers of processes to ingest with; speedups are relative to the first")
+    parser.add_argument("--depth", type=int, default=7, help="HTM depth of the shards")
+    parser.add_argument("--parser", default="genfromtxt", choices=["genfromtxt", "loadtxt"],
+                        help="text parser of the file reader")
+    parser.add_argument("--seed", type=int, default=1, help="seed of the random number generator")
+    parser.add_argument("--input", help="input repository for the ingest; default is that of obs_test")
+    parser.add_argument("--workDir", help="directory for the catalogs and repositories")
+    parser.add_argument("--keep", action="store_true", help="keep the catalogs and repositories")
+    parser.add_argument("--csv", help="also write the results to this CSV file")
+    return parser
+
+
+if __name__ == "__main__":
+    run(makeParser().parse_args())
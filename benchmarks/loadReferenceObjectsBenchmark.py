@@ -0,0 +1,318 @@
+#!/usr/bin/env python
+#
+# LSST Data Management System
+#
+# Copyright 2008-2017  AURA/LSST.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <https://www.lsstcorp.org/LegalNotices/>.
+#
+"""Benchmark loading reference objects from an HTM-indexed reference catalog
+
+For each combination of object density and HTM depth a synthetic catalog of objects
+distributed uniformly in a circular field is ingested with IngestIndexedReferenceTask
+into a local repository.  loadSkyCircle and loadPixelBox are then timed for each radius
+at random positions within the field, and for each case the mean number of shards
+touched, rows read and rows returned per call and the mean wall time per call are
+reported.  Each case runs in a fresh process, and column peakRssMiB is how much the peak
+resident set size of that process grew during the loads, above its peak after importing
+the stack and making the butler.
+
+Example:
+
+    python benchmarks/loadReferenceObjectsBenchmark.py --densities 100 1000 --depths 7 8 \\
+        --radii 0.1 0.5 1.0
+"""
+import argparse
+import multiprocessing
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+import lsst.afw.geom as afwGeom
+import lsst.daf.persistence as dafPersist
+import lsst.utils
+from lsst.meas.algorithms import (IngestIndexedReferenceTask, LoadIndexedReferenceObjectsTask,
+                                  LoadIndexedReferenceObjectsConfig)
+
+COLUMNS = ("method", "density", "depth", "radius", "shards", "rowsRead", "rowsReturned", "wallMs",
+           "peakRssMiB")
+
+
+def offsetPoints(ctrRa, ctrDec, distance, bearing):
+    """Offset points from a center by a distance along a bearing
+
+    @param[in] ctrRa, ctrDec  center, in degrees
+    @param[in] distance  numpy array of distances, in radians
+    @param[in] bearing  numpy array of bearings east of north, in radians
+    @return RA and Dec of the points, as numpy arrays in degrees
+    """
+    ra0 = np.radians(ctrRa)
+    dec0 = np.radians(ctrDec)
+    center = np.array([np.cos(dec0)*np.cos(ra0), np.cos(dec0)*np.sin(ra0), np.sin(dec0)])
+    east = np.array([-np.sin(ra0), np.cos(ra0), 0.0])
+    north = np.cross(center, east)
+    vectors = (np.outer(np.cos(distance), center) +
+               np.outer(np.sin(distance)*np.sin(bearing), east) +
+               np.outer(np.sin(distance)*np.cos(bearing), north))
+    ra = np.degrees(np.arctan2(vectors[:, 1], vectors[:, 0])) % 360.0
+    dec = np.degrees(np.arcsin(np.clip(vectors[:, 2], -1.0, 1.0)))
+    return ra, dec
+
+
+def randomPointsInCircle(rng, nPoints, ctrRa, ctrDec, radius):
+    """Draw points uniformly distributed on the sphere within a circle
+
+    @param[in] rng  numpy random number generator
+    @param[in] nPoints  number of points
+    @param[in] ctrRa, ctrDec  center of the circle, in degrees
+    @param[in] radius  radius of the circle, in degrees
+    @return RA and Dec of the points, as numpy arrays in degrees
+    """
+    cosDistance = rng.uniform(np.cos(np.radians(radius)), 1.0, nPoints)
+    return offsetPoints(ctrRa, ctrDec, np.arccos(cosDistance), rng.uniform(0.0, 2.0*np.pi, nPoints))
+
+
+def makeCatalogFile(path, rng, density, ctrRa, ctrDec, fieldRadius):
+    """Write a synthetic reference catalog as a text file
+
+    @param[in] path  path of the file to write
+    @param[in] rng  numpy random number generator
+    @param[in] density  number of objects per square degree
+    @param[in] ctrRa, ctrDec  center of the field, in degrees
+    @param[in] fieldRadius  radius of the field, in degrees
+    @return the number of objects
+    """
+    areaDeg2 = 2.0*np.pi*(1.0 - np.cos(np.radians(fieldRadius)))*np.degrees(1.0)**2
+    nObjects = int(round(density*areaDeg2))
+    ra, dec = randomPointsInCircle(rng, nObjects, ctrRa, ctrDec, fieldRadius)
+    mag = rng.uniform(12.0, 22.0, nObjects)
+    arr = np.rec.fromarrays([np.arange(1, nObjects + 1), ra, dec, mag], names="id,ra,dec,a")
+    np.savetxt(path, arr, delimiter=",", header="id,ra,dec,a", fmt=["%i", "%.10g", "%.10g", "%.4g"])
+    return nObjects
+
+
+def ingest(catalogPath, inputDir, repoPath, depth):
+    """Ingest a catalog file with the HTM indexer
+
+    @param[in] catalogPath  path of the catalog text file
+    @param[in] inputDir  path of the input repository
+    @param[in] repoPath  path of the output repository
+    @param[in] depth  HTM depth of the shards
+    @return a butler for the output repository
+    """
+    config = IngestIndexedReferenceTask.ConfigClass()
+    config.dataset_config.indexer.name = "HTM"
+    config.dataset_config.indexer.active.depth = depth
+    config.ra_name = "ra"
+    config.dec_name = "dec"
+    config.id_name = "id"
+    config.mag_column_list = ["a"]
+    IngestIndexedReferenceTask.parseAndRun(args=[inputDir, "--output", repoPath, catalogPath],
+                                           config=config)
+    return dafPersist.Butler(repoPath)
+
+
+def makeCountingLoader(butler, config):
+    """Make a loader that counts the shards it touches and the rows it reads
+
+    @param[in] butler  butler for the reference catalog repository
+    @param[in] config  LoadIndexedReferenceObjectsConfig
+    @return the loader and a dict of counts, "shards" and "rowsRead", updated by each load
+    """
+    loader = LoadIndexedReferenceObjectsTask(butler=butler, config=config)
+    counts = dict(shards=0, rowsRead=0)
+    getShards = loader.get_shards
+    readShard = loader._read_shard
+
+    def countingGetShards(id_list, *args, **kwargs):
+        counts["shards"] += len(id_list)
+        return getShards(id_list, *args, **kwargs)
+
+    def countingReadShard(pixel_id, *args, **kwargs):
+        shard = readShard(pixel_id, *args, **kwargs)
+        if shard is not None:
+            counts["rowsRead"] += len(shard)
+        return shard
+
+    loader.get_shards = countingGetShards
+    loader._read_shard = countingReadShard
+    return loader, counts
+
+
+def getMaxRssMiB():
+    """Return the peak resident set size of the process so far, in MiB"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in KiB elsewhere
+    return peak/2.0**20 if sys.platform == "darwin" else peak/2.0**10
+
+
+def makeBox(ctrCoord, radius, pixelScale):
+    """Make a square pixel box with a TAN WCS inscribed in a circle
+
+    @param[in] ctrCoord  center of the box (an lsst.afw.geom.SpherePoint)
+    @param[in] radius  half the diagonal of the box (an lsst.afw.geom.Angle)
+    @param[in] pixelScale  pixel scale (an lsst.afw.geom.Angle)
+    @return the bounding box (an lsst.afw.geom.Box2I) and WCS (an lsst.afw.geom.SkyWcs)
+    """
+    side = max(int(np.sqrt(2.0)*radius.asRadians()/pixelScale.asRadians()), 1)
+    bbox = afwGeom.Box2I(afwGeom.Point2I(0, 0), afwGeom.Extent2I(side, side))
+    wcs = afwGeom.makeSkyWcs(crpix=afwGeom.Box2D(bbox).getCenter(), crval=ctrCoord,
+                             cdMatrix=afwGeom.makeCdMatrix(scale=pixelScale))
+    return bbox, wcs
+
+
+def benchmark(butler, config, method, centers, radius, pixelScale):
+    """Time loading reference objects at a set of positions
+
+    @param[in] butler  butler for the reference catalog repository
+    @param[in] config  LoadIndexedReferenceObjectsConfig
+    @param[in] method  "loadSkyCircle" or "loadPixelBox"
+    @param[in] centers  list of centers (lsst.afw.geom.SpherePoint)
+    @param[in] radius  radius of the circles, or half the diagonal of the boxes (an lsst.afw.geom.Angle)
+    @param[in] pixelScale  pixel scale of the boxes (an lsst.afw.geom.Angle)
+    @return a dict of the mean shards touched, rows read, rows returned and wall time in ms per call
+    """
+    loader, counts = makeCountingLoader(butler, config)
+    nReturned = 0
+    wallTime = 0.0
+    for ctrCoord in centers:
+        if method == "loadSkyCircle":
+            start = time.perf_counter()
+            refCat = loader.loadSkyCircle(ctrCoord, radius, filterName="a").refCat
+        else:
+            bbox, wcs = makeBox(ctrCoord, radius, pixelScale)
+            start = time.perf_counter()
+            refCat = loader.loadPixelBox(bbox, wcs, filterName="a").refCat
+        wallTime += time.perf_counter() - start
+        nReturned += len(refCat)
+    nCalls = len(centers)
+    return dict(shards=counts["shards"]/nCalls, rowsRead=counts["rowsRead"]/nCalls,
+                rowsReturned=nReturned/nCalls, wallMs=1000.0*wallTime/nCalls)
+
+
+def runCase(repoPath, shardCacheBytes, method, ras, decs, radius, pixelScale):
+    """Time one case of the benchmark and measure the memory it uses
+
+    This is run in a fresh process for each case, so that the peak resident set size
+    reflects only that case.
+
+    @param[in] repoPath  path of the reference catalog repository
+    @param[in] shardCacheBytes  size of the shard cache of the loader
+    @param[in] method  "loadSkyCircle" or "loadPixelBox"
+    @param[in] ras, decs  numpy arrays of the centers of the loads, in degrees
+    @param[in] radius  radius of the circles, or half the diagonal of the boxes, in degrees
+    @param[in] pixelScale  pixel scale of the boxes, in arcseconds
+    @return the dict returned by benchmark, with the growth of the peak resident set size
+        during the loads as peakRssMiB
+    """
+    butler = dafPersist.Butler(repoPath)
+    config = LoadIndexedReferenceObjectsConfig()
+    config.shard_cache_bytes = shardCacheBytes
+    centers = [afwGeom.SpherePoint(ra, dec, afwGeom.degrees) for ra, dec in zip(ras, decs)]
+    baselineRssMiB = getMaxRssMiB()
+    result = benchmark(butler, config, method, centers, radius*afwGeom.degrees,
+                       pixelScale*afwGeom.arcseconds)
+    result["peakRssMiB"] = getMaxRssMiB() - baselineRssMiB
+    return result
+
+
+def run(args):
+    """Run the benchmark and print a table of results
+
+    @param[in] args  parsed command-line arguments
+    @return a list of dicts, one per row of the table
+    """
+    rng = np.random.RandomState(args.seed)
+    inputDir = args.input or os.path.join(lsst.utils.getPackageDir("obs_test"), "data", "input")
+    workDir = tempfile.mkdtemp(dir=args.workDir)
+    # each case runs in a new interpreter, rather than a fork of this one
+    context = multiprocessing.get_context("spawn")
+    rows = []
+    print(" ".join("%12s" % name for name in COLUMNS))
+    try:
+        for density in args.densities:
+            catalogPath = os.path.join(workDir, "ref_%g.txt" % (density,))
+            nObjects = makeCatalogFile(catalogPath, rng, density, args.ra, args.dec, args.fieldRadius)
+            print("# density %g per square degree: %d objects" % (density, nObjects))
+            for depth in args.depths:
+                repoPath = os.path.join(workDir, "repo_%g_%d" % (density, depth))
+                ingest(catalogPath, inputDir, repoPath, depth)
+                for radius in args.radii:
+                    # keep the whole search region inside the field
+                    ra, dec = randomPointsInCircle(rng, args.trials, args.ra, args.dec,
+                                                   max(args.fieldRadius - radius, 0.0))
+                    for method in args.methods:
+                        row = dict(method=method, density=density, depth=depth, radius=radius)
+                        with context.Pool(1) as pool:
+                            row.update(pool.apply(runCase, (repoPath, args.shardCacheBytes, method, ra, dec,
+                                                            radius, args.pixelScale)))
+                        rows.append(row)
+                        print(" ".join("%12s" % (row[name],) if isinstance(row[name], str) else
+                                       "%12.6g" % (row[name],) for name in COLUMNS))
+                        sys.stdout.flush()
+                if not args.keep:
+                    shutil.rmtree(repoPath, ignore_errors=True)
+    finally:
+        if args.keep:
+            print("# repositories kept in %s" % (workDir,))
+        else:
+            shutil.rmtree(workDir, ignore_errors=True)
+    if args.csv:
+        with open(args.csv, "w") as outFile:
+            outFile.write(",".join(COLUMNS) + "\n")
+            for row in rows:
+                outFile.write(",".join(str(row[name]) for name in COLUMNS) + "\n")
+    return rows
+
+
+def makeParser():
+    """Make the command-line argument parser"""
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--densities", type=float, nargs="+", default=[100.0, 1000.0],
+                        help="object densities, per square degree")
+    parser.add_argument("--depths", type=int, nargs="+", default=[7, 8],
+                        help="HTM depths of the shards")
+    parser.add_argument("--radii", type=float, nargs="+", default=[0.1, 0.5, 1.0],
+                        help="search radii, in degrees; boxes have half diagonals of this size")
+    parser.add_argument("--methods", nargs="+", default=["loadSkyCircle", "loadPixelBox"],
+                        choices=["loadSkyCircle", "loadPixelBox"], help="loader methods to time")
+    parser.add_argument("--trials", type=int, default=10, help="number of loads per case")
+    parser.add_argument("--ra", type=float, default=45.0, help="RA of the center of the field, in degrees")
+    parser.add_argument("--dec", type=float, default=0.0, help="Dec of the center of the field, in degrees")
+    parser.add_argument("--fieldRadius", type=float, default=3.0,
+                        help="radius of the field of the synthetic catalog, in degrees")
+    parser.add_argument("--pixelScale", type=float, default=0.2,
+                        help="pixel scale of the boxes, in arcseconds")
+    parser.add_argument("--shardCacheBytes", type=int, default=0,
+                        help="size of the shard cache of the loader; 0 disables it")
+    parser.add_argument("--seed", type=int, default=1, help="seed of the random number generator")
+    parser.add_argument("--input", help="input repository for the ingest; default is that of obs_test")
+    parser.add_argument("--workDir", help="directory for the temporary repositories")
+    parser.add_argument("--keep", action="store_true", help="keep the catalogs and repositories")
+    parser.add_argument("--csv", help="also write the results to this CSV file")
+    return parser
+
+
+if __name__ == "__main__":
+    run(makeParser().parse_args())
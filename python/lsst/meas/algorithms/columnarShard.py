@@ -0,0 +1,190 @@
+#
+# LSST Data Management System
+#
+# Copyright 2008-2017  AURA/LSST.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <https://www.lsstcorp.org/LegalNotices/>.
+#
+"""!Columnar storage of reference catalog shards
+
+A columnar shard is a compressed numpy .npz file next to the (empty) FITS shard that the
+butler knows about, which carries the schema.  The rows are divided into row groups, and
+each column of each row group is a separately compressed member of the file, so a reader
+decompresses only the columns and row groups it needs.  The minimum and maximum of the
+coordinates and of each flux are recorded for every row group, so that row groups
+outside a region or too faint for a flux limit can be skipped without being read.
+
+The ranges are only narrow if the rows are ordered: the ingest sorts them by HTM sub-cell
+if DatasetConfig.sub_index_depth is set, or by flux if sort_flux_column is set.  Rows in
+input order give row groups that each span the whole shard, so none can be skipped.
+"""
+
+__all__ = ["get_columnar_shard_path", "write_columnar_shard", "read_columnar_shard"]
+
+import os
+
+import numpy as np
+
+import lsst.afw.table as afwTable
+
+# fields that are always read, whatever columns are requested
+_REQUIRED_FIELDS = ("id", "coord_ra", "coord_dec")
+
+
+def get_columnar_shard_path(fits_path):
+    """!Return the path of the columnar data of a shard
+
+    @param[in] fits_path  path of the FITS shard persisted by the butler
+    @return the path of the .npz file holding the rows of the shard
+    """
+    return os.path.splitext(fits_path)[0] + ".npz"
+
+
+def _get_stats_fields(schema):
+    """!Return the names of the fields whose range is recorded for each row group"""
+    return ["coord_ra", "coord_dec"] + [name for name in _get_field_names(schema) if name.endswith("_flux")]
+
+
+def _get_field_names(schema):
+    """!Return the names of the fields of a schema, in order"""
+    return [item.field.getName() for item in schema]
+
+
+def write_columnar_shard(path, catalog, row_group_size):
+    """!Write the rows of a catalog as a columnar shard
+
+    The shard is written to a temporary file in the same directory, which then replaces
+    any existing file at path, so that an interrupted write leaves the old shard intact.
+
+    @param[in] path  path of the .npz file to write
+    @param[in] catalog  afwTable.SourceCatalog to write
+    @param[in] row_group_size  maximum number of rows in a row group
+    """
+    if not catalog.isContiguous():
+        catalog = catalog.copy(deep=True)
+    columns = catalog.extract("*")
+    n_rows = len(catalog)
+    starts = np.arange(0, max(n_rows, 1), row_group_size, dtype=np.int64)
+    stops = np.append(starts[1:], n_rows)
+    stats_fields = _get_stats_fields(catalog.schema)
+    stats_min = np.full((len(starts), len(stats_fields)), np.nan)
+    stats_max = np.full((len(starts), len(stats_fields)), np.nan)
+    members = {}
+    for i, (start, stop) in enumerate(zip(starts, stops)):
+        for name, values in columns.items():
+            members["%s.%d" % (name, i)] = np.asarray(values[start:stop])
+        if stop > start:
+            for j, name in enumerate(stats_fields):
+                values = np.asarray(columns[name][start:stop], dtype=np.float64)
+                stats_min[i, j] = np.fmin.reduce(values)
+                stats_max[i, j] = np.fmax.reduce(values)
+    tmp_path = path + ".tmp"
+    try:
+        with open(tmp_path, "wb") as tmp_file:
+            np.savez_compressed(tmp_file, _n_rows=np.int64(n_rows), _row_group_starts=starts,
+                                _stats_fields=np.array(stats_fields), _stats_min=stats_min,
+                                _stats_max=stats_max, **members)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def _overlaps_circle(ra_min, ra_max, dec_min, dec_max, ctrCoord, radius):
+    """!Test whether coordinate ranges may overlap a circle
+
+    The test is conservative: it may return True for a range that does not overlap the circle.
+
+    @param[in] ra_min, ra_max, dec_min, dec_max  numpy arrays of coordinate ranges, in radians
+    @param[in] ctrCoord  ICRS center of the circle (an lsst.afw.geom.SpherePoint)
+    @param[in] radius  radius of the circle (an lsst.afw.geom.Angle)
+    @return a numpy boolean array
+    """
+    ctr_ra = ctrCoord.getLongitude().asRadians()
+    ctr_dec = ctrCoord.getLatitude().asRadians()
+    radius = radius.asRadians()
+    overlaps = (dec_max >= ctr_dec - radius) & (dec_min <= ctr_dec + radius)
+    if abs(ctr_dec) + radius >= 0.5*np.pi:
+        # the circle contains a pole, so it spans every RA
+        return overlaps
+    half_width = np.arcsin(min(np.sin(radius)/np.cos(ctr_dec), 1.0))
+    in_ra = np.zeros(len(ra_min), dtype=bool)
+    for wrap in (-2.0*np.pi, 0.0, 2.0*np.pi):
+        in_ra |= (ra_max >= ctr_ra - half_width + wrap) & (ra_min <= ctr_ra + half_width + wrap)
+    return overlaps & in_ra
+
+
+def read_columnar_shard(path, schema, columns=None, circles=None, min_fluxes=None):
+    """!Read a columnar shard
+
+    @param[in] path  path of the .npz file to read
+    @param[in] schema  schema of the shard
+    @param[in] columns  names of the fields to read, or None to read all of them; id and the
+        coordinates are always read, and the other fields are left unset (NaN or 0)
+    @param[in] circles  list of (ctrCoord, radius) pairs, or None; if given, row groups that
+        cannot overlap any of the circles are skipped
+    @param[in] min_fluxes  dict of flux field name: minimum flux, or None; if given, row groups
+        in which no row is as bright as the minimum flux of every listed field are skipped
+    @return an afwTable.SourceCatalog with the rows of the row groups that were not skipped
+    """
+    with np.load(path) as data:
+        n_rows = int(data["_n_rows"])
+        starts = data["_row_group_starts"]
+        stops = np.append(starts[1:], n_rows)
+        stats_fields = [str(name) for name in data["_stats_fields"]]
+        stats_min = data["_stats_min"]
+        stats_max = data["_stats_max"]
+
+        keep = stops > starts
+        if circles is not None:
+            ra_index = stats_fields.index("coord_ra")
+            dec_index = stats_fields.index("coord_dec")
+            in_circles = np.zeros(len(starts), dtype=bool)
+            for ctrCoord, radius in circles:
+                in_circles |= _overlaps_circle(stats_min[:, ra_index], stats_max[:, ra_index],
+                                               stats_min[:, dec_index], stats_max[:, dec_index],
+                                               ctrCoord, radius)
+            keep &= in_circles
+        if min_fluxes:
+            for name, min_flux in min_fluxes.items():
+                keep &= stats_max[:, stats_fields.index(name)] >= min_flux
+        groups = np.flatnonzero(keep)
+
+        catalog = afwTable.SourceCatalog(schema)
+        if len(groups) == 0:
+            return catalog
+        catalog.resize(int(np.sum(stops[groups] - starts[groups])))
+        if columns is None:
+            names = _get_field_names(schema)
+        else:
+            names = list(_REQUIRED_FIELDS) + [name for name in columns if name not in _REQUIRED_FIELDS]
+        for name in names:
+            key = schema.find(name).key
+            values = np.concatenate([data["%s.%d" % (name, group)] for group in groups])
+            if values.dtype.kind in ("U", "S"):
+                # String fields cannot be set as a column
+                for record, value in zip(catalog, values):
+                    record.set(key, str(value))
+            elif values.dtype.kind == "b":
+                # Nor can Flag fields, which are packed bits
+                for record, value in zip(catalog, values):
+                    record.set(key, bool(value))
+            else:
+                catalog[key] = values
+    return catalog
@@ -141,6 +141,13 @@ class SourceDetectionConfig(pexConfig.Config):
         doc="Mask planes to ignore when calculating statistics of image (for thresholdType=stdev)",
         default=['BAD', 'SAT', 'EDGE', 'NO_DATA'],
     )
+    smoothImagePlaneOnly = pexConfig.Field(
+        dtype=bool,
+        doc=("Smooth only the image plane? The mask is then not smoothed, and the variance is "
+             "scaled by the sum of the squared smoothing kernel, which equals smoothing it where "
+             "the variance is locally uniform"),
+        default=False,
+    )
 
     def setDefaults(self):
         self.tempLocalBackground.binSize = 64
@@ -496,6 +503,10 @@ into your debug.py file and run measAlgTasks.py with the @c --debug flag.
         with the edges removed. This is because we can't convolve the edges
         because the kernel would extend off the image.
 
+        If ``config.smoothImagePlaneOnly``, only the image plane is convolved;
+        the mask is copied, and the variance is copied and multiplied by the
+        sum of the squared kernel.
+
         Parameters
         ----------
         maskedImage : `lsst.afw.image.MaskedImage`
@@ -528,14 +539,30 @@ into your debug.py file and run measAlgTasks.py with the @c --debug flag.
         gaussFunc = afwMath.GaussianFunction1D(sigma)
         gaussKernel = afwMath.SeparableKernel(kWidth, kWidth, gaussFunc, gaussFunc)
 
-        convolvedImage = maskedImage.Factory(maskedImage.getBBox())
+        if self.config.smoothImagePlaneOnly:
+            toConvolve = maskedImage.getImage()
+        else:
+            toConvolve = maskedImage
+        convolvedImage = toConvolve.Factory(toConvolve.getBBox())
 
-        afwMath.convolve(convolvedImage, maskedImage, gaussKernel, afwMath.ConvolutionControl())
+        afwMath.convolve(convolvedImage, toConvolve, gaussKernel, afwMath.ConvolutionControl())
         #
         # Only search psf-smoothed part of frame
         #
         goodBBox = gaussKernel.shrinkBBox(convolvedImage.getBBox())
         middle = convolvedImage.Factory(convolvedImage, goodBBox, afwImage.PARENT, False)
+        if self.config.smoothImagePlaneOnly:
+            # Smoothing with a normalized kernel scales the variance of uncorrelated
+            # noise by the sum of the squared kernel
+            kernelImage = afwImage.ImageD(gaussKernel.getDimensions())
+            gaussKernel.computeImage(kernelImage, True)
+            varianceFactor = float(np.sum(kernelImage.getArray()**2))
+            self.metadata.set("smoothingVarianceFactor", varianceFactor)
+            mask = maskedImage.getMask().Factory(maskedImage.getMask(), goodBBox, afwImage.PARENT, True)
+            variance = maskedImage.getVariance().Factory(maskedImage.getVariance(), goodBBox,
+                                                         afwImage.PARENT, True)
+            variance *= varianceFactor
+            middle = afwImage.makeMaskedImage(middle, mask, variance)
         #
         # Mark the parts of the image outside goodBBox as EDGE
         #
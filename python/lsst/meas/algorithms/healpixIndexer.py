@@ -0,0 +1,149 @@
+#
+# LSST Data Management System
+#
+# Copyright 2008-2017  AURA/LSST.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <https://www.lsstcorp.org/LegalNotices/>.
+#
+
+__all__ = ["HealpixIndexer", "MultiOrderHealpixIndexer"]
+
+import numpy as np
+
+from .multiOrderIndexer import MultiOrderIndexer
+
+
+def _get_healpy():
+    """!Import healpy, which is only needed by the HEALPix indexers
+    """
+    try:
+        import healpy
+    except ImportError as e:
+        raise ImportError("The HEALPix indexers require healpy: %s" % (e,))
+    return healpy
+
+
+def _index_points(order, ra_list, dec_list):
+    """!Compute the nested-scheme HEALPix pixels of one order containing a set of points
+
+    @param[in] order  HEALPix order; nside = 2**order
+    @param[in] ra_list  List of RA coordinate in degrees
+    @param[in] dec_list  List of Dec coordinate in degrees
+    @param[out] A numpy array of pixel numbers
+    """
+    healpy = _get_healpy()
+    return healpy.ang2pix(2**order, np.asarray(ra_list, dtype=float), np.asarray(dec_list, dtype=float),
+                          nest=True, lonlat=True).astype(np.int64)
+
+
+def _get_cover(order, ra, dec, radius):
+    """!Get the nested-scheme HEALPix pixels of one order that touch a circle, and those inside it
+
+    A pixel is taken to be inside the circle if its center is closer to the center of the
+    circle than the radius less the largest distance from a pixel center to its boundary.
+
+    @param[in] order  HEALPix order; nside = 2**order
+    @param[in] ra  RA of the center of the circle, in degrees
+    @param[in] dec  Dec of the center of the circle, in degrees
+    @param[in] radius  radius of the circle, in degrees
+    @param[out] a numpy array of the pixels that touch the circle and one of those inside it
+    """
+    healpy = _get_healpy()
+    nside = 2**order
+    vec = healpy.ang2vec(ra, dec, lonlat=True)
+    pixel_id_list = healpy.query_disc(nside, vec, np.radians(radius), inclusive=True, nest=True)
+    inner_radius = np.radians(radius) - healpy.max_pixrad(nside)
+    if inner_radius > 0:
+        covered_pixel_id_list = healpy.query_disc(nside, vec, inner_radius, inclusive=False, nest=True)
+    else:
+        covered_pixel_id_list = np.array([], dtype=np.int64)
+    return pixel_id_list.astype(np.int64), covered_pixel_id_list.astype(np.int64)
+
+
+class HealpixIndexer:
+    """!Indexer using the pixels of one order of the HEALPix nested scheme
+
+    Unlike HTM trixels, HEALPix pixels of one order all have the same area.
+    """
+
+    def __init__(self, order=8):
+        """!Construct the indexer object
+
+        @param[in] order  HEALPix order; nside = 2**order
+        """
+        _get_healpy()
+        self.order = order
+
+    def get_pixel_ids(self, ctrCoord, radius):
+        """!Get all shards that touch a circular aperture
+
+        @param[in] ctrCoord  afwGeom.SpherePoint ICRS center of the aperture
+        @param[in] radius  afwGeom.Angle object of the aperture radius
+        @param[out] the numpy array of the ids of the shards and a numpy boolean array,
+                    indicating whether the shard touches the boundary (True) or is fully contained (False).
+        """
+        pixel_id_list, covered_pixel_id_list = _get_cover(self.order, ctrCoord.getLongitude().asDegrees(),
+                                                          ctrCoord.getLatitude().asDegrees(),
+                                                          radius.asDegrees())
+        return pixel_id_list, ~np.isin(pixel_id_list, covered_pixel_id_list)
+
+    def index_points(self, ra_list, dec_list):
+        """!Generate pixel ids for each row in an input file
+
+        @param[in] ra_list  List of RA coordinate in degrees
+        @param[in] dec_list  List of Dec coordinate in degrees
+        @param[out] A numpy array of pixel ids
+        """
+        return _index_points(self.order, ra_list, dec_list)
+
+    @staticmethod
+    def make_data_id(pixel_id, dataset_name):
+        """!Make a data id.  Meant to be overridden.
+        @param[in] pixel_id  An identifier for the pixel in question.
+        @param[in] dataset_name  Name of the dataset to use.
+        @param[out] dataId (dictionary)
+        """
+        if pixel_id is None:
+            # NoneType doesn't format, so make dummy pixel
+            pixel_id = 0
+        return {'pixel_id': pixel_id, 'name': dataset_name}
+
+
+class MultiOrderHealpixIndexer(MultiOrderIndexer):
+    """!Indexer using HEALPix pixels of several orders, so that no shard is too large
+
+    Pixel ids are in the NUNIQ scheme: 4*4**order + pixel number in the nested scheme.
+    """
+
+    def __init__(self, min_order, max_order, max_rows_per_shard, split_pixels=()):
+        """!Construct the indexer object
+
+        @param[in] min_order  HEALPix order of the largest pixels
+        @param[in] max_order  HEALPix order of the smallest pixels
+        @param[in] max_rows_per_shard  maximum number of points in a shard above max_order
+        @param[in] split_pixels  NUNIQ ids of the pixels that are replaced by their children
+        """
+        _get_healpy()
+        MultiOrderIndexer.__init__(self, min_order, max_order, max_rows_per_shard, split_pixels)
+
+    def _index_points_at_level(self, ra_list, dec_list, level):
+        return 4*4**level + _index_points(level, ra_list, dec_list)
+
+    def _get_cover_at_level(self, ra, dec, radius, level):
+        pixel_id_list, covered_pixel_id_list = _get_cover(level, ra, dec, radius)
+        return 4*4**level + pixel_id_list, 4*4**level + covered_pixel_id_list
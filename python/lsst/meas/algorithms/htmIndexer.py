@@ -20,7 +20,13 @@
 # the GNU General Public License along with this program.  If not,
 # see <https://www.lsstcorp.org/LegalNotices/>.
 #
+import collections
+import math
+
 import esutil
+import numpy as np
+
+from .multiOrderIndexer import MultiOrderIndexer
 
 
 class HtmIndexer:
@@ -31,6 +37,27 @@ class HtmIndexer:
         @param[in] depth  depth of the hierarchy to construct
         """
         self.htm = esutil.htm.HTM(depth)
+        self._cover_cache = None
+        self._cover_quantum = None
+        self._cover_cache_size = None
+
+    def enable_cover_cache(self, quantum, max_entries=1000):
+        """!Remember the covers computed by get_pixel_ids for reuse by nearby circles
+
+        Circles are grouped by their center coordinates and radius in units of quantum.
+        The cover of a group is computed for a circle enclosing every circle in the group,
+        and only the pixels inside a circle contained in every circle of the group are
+        marked as not on the boundary.  A cached cover may therefore have a few extra pixels,
+        all marked as on the boundary, but it never misses a pixel or marks a pixel that
+        straddles the boundary as fully contained.
+
+        @param[in] quantum  afwGeom.Angle quantization of the circle centers and radii
+        @param[in] max_entries  maximum number of covers to remember; the least recently
+            used are forgotten first
+        """
+        self._cover_quantum = quantum.asDegrees()
+        self._cover_cache_size = max_entries
+        self._cover_cache = collections.OrderedDict()
 
     def get_pixel_ids(self, ctrCoord, radius):
         """!Get all shards that touch a circular aperture
@@ -40,13 +67,43 @@ class HtmIndexer:
         @param[out] A pipeBase.Struct with the list of shards, shards, and a boolean arry, boundary_mask,
                     indicating whether the shard touches the boundary (True) or is fully contained (False).
         """
-        pixel_id_list = self.htm.intersect(ctrCoord.getLongitude().asDegrees(),
-                                           ctrCoord.getLatitude().asDegrees(),
-                                           radius.asDegrees(), inclusive=True)
-        covered_pixel_id_list = self.htm.intersect(ctrCoord.getLongitude().asDegrees(),
-                                                   ctrCoord.getLatitude().asDegrees(),
-                                                   radius.asDegrees(), inclusive=False)
-        is_on_boundary = (pixel_id not in covered_pixel_id_list for pixel_id in pixel_id_list)
+        ra = ctrCoord.getLongitude().asDegrees()
+        dec = ctrCoord.getLatitude().asDegrees()
+        if self._cover_cache is None:
+            return self._get_cover(ra, dec, radius.asDegrees(), radius.asDegrees())
+
+        quantum = self._cover_quantum
+        key = (int(round(ra/quantum)), int(round(dec/quantum)), int(math.floor(radius.asDegrees()/quantum)))
+        cover = self._cover_cache.get(key)
+        if cover is None:
+            # The quantized center is less than one quantum from the true center, and the radius
+            # is between key[2] and key[2] + 1 quanta.
+            cover = self._get_cover(key[0]*quantum, min(max(key[1]*quantum, -90.0), 90.0),
+                                    (key[2] + 2)*quantum, (key[2] - 1)*quantum)
+            self._cover_cache[key] = cover
+            if len(self._cover_cache) > self._cover_cache_size:
+                self._cover_cache.popitem(last=False)
+        else:
+            self._cover_cache.move_to_end(key)
+        return cover
+
+    def _get_cover(self, ra, dec, outer_radius, inner_radius):
+        """!Get the shards that touch a circle, and those fully inside a concentric circle
+
+        @param[in] ra  RA of the center of the circles, in degrees
+        @param[in] dec  Dec of the center of the circles, in degrees
+        @param[in] outer_radius  radius of the circle to find the touching shards of, in degrees
+        @param[in] inner_radius  radius of the circle to find the contained shards of, in degrees;
+            no shards are contained if it is not positive
+        @param[out] the numpy array of shards touching the outer circle and a numpy boolean array
+                    that is False for the shards fully inside the inner circle
+        """
+        pixel_id_list = self.htm.intersect(ra, dec, outer_radius, inclusive=True)
+        if inner_radius > 0:
+            covered_pixel_id_list = self.htm.intersect(ra, dec, inner_radius, inclusive=False)
+        else:
+            covered_pixel_id_list = []
+        is_on_boundary = ~np.isin(pixel_id_list, covered_pixel_id_list)
         return pixel_id_list, is_on_boundary
 
     def index_points(self, ra_list, dec_list):
@@ -69,3 +126,36 @@ class HtmIndexer:
             # NoneType doesn't format, so make dummy pixel
             pixel_id = 0
         return {'pixel_id': pixel_id, 'name': dataset_name}
+
+
+class AdaptiveHtmIndexer(MultiOrderIndexer):
+    """!Indexer using HTM trixels of several depths, so that no shard is too large
+
+    Dense regions of the sky, such as the galactic plane, are split into deeper trixels
+    than sparse ones.  Trixel ids are unique across depths, so shards of different
+    depths never collide.
+    """
+
+    def __init__(self, min_depth, max_depth, max_rows_per_shard, split_pixels=()):
+        """!Construct the indexer object
+
+        @param[in] min_depth  depth of the largest trixels
+        @param[in] max_depth  depth of the smallest trixels
+        @param[in] max_rows_per_shard  maximum number of points in a shard above max_depth
+        @param[in] split_pixels  ids of the trixels that are replaced by their children
+        """
+        MultiOrderIndexer.__init__(self, min_depth, max_depth, max_rows_per_shard, split_pixels)
+        self._htm = {}
+
+    def _get_htm(self, depth):
+        htm = self._htm.get(depth)
+        if htm is None:
+            htm = self._htm[depth] = esutil.htm.HTM(depth)
+        return htm
+
+    def _index_points_at_level(self, ra_list, dec_list, level):
+        return self._get_htm(level).lookup_id(ra_list, dec_list)
+
+    def _get_cover_at_level(self, ra, dec, radius, level):
+        htm = self._get_htm(level)
+        return htm.intersect(ra, dec, radius, inclusive=True), htm.intersect(ra, dec, radius, inclusive=False)
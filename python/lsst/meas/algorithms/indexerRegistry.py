@@ -23,8 +23,9 @@
 
 __all__ = ["IndexerRegistry"]
 
-from lsst.pex.config import Config, makeRegistry, Field
-from .htmIndexer import HtmIndexer
+from lsst.pex.config import Config, makeRegistry, Field, ListField
+from .htmIndexer import HtmIndexer, AdaptiveHtmIndexer
+from .healpixIndexer import HealpixIndexer, MultiOrderHealpixIndexer
 
 IndexerRegistry = makeRegistry(
     """Registry of indexing algorithms
@@ -48,3 +49,105 @@ def makeHtmIndexer(config):
 
 makeHtmIndexer.ConfigClass = HtmIndexerConfig
 IndexerRegistry.register("HTM", makeHtmIndexer)
+
+
+class AdaptiveHtmIndexerConfig(Config):
+    min_depth = Field(
+        doc="Depth of the largest trixels.",
+        dtype=int,
+        default=6,
+    )
+    max_depth = Field(
+        doc="Depth of the smallest trixels.",
+        dtype=int,
+        default=12,
+    )
+    max_rows_per_shard = Field(
+        doc="Trixels with more rows than this are split into their four children, unless they "
+            "are at max_depth.",
+        dtype=int,
+        default=1000000,
+    )
+    split_pixels = ListField(
+        doc="Ids of the trixels that are split.  Set by the ingest from the input catalog.",
+        dtype=int,
+        default=[],
+    )
+
+    def validate(self):
+        Config.validate(self)
+        if self.max_depth < self.min_depth:
+            raise ValueError("max_depth %s must not be less than min_depth %s" %
+                             (self.max_depth, self.min_depth))
+
+
+def makeAdaptiveHtmIndexer(config):
+    """Make an AdaptiveHtmIndexer
+    """
+    return AdaptiveHtmIndexer(min_depth=config.min_depth, max_depth=config.max_depth,
+                              max_rows_per_shard=config.max_rows_per_shard,
+                              split_pixels=config.split_pixels)
+
+
+makeAdaptiveHtmIndexer.ConfigClass = AdaptiveHtmIndexerConfig
+IndexerRegistry.register("ADAPTIVE_HTM", makeAdaptiveHtmIndexer)
+
+
+class HealpixIndexerConfig(Config):
+    order = Field(
+        doc="HEALPix order (nside = 2**order).  Default is order=8 which gives ~ 0.05 sq. deg. per pixel.",
+        dtype=int,
+        default=8,
+    )
+
+
+def makeHealpixIndexer(config):
+    """Make a HealpixIndexer
+    """
+    return HealpixIndexer(order=config.order)
+
+
+makeHealpixIndexer.ConfigClass = HealpixIndexerConfig
+IndexerRegistry.register("HEALPIX", makeHealpixIndexer)
+
+
+class MultiOrderHealpixIndexerConfig(Config):
+    min_order = Field(
+        doc="HEALPix order of the largest pixels.",
+        dtype=int,
+        default=6,
+    )
+    max_order = Field(
+        doc="HEALPix order of the smallest pixels.",
+        dtype=int,
+        default=12,
+    )
+    max_rows_per_shard = Field(
+        doc="Pixels with more rows than this are split into their four children, unless they "
+            "are at max_order.",
+        dtype=int,
+        default=1000000,
+    )
+    split_pixels = ListField(
+        doc="NUNIQ ids of the pixels that are split.  Set by the ingest from the input catalog.",
+        dtype=int,
+        default=[],
+    )
+
+    def validate(self):
+        Config.validate(self)
+        if self.max_order < self.min_order:
+            raise ValueError("max_order %s must not be less than min_order %s" %
+                             (self.max_order, self.min_order))
+
+
+def makeMultiOrderHealpixIndexer(config):
+    """Make a MultiOrderHealpixIndexer
+    """
+    return MultiOrderHealpixIndexer(min_order=config.min_order, max_order=config.max_order,
+                                    max_rows_per_shard=config.max_rows_per_shard,
+                                    split_pixels=config.split_pixels)
+
+
+makeMultiOrderHealpixIndexer.ConfigClass = MultiOrderHealpixIndexerConfig
+IndexerRegistry.register("MULTI_ORDER_HEALPIX", makeMultiOrderHealpixIndexer)
@@ -23,15 +23,29 @@
 
 __all__ = ["IngestIndexedReferenceConfig", "IngestIndexedReferenceTask", "DatasetConfig"]
 
+import collections
+import functools
+import io
+import json
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+
+import esutil
 import numpy as np
 
+import lsst.daf.persistence as dafPersist
 import lsst.pex.config as pexConfig
 import lsst.pipe.base as pipeBase
 import lsst.afw.table as afwTable
 import lsst.afw.geom as afwGeom
 from lsst.afw.image import fluxFromABMag, fluxErrFromABMagErr
+from .columnarShard import get_columnar_shard_path, read_columnar_shard, write_columnar_shard
 from .indexerRegistry import IndexerRegistry
 from .readTextCatalogTask import ReadTextCatalogTask
+from .shardManifest import get_shard_manifest_path, read_shard_manifest, write_shard_manifest
 
 
 class IngestReferenceRunner(pipeBase.TaskRunner):
@@ -49,7 +63,9 @@ class IngestReferenceRunner(pipeBase.TaskRunner):
         """
         files = parsedCmd.files
         butler = parsedCmd.butler
-        task = self.TaskClass(config=self.config, log=self.log, butler=butler)
+        # parallel ingests make their own butlers for the output repository in the worker processes
+        output_root = parsedCmd.output if parsedCmd.output is not None else parsedCmd.input
+        task = self.TaskClass(config=self.config, log=self.log, butler=butler, output_root=output_root)
         task.writeConfig(parsedCmd.butler, clobber=self.clobberConfig, doBackup=self.doBackup)
 
         result = task.create_indexed_catalog(files)
@@ -69,6 +85,55 @@ class DatasetConfig(pexConfig.Config):
         default='HTM',
         doc='Name of indexer algoritm to use.  Default is HTM',
     )
+    has_manifest = pexConfig.Field(
+        dtype=bool,
+        default=False,
+        doc='Is there a manifest of every populated shard, with its number of rows and its size on disk '
+            '(for columnar shards the sum of the FITS and columnar files), in a file next to this config?  '
+            'Set by the ingest; if False, loaders must check whether each shard exists.',
+    )
+    shard_format = pexConfig.ChoiceField(
+        dtype=str,
+        default='fits',
+        allowed={
+            'fits': 'Each shard is a SourceCatalog FITS file, read in full.',
+            'columnar': 'Each shard is an empty SourceCatalog FITS file holding the schema and a '
+                        'compressed columnar file of its rows, divided into row groups with the '
+                        'range of the coordinates and fluxes of each; see columnarShard.  The '
+                        'ranges only let loaders skip row groups if the rows are ordered, so set '
+                        'sub_index_depth (or sort_flux_column for flux limits) with this format.',
+        },
+        doc='Storage format of the shards.',
+    )
+    row_group_size = pexConfig.RangeField(
+        dtype=int,
+        default=10000,
+        min=1,
+        doc='Maximum number of rows in a row group of a columnar shard.  Row groups are only '
+            'compact on the sky if sub_index_depth is set.',
+    )
+    sort_flux_column = pexConfig.Field(
+        dtype=str,
+        optional=True,
+        doc='Magnitude column (an entry of mag_column_list) by whose flux the rows of each shard are '
+            'sorted, brightest first (optional).  Loaders then read only the bright prefix of each '
+            'shard for a magnitude limit in that filter.',
+    )
+    add_unit_vectors = pexConfig.Field(
+        dtype=bool,
+        default=False,
+        doc='Store the ICRS unit vector of each row in fields coord_x, coord_y and coord_z, so that '
+            'loaders can trim shards to a circle without trigonometry?',
+    )
+    sub_index_depth = pexConfig.RangeField(
+        dtype=int,
+        default=0,
+        min=0,
+        doc='HTM depth of the cells by which the rows of each shard are sorted, or 0 not to sort them.  '
+            'The id of the cell of each row is stored in field htm_sub_id, so that loaders can trim '
+            'shards to a region by reading only the rows of the cells that overlap it.  The depth '
+            'should be a few levels deeper than the shards.  Cannot be used with sort_flux_column.',
+    )
 
 
 class IngestIndexedReferenceConfig(pexConfig.Config):
@@ -124,6 +189,45 @@ class IngestIndexedReferenceConfig(pexConfig.Config):
         default=[],
         doc='Extra columns to add to the reference catalog.'
     )
+    rows_per_chunk = pexConfig.RangeField(
+        dtype=int,
+        default=1000000,
+        min=1,
+        doc="Number of rows to read from an input file at a time, if the file_reader supports "
+            "reading in chunks."
+    )
+    max_rows_in_memory = pexConfig.Field(
+        dtype=int,
+        default=10000000,
+        doc="Maximum number of input rows to buffer in memory while sorting them into shards; "
+            "when exceeded the buffered rows are spilled to temporary files.  0 means no limit."
+    )
+    n_processes = pexConfig.Field(
+        dtype=int,
+        default=1,
+        doc="Number of python processes to use when ingesting.  If greater than 1 the input files are "
+            "read and indexed, and the shards written, in parallel, with each file read by one process "
+            "and each shard owned by one process."
+    )
+    checkpoint_file = pexConfig.Field(
+        dtype=str,
+        optional=True,
+        doc="Path of a file in which to record the progress of the ingest (optional).  If set, the "
+            "files are ingested in batches and a rerun with the same checkpoint file resumes an "
+            "interrupted ingest."
+    )
+    files_per_checkpoint = pexConfig.RangeField(
+        dtype=int,
+        default=10,
+        min=1,
+        doc="Number of input files to ingest between checkpoints, if checkpoint_file is set."
+    )
+    spill_dir = pexConfig.Field(
+        dtype=str,
+        optional=True,
+        doc="Directory in which to create temporary spill files (optional); "
+            "if None the system default temporary directory is used."
+    )
 
     def validate(self):
         pexConfig.Config.validate(self)
@@ -132,6 +236,337 @@ class IngestIndexedReferenceConfig(pexConfig.Config):
                              " supplied.")
         if len(self.mag_err_column_map) > 0 and not len(self.mag_column_list) == len(self.mag_err_column_map):
             raise ValueError("If magnitude errors are provided, all magnitudes must have an error column")
+        sort_flux_column = self.dataset_config.sort_flux_column
+        if sort_flux_column and sort_flux_column not in self.mag_column_list:
+            raise ValueError("dataset_config.sort_flux_column %r is not in mag_column_list" %
+                             (sort_flux_column,))
+        if sort_flux_column and self.dataset_config.sub_index_depth > 0:
+            raise ValueError("dataset_config.sort_flux_column and dataset_config.sub_index_depth "
+                             "cannot both be set")
+
+
+def _promote_dtype(dtype, other):
+    """!Return a structured dtype whose fields can hold the values of both inputs
+
+    Chunks of a text file may be read with different types for the same column, e.g. strings
+    of different widths or integers where a later chunk has floats.
+
+    @param[in] dtype  numpy structured dtype, or None
+    @param[in] other  numpy structured dtype with the same field names
+    @return the promoted dtype
+    """
+    if dtype is None or dtype == other:
+        return other
+    return np.dtype([(name, np.promote_types(dtype[name], other[name])) for name in dtype.names])
+
+
+def _concatenate(arrays):
+    """!Concatenate numpy structured arrays whose fields may differ in type
+
+    @param[in] arrays  list of numpy structured arrays with the same field names
+    @return the concatenated array, with a type given by _promote_dtype
+    """
+    dtype = None
+    for arr in arrays:
+        dtype = _promote_dtype(dtype, arr.dtype)
+    return np.concatenate([arr.astype(dtype, copy=False) for arr in arrays])
+
+
+def _reorder_catalog(catalog, order):
+    """!Return a copy of a catalog with its records in a new order
+
+    @param[in] catalog  afwTable.SourceCatalog
+    @param[in] order  numpy array of the indices of the records, in their new order
+    @return a contiguous afwTable.SourceCatalog
+    """
+    if not catalog.isContiguous():
+        catalog = catalog.copy(deep=True)
+    new_catalog = afwTable.SourceCatalog(catalog.schema)
+    new_catalog.reserve(len(order))
+    new_catalog.resize(len(order))
+    for name, values in catalog.extract("*").items():
+        key = catalog.schema.find(name).key
+        values = np.asarray(values)[order]
+        if values.dtype.kind in ('U', 'S'):
+            # String fields cannot be set as a column
+            for record, value in zip(new_catalog, values):
+                record.set(key, str(value))
+        elif values.dtype.kind == 'b':
+            # Nor can Flag fields, which are packed bits
+            for record, value in zip(new_catalog, values):
+                record.set(key, bool(value))
+        else:
+            new_catalog[key] = values
+    return new_catalog
+
+
+def _write_fits_catalog(catalog, path):
+    """!Write a catalog to a FITS file, atomically replacing any existing file
+
+    The catalog is written to a temporary file in the same directory, which is then
+    renamed to path, so that an interrupted write leaves any existing file intact.
+
+    @param[in] catalog  afwTable.SourceCatalog to write
+    @param[in] path  path of the FITS file
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = path + '.tmp'
+    try:
+        catalog.writeFits(tmp_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+# numpy types of the numeric field types of afw tables
+_FIELD_DTYPES = {'B': np.uint8, 'U': np.uint16, 'I': np.int32, 'L': np.int64,
+                 'F': np.float32, 'D': np.float64}
+
+
+def _load_spilled(spill_files, path, start, stop):
+    """!Read the rows of one shard from a spill file written by _ShardBuckets.spill
+
+    @param[in,out] spill_files  dict of path: memory-mapped spill file, to which the file
+        is added if it is not already open
+    @param[in] path  Path of the spill file
+    @param[in] start  Index of the first row of the shard in the file
+    @param[in] stop  Index one past the last row of the shard in the file
+    @return the rows (a numpy structured array) and their ids (a numpy array)
+    """
+    if path not in spill_files:
+        spill_files[path] = np.load(path, mmap_mode='r')
+    # only the rows of the shard are read from the memory-mapped file
+    spilled = spill_files[path][start:stop]
+    return np.array(spilled['row']), np.array(spilled['id'])
+
+
+class _ShardBuckets:
+    """!Buffer of input rows sorted into shards by pixel id
+
+    Rows are held in memory until more than max_rows are buffered, at which point all
+    buffered rows are spilled to a single numpy file in a temporary directory, sorted by
+    pixel id, and the range of rows of each shard in that file is kept in memory.  The rows
+    of each shard are returned in input order by pop.
+    """
+
+    def __init__(self, max_rows=0, spill_dir=None):
+        """!Construct an empty set of buckets
+
+        @param[in] max_rows  Maximum number of rows to hold in memory; 0 for no limit
+        @param[in] spill_dir  Directory in which to make the temporary spill directory;
+            None for the system default
+        """
+        self.max_rows = max_rows
+        self.spill_dir = spill_dir
+        self.n_rows = 0
+        self._n_in_memory = 0
+        self._n_spills = 0
+        self._tmp_dir = None
+        # pixel_id: list of (array, ids) pieces, or (spill file, start, stop) once spilled
+        self._pieces = collections.OrderedDict()
+        # spill file: number of shards with rows in it that have not been popped
+        self._spill_refs = {}
+        # spill file: memory map of the file, once rows have been popped from it
+        self._spill_files = {}
+
+    def add(self, arr, ids, index_list):
+        """!Sort rows into buckets
+
+        @param[in] arr  numpy structured array of input rows
+        @param[in] ids  numpy array of record ids, one per row
+        @param[in] index_list  numpy array of pixel ids, one per row
+        """
+        index_list = np.asarray(index_list)
+        # a stable sort preserves the input order within each shard
+        order = np.argsort(index_list, kind='mergesort')
+        sorted_index = index_list[order]
+        arr = arr[order]
+        ids = ids[order]
+        pixel_ids, starts = np.unique(sorted_index, return_index=True)
+        stops = np.append(starts[1:], len(sorted_index))
+        for pixel_id, start, stop in zip(pixel_ids, starts, stops):
+            self._pieces.setdefault(int(pixel_id), []).append((arr[start:stop], ids[start:stop]))
+        self.n_rows += len(arr)
+        self._n_in_memory += len(arr)
+        if self.max_rows > 0 and self._n_in_memory > self.max_rows:
+            self.spill()
+
+    def spill(self):
+        """!Write all rows held in memory to one spill file, sorted by pixel id
+        """
+        in_memory = collections.OrderedDict()
+        for pixel_id in sorted(self._pieces.keys()):
+            pieces = [piece for piece in self._pieces[pixel_id] if not isinstance(piece[0], str)]
+            if pieces:
+                in_memory[pixel_id] = pieces
+        if not in_memory:
+            return
+        if self._tmp_dir is None:
+            self._tmp_dir = tempfile.mkdtemp(prefix='ref_cat_ingest_', dir=self.spill_dir)
+        path = os.path.join(self._tmp_dir, '%d.npy' % (self._n_spills,))
+        arr = _concatenate([piece[0] for pieces in in_memory.values() for piece in pieces])
+        ids = np.concatenate([piece[1] for pieces in in_memory.values() for piece in pieces])
+        spilled = np.empty(len(arr), dtype=[('id', ids.dtype), ('row', arr.dtype)])
+        spilled['id'] = ids
+        spilled['row'] = arr
+        np.save(path, spilled)
+        start = 0
+        for pixel_id, pieces in in_memory.items():
+            stop = start + sum(len(piece[0]) for piece in pieces)
+            # spilled rows precede any rows added later, so input order is preserved
+            self._pieces[pixel_id] = [piece for piece in self._pieces[pixel_id]
+                                      if isinstance(piece[0], str)] + [(path, start, stop)]
+            start = stop
+        self._spill_refs[path] = len(in_memory)
+        self._n_spills += 1
+        self._n_in_memory = 0
+
+    def pixel_ids(self):
+        """!Return a list of the pixel ids of all non-empty buckets
+        """
+        return list(self._pieces.keys())
+
+    def pop(self, pixel_id):
+        """!Remove the rows of one shard from the buckets
+
+        A spill file is removed once the rows of all of its shards have been popped.
+
+        @param[in] pixel_id  Pixel id of the shard
+        @return the rows (a numpy structured array) and their ids (a numpy array)
+        """
+        arrs = []
+        ids = []
+        for piece in self._pieces.pop(pixel_id):
+            if isinstance(piece[0], str):
+                arr, piece_ids = _load_spilled(self._spill_files, *piece)
+                arrs.append(arr)
+                ids.append(piece_ids)
+                self._spill_refs[piece[0]] -= 1
+                if self._spill_refs[piece[0]] == 0:
+                    del self._spill_refs[piece[0]]
+                    del self._spill_files[piece[0]]
+                    os.remove(piece[0])
+            else:
+                arrs.append(piece[0])
+                ids.append(piece[1])
+                self._n_in_memory -= len(piece[0])
+        return _concatenate(arrs), np.concatenate(ids)
+
+    def detach(self):
+        """!Spill all buffered rows and give up ownership of the spill files
+
+        @return a dict of pixel id: list of (spill file, start, stop) triples, in input order,
+            where rows start to stop of the spill file belong to the shard
+        """
+        self.spill()
+        pieces = dict(self._pieces)
+        self._pieces.clear()
+        self._spill_refs.clear()
+        self._spill_files.clear()
+        self._tmp_dir = None
+        return pieces
+
+    def cleanup(self):
+        """!Discard all buffered rows and remove the spill directory
+        """
+        self._pieces.clear()
+        self._spill_refs.clear()
+        self._spill_files.clear()
+        self._n_in_memory = 0
+        if self._tmp_dir is not None:
+            shutil.rmtree(self._tmp_dir, ignore_errors=True)
+            self._tmp_dir = None
+
+
+class _IngestCheckpoint:
+    """!Progress of an ingest, persisted as a JSON file
+
+    The checkpoint lists the input files whose rows have been committed to shards, the number
+    of rows committed to each shard, and the shards being written by the current batch, if any.
+    """
+
+    def __init__(self, path=None):
+        """!Construct a checkpoint, reading it from path if that file exists
+
+        @param[in] path  Path of the checkpoint file, or None to keep the checkpoint in memory
+        """
+        self.path = path
+        self.files = []
+        self.n_rows = 0
+        self.shard_rows = {}
+        self.shard_bytes = {}
+        self.pending = []
+        if path is not None and os.path.exists(path):
+            with open(path) as f:
+                state = json.load(f)
+            self.files = state['files']
+            self.n_rows = state['n_rows']
+            self.shard_rows = {int(pixel_id): n for pixel_id, n in state['shard_rows'].items()}
+            self.shard_bytes = {int(pixel_id): n for pixel_id, n in state['shard_bytes'].items()}
+            self.pending = state['pending']
+
+    def write(self):
+        """!Atomically replace the checkpoint file, if any, with the current state
+        """
+        if self.path is None:
+            return
+        state = dict(
+            files=self.files,
+            n_rows=self.n_rows,
+            shard_rows={str(pixel_id): n for pixel_id, n in self.shard_rows.items()},
+            shard_bytes={str(pixel_id): n for pixel_id, n in self.shard_bytes.items()},
+            pending=self.pending,
+        )
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.path)
+
+    def commit(self, files, result):
+        """!Record that a batch of files has been written to its shards
+
+        @param[in] files  List of the files in the batch
+        @param[in] result  pipeBase.Struct returned by IngestIndexedReferenceTask._ingest_serial
+            or _ingest_parallel for the batch
+        """
+        self.files.extend(os.path.abspath(filename) for filename in files)
+        self.n_rows += result.n_rows
+        self.shard_rows.update(result.shard_rows)
+        self.shard_bytes.update(result.shard_bytes)
+        self.pending = []
+        self.write()
+
+
+# The task used by the worker processes of a parallel ingest
+_worker_task = None
+
+
+def _init_worker(config, output_root):
+    """!Initialize a worker process of a parallel ingest
+
+    The task and its butler are made anew in each worker, rather than pickled, so that
+    the workers can be started by any multiprocessing start method.
+
+    @param[in] config  IngestIndexedReferenceConfig of the ingest, with the indexer config
+        updated with any pixels the indexer chose from the data
+    @param[in] output_root  Root of the output repository
+    """
+    global _worker_task
+    _worker_task = IngestIndexedReferenceTask(config=config, butler=dafPersist.Butler(output_root))
+
+
+def _run_bucket_file(args):
+    """!Call IngestIndexedReferenceTask._bucket_file in a worker process
+    """
+    return _worker_task._bucket_file(*args)
+
+
+def _run_write_shards(args):
+    """!Call IngestIndexedReferenceTask._write_shards in a worker process
+    """
+    return _worker_task._write_shards(*args)
 
 
 class IngestIndexedReferenceTask(pipeBase.CmdLineTask):
@@ -163,43 +598,613 @@ class IngestIndexedReferenceTask(pipeBase.CmdLineTask):
         """!Constructor for the HTM indexing engine
 
         @param[in] butler  dafPersistence.Butler object for reading and writing catalogs
+        @param[in] output_root  Root of the repository the butler writes to (optional);
+            required if config.n_processes > 1, to make a butler in each worker process
         """
         self.butler = kwargs.pop('butler')
+        self.output_root = kwargs.pop('output_root', None)
         pipeBase.Task.__init__(self, *args, **kwargs)
         self.indexer = IndexerRegistry[self.config.dataset_config.indexer.name](
             self.config.dataset_config.indexer.active)
         self.makeSubtask('file_reader')
+        # HTM of the cells by which the rows of each shard are sorted, made when first needed
+        self._sub_htm = None
+        # Schema of the persisted master schema catalog, once written
+        self._master_schema = None
 
     def create_indexed_catalog(self, files):
         """!Index a set of files comprising a reference catalog.  Outputs are persisted in the
         data repository.
 
+        All input files are read and their rows sorted into shards before anything is
+        written, so that each shard is read and written exactly once.  If config.n_processes
+        is greater than one the files are read and indexed, and the shards written, by a pool
+        of processes, with each file read and each shard written by exactly one process.
+
+        If config.checkpoint_file is set the files are instead ingested in batches of
+        config.files_per_checkpoint files, and the progress is recorded in the checkpoint file
+        after each batch.  Rerunning an interrupted ingest with the same checkpoint file skips
+        the files that were committed and rolls back the shards of the interrupted batch.
+
+        If config.dataset_config.sort_flux_column is set the rows of each shard are sorted by
+        that flux, brightest first, and if config.dataset_config.sub_index_depth is set they are
+        sorted by HTM cell, as the shard is written; if config.checkpoint_file is also set the
+        shards are instead sorted after the last batch.
+
+        If the indexer chooses its pixels from the data (e.g. MULTI_ORDER_HEALPIX), all the files
+        are read once first to count the rows in each pixel, and the chosen pixels are recorded
+        in the persisted dataset config.  The pixels are chosen from the files of one ingest,
+        so such a catalog can generally not be extended by a later ingest: RuntimeError is
+        raised before anything is written if the reference catalog already exists with a
+        different indexer config, including the chosen pixels.
+
         @param[in] files  A list of file names to read.
+        @return a pipeBase.Struct containing:
+        - shard_rows: dict of pixel id: number of rows in each shard written
+        - shard_bytes: dict of pixel id: size on disk in bytes of each shard written
         """
-        rec_num = 0
-        first = True
+        start_time = time.time()
+        if hasattr(self.indexer, 'count_points'):
+            self._count_points(files)
+        self._check_existing_config()
+        checkpoint = _IngestCheckpoint(self.config.checkpoint_file)
+        if checkpoint.pending:
+            self._roll_back(checkpoint)
+        if checkpoint.files:
+            self.log.info("Resuming ingest from %s: skipping %d committed files",
+                          self.config.checkpoint_file, len(checkpoint.files))
+        committed = collections.Counter(checkpoint.files)
+        remaining = []
         for filename in files:
-            arr = self.file_reader.run(filename)
-            index_list = self.indexer.index_points(arr[self.config.ra_name], arr[self.config.dec_name])
-            if first:
-                schema, key_map = self.make_schema(arr.dtype)
-                # persist empty catalog to hold the master schema
-                dataId = self.indexer.make_data_id('master_schema',
-                                                   self.config.dataset_config.ref_dataset_name)
-                self.butler.put(self.get_catalog(dataId, schema), 'ref_cat',
-                                dataId=dataId)
-                first = False
-            pixel_ids = set(index_list)
-            for pixel_id in pixel_ids:
-                dataId = self.indexer.make_data_id(pixel_id, self.config.dataset_config.ref_dataset_name)
-                catalog = self.get_catalog(dataId, schema)
-                els = np.where(index_list == pixel_id)
-                for row in arr[els]:
-                    record = catalog.addNew()
-                    rec_num = self._fill_record(record, row, rec_num, key_map)
-                self.butler.put(catalog, 'ref_cat', dataId=dataId)
+            if committed[os.path.abspath(filename)] > 0:
+                committed[os.path.abspath(filename)] -= 1
+            else:
+                remaining.append(filename)
+        files = remaining
+
+        if self.config.checkpoint_file:
+            batch_size = self.config.files_per_checkpoint
+            begin_write = functools.partial(self._begin_write, checkpoint)
+        else:
+            batch_size = len(files)
+            begin_write = None
+
+        n_rows = 0
+        for i in range(0, len(files), max(batch_size, 1)):
+            batch = files[i:i + batch_size]
+            if self.config.n_processes > 1:
+                result = self._ingest_parallel(batch, checkpoint.n_rows, begin_write)
+            else:
+                result = self._ingest_serial(batch, checkpoint.n_rows, begin_write)
+            checkpoint.commit(batch, result)
+            n_rows += result.n_rows
+        if self.config.checkpoint_file and self._sorts_shards():
+            # Rolling back a batch relies on new rows being appended to the shards, so shards
+            # of a checkpointed ingest are sorted once all the files are committed
+            checkpoint.shard_bytes.update(self._sort_shards(list(checkpoint.shard_bytes.keys())))
+        shard_rows = {pixel_id: checkpoint.shard_rows[pixel_id] for pixel_id in checkpoint.shard_bytes}
+        self._put_dataset_config(shard_rows, checkpoint.shard_bytes)
+
+        elapsed = time.time() - start_time
+        rows_per_sec = n_rows/elapsed if elapsed > 0 else 0.0
+        n_bytes = sum(checkpoint.shard_bytes.values())
+        self.log.info("Ingested %d rows into %d shards (%d bytes) in %.1f sec: %.0f rows/sec",
+                      n_rows, len(checkpoint.shard_bytes), n_bytes, elapsed, rows_per_sec)
+        self.metadata.set("numRowsIngested", n_rows)
+        self.metadata.set("numShardsWritten", len(checkpoint.shard_bytes))
+        self.metadata.set("numBytesWritten", n_bytes)
+        self.metadata.set("rowsPerSec", rows_per_sec)
+        return pipeBase.Struct(
+            shard_rows=shard_rows,
+            shard_bytes=dict(checkpoint.shard_bytes),
+        )
+
+    def _put_dataset_config(self, shard_rows, shard_bytes):
+        """!Persist the dataset config, with a manifest of the populated shards
+
+        The manifest is written by write_shard_manifest to a file next to the dataset config,
+        before the dataset config, so a dataset config with has_manifest set always has one.
+        The manifest is merged with that of an existing dataset config, so that ingesting
+        more files into a reference catalog keeps the shards written by earlier ingests.
+        If an existing dataset config has no manifest, none is written.
+
+        @param[in] shard_rows  dict of pixel id: number of rows in each shard written
+        @param[in] shard_bytes  dict of pixel id: size on disk in bytes of each shard written
+        """
+        dataId = self.indexer.make_data_id(None, self.config.dataset_config.ref_dataset_name)
+        # The task config is frozen, so persist a copy with the manifest filled in
+        dataset_config = self._make_dataset_config()
+        dataset_config.has_manifest = True
+        all_rows = {}
+        all_bytes = {}
+        if self.butler.datasetExists('ref_cat_config', dataId=dataId):
+            old_config = self.butler.get('ref_cat_config', dataId=dataId, immediate=True)
+            dataset_config.has_manifest = old_config.has_manifest
+            # shards written by the earlier ingest are not sorted the same way
+            if old_config.sort_flux_column != dataset_config.sort_flux_column:
+                dataset_config.sort_flux_column = None
+            if old_config.sub_index_depth != dataset_config.sub_index_depth:
+                dataset_config.sub_index_depth = 0
+            if old_config.has_manifest:
+                all_rows, all_bytes = read_shard_manifest(
+                    get_shard_manifest_path(self.butler.getUri('ref_cat_config', dataId=dataId)))
+        if dataset_config.has_manifest:
+            all_rows.update(shard_rows)
+            all_bytes.update(shard_bytes)
+            write_shard_manifest(
+                get_shard_manifest_path(self.butler.getUri('ref_cat_config', dataId=dataId, write=True)),
+                all_rows, all_bytes)
+        self.butler.put(dataset_config, 'ref_cat_config', dataId=dataId)
+
+    def _make_dataset_config(self):
+        """!Return a copy of the dataset config, including any pixels the indexer chose from the data
+        """
+        stream = io.StringIO()
+        self.config.dataset_config.saveToStream(stream)
+        dataset_config = DatasetConfig()
+        dataset_config.loadFromStream(stream.getvalue())
+        if hasattr(self.indexer, 'update_config'):
+            self.indexer.update_config(dataset_config.indexer.active)
+        return dataset_config
+
+    def _check_existing_config(self):
+        """!Check that an existing reference catalog is indexed the same way as this ingest
+
+        The shards of an existing catalog are only found by the loader if the pixels are
+        unchanged, so its indexer config, including any pixels a data-driven indexer chose,
+        must match that of this ingest.
+
+        @throw RuntimeError if the reference catalog exists with a different indexer config
+        """
         dataId = self.indexer.make_data_id(None, self.config.dataset_config.ref_dataset_name)
-        self.butler.put(self.config.dataset_config, 'ref_cat_config', dataId=dataId)
+        if not self.butler.datasetExists('ref_cat_config', dataId=dataId):
+            return
+        old_config = self.butler.get('ref_cat_config', dataId=dataId, immediate=True)
+        new_config = self._make_dataset_config()
+        if old_config.indexer.name != new_config.indexer.name or \
+                not old_config.indexer.active.compare(new_config.indexer.active):
+            raise RuntimeError("Reference catalog %s already exists with a different indexer config; "
+                               "its shards would not be found.  Ingest all the files at once instead."
+                               % (self.config.dataset_config.ref_dataset_name,))
+
+    def _count_points(self, files):
+        """!Count the rows of a set of files in the pixels of the indexer, so that it can choose its pixels
+
+        @param[in] files  A list of file names to read.
+        """
+        for filename in files:
+            for arr in self._read_chunks(filename):
+                self.indexer.count_points(arr[self.config.ra_name], arr[self.config.dec_name])
+        split_pixels = self.indexer.finish_counts()
+        self.log.info("Split %d pixels to limit shards to %d rows",
+                      len(split_pixels), self.indexer.max_rows_per_shard)
+
+    def _begin_write(self, checkpoint, pixel_ids):
+        """!Record in a checkpoint that a batch is about to write to a set of shards
+
+        @param[in,out] checkpoint  _IngestCheckpoint of the ingest
+        @param[in] pixel_ids  List of pixel ids of the shards to be written
+        """
+        # Record the committed size of each shard before any of them is modified
+        for pixel_id in pixel_ids:
+            if pixel_id not in checkpoint.shard_rows:
+                checkpoint.shard_rows[pixel_id] = self._get_shard_size(pixel_id)
+        checkpoint.pending = list(pixel_ids)
+        checkpoint.write()
+
+    def _get_shard_size(self, pixel_id):
+        """!Return the number of rows in a persisted shard
+
+        @param[in] pixel_id  Pixel id of the shard
+        @return the number of rows in the shard, or 0 if it does not exist
+        """
+        dataId = self.indexer.make_data_id(pixel_id, self.config.dataset_config.ref_dataset_name)
+        if self.butler.datasetExists('ref_cat', dataId=dataId):
+            return len(self._get_shard(dataId))
+        return 0
+
+    def _roll_back(self, checkpoint):
+        """!Truncate the shards of an interrupted batch to their committed size
+
+        New rows are always appended to a shard, so the committed rows are a prefix of it.
+
+        @param[in,out] checkpoint  _IngestCheckpoint with a list of pending shards
+        """
+        for pixel_id in checkpoint.pending:
+            dataId = self.indexer.make_data_id(pixel_id, self.config.dataset_config.ref_dataset_name)
+            if not self.butler.datasetExists('ref_cat', dataId=dataId):
+                continue
+            catalog = self._get_shard(dataId)
+            n_rows = checkpoint.shard_rows.get(pixel_id, 0)
+            if len(catalog) > n_rows:
+                self.log.info("Rolling back shard %s from %d to %d rows", pixel_id, len(catalog), n_rows)
+                self._put_shard(catalog[:n_rows], dataId)
+        checkpoint.pending = []
+        checkpoint.write()
+
+    def _ingest_serial(self, files, rec_num=0, begin_write=None):
+        """!Read a set of files and write their rows to shards in this process
+
+        @param[in] files  A list of file names to read.
+        @param[in] rec_num  Number of records assigned an id by earlier calls
+        @param[in] begin_write  Function to call with the list of pixel ids of the shards
+            to be written before any of them is written, or None
+        @return a pipeBase.Struct containing:
+        - n_rows: number of rows read
+        - shard_rows: dict of pixel id: number of rows in each shard written
+        - shard_bytes: dict of pixel id: size on disk in bytes of each shard written
+        """
+        dtype = None
+        buckets = _ShardBuckets(self.config.max_rows_in_memory, self.config.spill_dir)
+        shard_rows = {}
+        shard_bytes = {}
+        try:
+            for filename in files:
+                for arr in self._read_chunks(filename):
+                    index_list = self.indexer.index_points(arr[self.config.ra_name],
+                                                           arr[self.config.dec_name])
+                    dtype = _promote_dtype(dtype, arr.dtype)
+                    ids, rec_num = self._make_ids(arr, rec_num)
+                    buckets.add(arr, ids, index_list)
+            if dtype is not None:
+                schema, key_map = self._put_master_schema(dtype)
+            if begin_write is not None:
+                begin_write(buckets.pixel_ids())
+            for pixel_id in buckets.pixel_ids():
+                arr, ids = buckets.pop(pixel_id)
+                shard_rows[pixel_id], shard_bytes[pixel_id] = self._write_shard(pixel_id, arr, ids,
+                                                                                schema, key_map)
+        finally:
+            buckets.cleanup()
+        return pipeBase.Struct(
+            n_rows=buckets.n_rows,
+            shard_rows=shard_rows,
+            shard_bytes=shard_bytes,
+        )
+
+    def _ingest_parallel(self, files, rec_num=0, begin_write=None):
+        """!Read a set of files and write their rows to shards using a pool of processes
+
+        Each file is read, a chunk at a time, by a worker, which indexes its rows and spills
+        them, sorted into shards, to temporary files; only the names of the spill files are
+        returned here.  Each worker writes one spill file per flush, holding the rows of all of
+        its shards sorted by pixel id, and returns the range of rows of each shard.  The shards
+        are then divided among the workers so that every shard is written by exactly one of
+        them.  The master schema is written here.
+
+        @param[in] files  A list of file names to read.
+        @param[in] rec_num  Number of records assigned an id by earlier calls
+        @param[in] begin_write  Function to call with the list of pixel ids of the shards
+            to be written before any of them is written, or None
+        @return a pipeBase.Struct containing:
+        - n_rows: number of rows read
+        - shard_rows: dict of pixel id: number of rows in each shard written
+        - shard_bytes: dict of pixel id: size on disk in bytes of each shard written
+        """
+        if self.output_root is None:
+            raise RuntimeError("A parallel ingest requires the task to be constructed with output_root")
+        n_processes = self.config.n_processes
+        spill_dir = tempfile.mkdtemp(prefix='ref_cat_ingest_', dir=self.config.spill_dir)
+        dtype = None
+        n_rows = 0
+        # pixel_id: list of (spill file, start, stop, id offset), in input order
+        pixel_pieces = collections.OrderedDict()
+        try:
+            with multiprocessing.Pool(n_processes, initializer=_init_worker,
+                                      initargs=(self._get_worker_config(), self.output_root)) as pool:
+                # imap returns the results in the order of the files, so the rows of each shard
+                # stay in input order
+                for file_dtype, file_rows, pieces in pool.imap(_run_bucket_file,
+                                                               [(filename, spill_dir) for filename in files]):
+                    if file_dtype is None:
+                        continue
+                    dtype = _promote_dtype(dtype, file_dtype)
+                    # the workers number the rows of each file from 1, so offset them by the
+                    # rows of the earlier files
+                    id_offset = 0 if self.config.id_name else rec_num + n_rows
+                    for pixel_id, spans in pieces.items():
+                        pixel_pieces.setdefault(pixel_id, []).extend(
+                            (path, start, stop, id_offset) for path, start, stop in spans)
+                    n_rows += file_rows
+                if dtype is None:
+                    return pipeBase.Struct(n_rows=0, shard_rows={}, shard_bytes={})
+                self._put_master_schema(dtype)
+
+                # Deal the shards out to the writers so that each shard has exactly one owner.
+                pixel_ids = list(pixel_pieces.keys())
+                if begin_write is not None:
+                    begin_write(pixel_ids)
+                n_writers = min(n_processes, len(pixel_ids))
+                write_results = pool.map(_run_write_shards, [
+                    (dtype, [(pixel_id, pixel_pieces[pixel_id]) for pixel_id in pixel_ids[i::n_writers]])
+                    for i in range(n_writers)])
+        finally:
+            shutil.rmtree(spill_dir, ignore_errors=True)
+        shard_rows = {}
+        shard_bytes = {}
+        for rows, n_bytes in write_results:
+            shard_rows.update(rows)
+            shard_bytes.update(n_bytes)
+        return pipeBase.Struct(
+            n_rows=n_rows,
+            shard_rows=shard_rows,
+            shard_bytes=shard_bytes,
+        )
+
+    def _get_worker_config(self):
+        """!Return a copy of the task config for the worker processes of a parallel ingest
+
+        The copy includes any pixels the indexer has chosen from the data.
+        """
+        stream = io.StringIO()
+        self.config.saveToStream(stream)
+        config = type(self.config)()
+        config.loadFromStream(stream.getvalue())
+        if hasattr(self.indexer, 'update_config'):
+            self.indexer.update_config(config.dataset_config.indexer.active)
+        return config
+
+    def _bucket_file(self, filename, spill_dir):
+        """!Read and index the rows of a file and spill them, sorted into shards, to temporary files
+
+        If config.id_name is not set the rows are given ids 1, 2, ... in the order of the file.
+
+        @param[in] filename  Name of the file to read
+        @param[in] spill_dir  Directory in which to write the spill files
+        @return the numpy dtype of the rows (None if the file has no rows), the number of rows,
+            and a dict of pixel id: list of (spill file, start, stop) triples, in input order
+        """
+        dtype = None
+        rec_num = 0
+        buckets = _ShardBuckets(self.config.max_rows_in_memory, spill_dir)
+        for arr in self._read_chunks(filename):
+            index_list = self.indexer.index_points(arr[self.config.ra_name], arr[self.config.dec_name])
+            dtype = _promote_dtype(dtype, arr.dtype)
+            ids, rec_num = self._make_ids(arr, rec_num)
+            buckets.add(arr, ids, index_list)
+        return dtype, buckets.n_rows, buckets.detach()
+
+    def _read_chunks(self, filename):
+        """!Read an input file in chunks of at most config.rows_per_chunk rows
+
+        Only the columns used by the ingest are read.  The whole file is returned as a single chunk,
+        with all of its columns, if the file reader has no iter_chunks method.
+
+        @param[in] filename  Name of the file to read
+        @return an iterator over numpy structured arrays of input rows
+        """
+        if hasattr(self.file_reader, 'iter_chunks'):
+            return self.file_reader.iter_chunks(filename, self.config.rows_per_chunk,
+                                                columns=self._get_columns())
+        return iter([self.file_reader.run(filename)])
+
+    def _get_columns(self):
+        """!Return the names of the input columns used by the ingest
+
+        @return a list of column names, in the order: ra, dec, id, magnitudes, magnitude errors,
+            flags, extra columns; each name appears only once
+        """
+        names = [self.config.ra_name, self.config.dec_name]
+        if self.config.id_name:
+            names.append(self.config.id_name)
+        names += self.config.mag_column_list
+        names += [self.config.mag_err_column_map[name] for name in self.config.mag_err_column_map.keys()]
+        for flag in self._flags:
+            name = getattr(self.config, 'is_{}_name'.format(flag))
+            if name:
+                names.append(name)
+        names += self.config.extra_col_names
+        return list(collections.OrderedDict.fromkeys(names))
+
+    def _write_shards(self, dtype, pixel_pieces):
+        """!Write shards from rows spilled to temporary files by _bucket_file
+
+        The master schema must have been persisted.
+
+        @param[in] dtype  numpy dtype of the input rows
+        @param[in] pixel_pieces  list of (pixel id, list of (spill file, start, stop, id offset)),
+            where rows start to stop of the spill file belong to the shard and the id offset
+            is added to their ids
+        @return a dict of pixel id: number of rows and a dict of pixel id: number of bytes
+            for each shard written
+        """
+        schema = self._get_persisted_master_schema()
+        key_map = self._get_key_map(schema, dtype)
+        shard_rows = {}
+        shard_bytes = {}
+        spill_files = {}
+        for pixel_id, pieces in pixel_pieces:
+            arrs = []
+            ids = []
+            for path, start, stop, id_offset in pieces:
+                arr, piece_ids = _load_spilled(spill_files, path, start, stop)
+                arrs.append(arr)
+                ids.append(piece_ids + id_offset)
+            arr = _concatenate(arrs)
+            ids = np.concatenate(ids)
+            shard_rows[pixel_id], shard_bytes[pixel_id] = self._write_shard(pixel_id, arr, ids,
+                                                                            schema, key_map)
+        return shard_rows, shard_bytes
+
+    def _put_master_schema(self, dtype):
+        """!Persist an empty catalog to hold the master schema, unless already persisted
+
+        The master schema is made from the rows of the first batch of files; all of that
+        batch is read before the schema is made, so it fits every chunk of the batch.  The
+        rows of later batches must fit that schema, as checked by _get_key_map.  If the
+        reference catalog already has a master schema, e.g. because this ingest resumes from
+        a checkpoint or adds files to an existing catalog, the persisted schema is used and
+        never replaced.
+
+        @param[in] dtype  A np.dtype to use in constructing the schema
+        @return the master schema and the map of its keys to use in filling the records
+        @throw RuntimeError if the master schema has already been persisted and rows of dtype
+            do not fit it
+        """
+        if self._master_schema is None:
+            self._master_schema = self._get_persisted_master_schema()
+        if self._master_schema is not None:
+            return self._master_schema, self._get_key_map(self._master_schema, dtype)
+        schema, key_map = self.make_schema(dtype)
+        dataId = self.indexer.make_data_id('master_schema', self.config.dataset_config.ref_dataset_name)
+        self.butler.put(afwTable.SourceCatalog(schema), 'ref_cat', dataId=dataId)
+        self._master_schema = schema
+        return schema, key_map
+
+    def _get_persisted_master_schema(self):
+        """!Return the persisted master schema, or None if it has not been persisted
+        """
+        dataId = self.indexer.make_data_id('master_schema', self.config.dataset_config.ref_dataset_name)
+        if not self.butler.datasetExists('ref_cat', dataId=dataId):
+            return None
+        return self.butler.get('ref_cat', dataId=dataId, immediate=True).schema
+
+    def _get_key_map(self, schema, dtype):
+        """!Return the map of catalog keys of a schema to use in filling records from rows of a dtype
+
+        Chunks of input may be read with different types for a column (see
+        ReadTextCatalogTask.iter_chunks), so the rows need not have the types the schema was
+        made from, but their values must fit its fields without loss: strings must be no
+        wider, and numbers must be safely castable to the type of the field.
+
+        @param[in] schema  Schema made by make_schema, e.g. the master schema
+        @param[in] dtype  np.dtype of the input rows
+        @return the map of catalog keys, as returned by make_schema, but with keys of schema
+        @throw RuntimeError if a field of the records is not in schema, or a column of dtype
+            does not fit its field in schema
+        """
+        new_schema, new_key_map = self.make_schema(dtype)
+        missing = sorted(set(new_key_map) - set(schema.getNames()))
+        if missing:
+            raise RuntimeError("Fields %s are not in the master schema of reference catalog %s" %
+                               (missing, self.config.dataset_config.ref_dataset_name))
+        for name in self.config.extra_col_names:
+            field = schema.find(name).field
+            new_field = new_schema.find(name).field
+            type_str = field.getTypeString()
+            new_type_str = new_field.getTypeString()
+            if type_str == 'String' and new_type_str == 'String':
+                if new_field.getSize() <= field.getSize():
+                    continue
+            elif type_str == new_type_str:
+                continue
+            elif type_str in _FIELD_DTYPES and new_type_str in _FIELD_DTYPES and \
+                    np.can_cast(_FIELD_DTYPES[new_type_str], _FIELD_DTYPES[type_str], casting='safe'):
+                continue
+            raise RuntimeError("Column %s of the input does not fit its field in the master schema of "
+                               "reference catalog %s: %s cannot hold %s without loss" %
+                               (name, self.config.dataset_config.ref_dataset_name,
+                                self._describe_field(field), self._describe_field(new_field)))
+        # the names in a key map are those of the fields
+        return {name: schema.find(name).key for name in new_key_map}
+
+    @staticmethod
+    def _describe_field(field):
+        """!Return a description of the type of a field, e.g. "String[40]" or "D"
+        """
+        if field.getTypeString() == 'String':
+            return 'String[%d]' % (field.getSize(),)
+        return field.getTypeString()
+
+    def _write_shard(self, pixel_id, arr, ids, schema, key_map):
+        """!Add rows to a shard and persist it
+
+        @param[in] pixel_id  Pixel id of the shard
+        @param[in] arr  A numpy structured array of the rows to add
+        @param[in] ids  A numpy array of unique ids, one per row
+        @param[in] schema  Schema of the shard
+        @param[in] key_map  Map of catalog keys to use in filling the records
+        @return the number of rows and the size on disk in bytes of the shard
+        """
+        dataId = self.indexer.make_data_id(pixel_id, self.config.dataset_config.ref_dataset_name)
+        catalog = self._fill_catalog(self._get_shard(dataId, schema), arr, ids, key_map)
+        if self._sorts_shards() and not self.config.checkpoint_file:
+            catalog = self._sort_catalog(catalog)
+        n_bytes = self._put_shard(catalog, dataId)
+        self.log.debug("Wrote %d rows (%d bytes) to shard %s", len(catalog), n_bytes, pixel_id)
+        return len(catalog), n_bytes
+
+    def _get_shard(self, dataId, schema=None):
+        """!Get the catalog of a shard in the format of config.dataset_config.shard_format
+
+        @param[in] dataId  Identifier of the shard
+        @param[in] schema  Schema to use in catalog creation if the shard does not exist
+        @return afwTable.SourceCatalog of the rows of the shard
+        """
+        catalog = self.get_catalog(dataId, schema)
+        if self.config.dataset_config.shard_format == 'columnar' and \
+                self.butler.datasetExists('ref_cat', dataId=dataId):
+            path = get_columnar_shard_path(self.butler.getUri('ref_cat', dataId=dataId))
+            catalog = read_columnar_shard(path, catalog.schema)
+        return catalog
+
+    def _put_shard(self, catalog, dataId):
+        """!Persist the catalog of a shard in the format of config.dataset_config.shard_format
+
+        Each file is written to a temporary file that then replaces the old one, so that a
+        shard interrupted while being written can still be read, and rolled back, on resuming.
+
+        @param[in] catalog  afwTable.SourceCatalog of the rows of the shard
+        @param[in] dataId  Identifier of the shard
+        @return the size on disk in bytes of the files written
+        """
+        fits_path = self.butler.getUri('ref_cat', dataId=dataId, write=True)
+        if self.config.dataset_config.shard_format != 'columnar':
+            _write_fits_catalog(catalog, fits_path)
+            return os.path.getsize(fits_path)
+        # The FITS file holds an empty catalog, to carry the schema and mark the shard as existing
+        _write_fits_catalog(afwTable.SourceCatalog(catalog.schema), fits_path)
+        path = get_columnar_shard_path(fits_path)
+        write_columnar_shard(path, catalog, self.config.dataset_config.row_group_size)
+        return os.path.getsize(fits_path) + os.path.getsize(path)
+
+    def _sorts_shards(self):
+        """!Return True if the rows of each shard are sorted, by flux or by HTM cell"""
+        return bool(self.config.dataset_config.sort_flux_column) or \
+            self.config.dataset_config.sub_index_depth > 0
+
+    def _sort_catalog(self, catalog):
+        """!Sort a catalog as configured by config.dataset_config
+
+        If sort_flux_column is set the records are sorted by that flux, brightest first,
+        with NaN fluxes last; otherwise they are sorted by htm_sub_id.  Records with equal
+        keys keep their order.
+
+        @param[in] catalog  afwTable.SourceCatalog to sort
+        @return the sorted catalog, a contiguous copy
+        """
+        if not catalog.isContiguous():
+            catalog = catalog.copy(deep=True)
+        if self.config.dataset_config.sort_flux_column:
+            sort_key = -catalog[self.config.dataset_config.sort_flux_column + '_flux']
+        else:
+            sort_key = catalog['htm_sub_id']
+        return _reorder_catalog(catalog, np.argsort(sort_key, kind='mergesort'))
+
+    def _sort_shards(self, pixel_ids):
+        """!Sort persisted shards as configured by config.dataset_config
+
+        @param[in] pixel_ids  Pixel ids of the shards to sort
+        @return a dict of pixel id: size on disk in bytes of each sorted shard
+        """
+        shard_bytes = {}
+        for pixel_id in pixel_ids:
+            dataId = self.indexer.make_data_id(pixel_id, self.config.dataset_config.ref_dataset_name)
+            shard_bytes[pixel_id] = self._put_shard(self._sort_catalog(self._get_shard(dataId)), dataId)
+        return shard_bytes
+
+    def _make_ids(self, arr, rec_num):
+        """!Make the record ids for a set of input rows
+
+        @param[in] arr  numpy structured array of input rows
+        @param[in] rec_num  Number of records assigned an id so far
+        @return a numpy array of ids, one per row, and the updated record count
+        """
+        if self.config.id_name:
+            ids = np.asarray(arr[self.config.id_name]).astype(np.int64)
+        else:
+            ids = np.arange(rec_num + 1, rec_num + len(arr) + 1, dtype=np.int64)
+        return ids, rec_num + len(arr)
 
     @staticmethod
     def compute_coord(row, ra_name, dec_name):
@@ -211,72 +1216,123 @@ class IngestIndexedReferenceTask(pipeBase.CmdLineTask):
         """
         return afwGeom.SpherePoint(row[ra_name], row[dec_name], afwGeom.degrees)
 
-    def _set_flags(self, record, row, key_map):
-        """!Set the flags for a record.  Relies on the _flags class attribute
-        @param[in,out] record  SourceCatalog record to modify
-        @param[in] row  dict like object containing flag info
-        @param[in] key_map  Map of catalog keys to use in filling the record
+    @staticmethod
+    def compute_coord_arrays(ra, dec):
+        """!Compute ICRS coord_ra and coord_dec column values from arrays of RA and Dec
+
+        The values match those set by a record's setCoord(compute_coord(...)):
+        RA is wrapped into [0, 2 pi) and Dec must lie in [-pi/2, pi/2].
+
+        @param[in] ra  array of RA in degrees
+        @param[in] dec  array of Dec in degrees
+        @return arrays of RA and Dec in radians
+        @throw ValueError if any Dec is outside [-90, 90] degrees
+        """
+        ra = np.radians(np.asarray(ra, dtype=np.float64))
+        dec = np.radians(np.asarray(dec, dtype=np.float64))
+        if np.any(np.abs(dec) > 0.5*np.pi):
+            raise ValueError("Dec must be in the range [-90, 90] degrees")
+        ra = np.fmod(ra, 2.0*np.pi)
+        ra[ra < 0.0] += 2.0*np.pi
+        ra[ra >= 2.0*np.pi] = 0.0
+        return ra, dec
+
+    def _set_flags(self, catalog, arr, key_map):
+        """!Set the flag columns of a catalog.  Relies on the _flags class attribute
+        @param[in,out] catalog  contiguous SourceCatalog to modify
+        @param[in] arr  numpy structured array containing flag info
+        @param[in] key_map  Map of catalog keys to use in filling the catalog
         """
-        names = record.schema.getNames()
         for flag in self._flags:
-            if flag in names:
+            if flag in key_map:
                 attr_name = 'is_{}_name'.format(flag)
-                record.set(key_map[flag], bool(row[getattr(self.config, attr_name)]))
+                values = np.asarray(arr[getattr(self.config, attr_name)]).astype(bool)
+                # Flag fields are packed bits, which cannot be set as a column
+                for record, value in zip(catalog, values):
+                    record.set(key_map[flag], bool(value))
 
-    def _set_mags(self, record, row, key_map):
-        """!Set the flux records from the input magnitudes
-        @param[in,out] record  SourceCatalog record to modify
-        @param[in] row  dict like object containing magnitude values
-        @param[in] key_map  Map of catalog keys to use in filling the record
+    def _set_mags(self, catalog, arr, key_map):
+        """!Set the flux columns of a catalog from the input magnitudes
+        @param[in,out] catalog  contiguous SourceCatalog to modify
+        @param[in] arr  numpy structured array containing magnitude values
+        @param[in] key_map  Map of catalog keys to use in filling the catalog
         """
+        def get_column(name):
+            return np.ascontiguousarray(arr[name], dtype=np.float64)
+
         for item in self.config.mag_column_list:
-            record.set(key_map[item+'_flux'], fluxFromABMag(row[item]))
+            catalog[key_map[item+'_flux']] = fluxFromABMag(get_column(item))
         if len(self.config.mag_err_column_map) > 0:
             for err_key in self.config.mag_err_column_map.keys():
                 error_col_name = self.config.mag_err_column_map[err_key]
-                record.set(key_map[err_key+'_fluxSigma'],
-                           fluxErrFromABMagErr(row[error_col_name], row[err_key]))
+                catalog[key_map[err_key+'_fluxSigma']] = fluxErrFromABMagErr(get_column(error_col_name),
+                                                                             get_column(err_key))
 
-    def _set_extra(self, record, row, key_map):
-        """!Copy the extra column information to the record
-        @param[in,out] record  SourceCatalog record to modify
-        @param[in] row  dict like object containing the column values
-        @param[in] key_map  Map of catalog keys to use in filling the record
+    def _set_extra(self, catalog, arr, key_map):
+        """!Copy the extra column information to a catalog
+        @param[in,out] catalog  contiguous SourceCatalog to modify
+        @param[in] arr  numpy structured array containing the column values
+        @param[in] key_map  Map of catalog keys to use in filling the catalog
         """
         for extra_col in self.config.extra_col_names:
-            value = row[extra_col]
+            values = arr[extra_col]
+            if values.dtype.kind == 'b':
+                # bool columns become Flag fields, which are packed bits and cannot be set as a column
+                for record, value in zip(catalog, values):
+                    record.set(key_map[extra_col], bool(value))
+                continue
+            if values.dtype.kind not in ('U', 'S'):
+                catalog[key_map[extra_col]] = values
+                continue
+            # String fields cannot be set as a column, so set them one record at a time.
             # If data read from a text file contains string like entires,
             # numpy stores this as its own internal type, a numpy.str_
             # object. This seems to be a consequence of how numpy stores
-            # string like objects in fixed column arrays. This checks
-            # if any of the values to be added to the catalog are numpy
-            # string types, and if they are, casts them to a python string
-            # which is what the python c++ records expect
-            if isinstance(value, np.str_):
-                value = str(value)
-            record.set(key_map[extra_col], value)
-
-    def _fill_record(self, record, row, rec_num, key_map):
-        """!Fill a record to put in the persisted indexed catalogs
-
-        @param[in,out] record  afwTable.SourceRecord in a reference catalog to fill.
-        @param[in] row  A row from a numpy array constructed from the input catalogs.
-        @param[in] rec_num  Starting integer to increment for the unique id
-        @param[in] key_map  Map of catalog keys to use in filling the record
-        """
-        record.setCoord(self.compute_coord(row, self.config.ra_name, self.config.dec_name))
-        if self.config.id_name:
-            record.setId(row[self.config.id_name])
-        else:
-            rec_num += 1
-            record.setId(rec_num)
+            # string like objects in fixed column arrays. This casts the
+            # values to a python string which is what the python c++ records expect
+            for record, value in zip(catalog, values):
+                record.set(key_map[extra_col], str(value))
+
+    def _fill_catalog(self, catalog, arr, ids, key_map):
+        """!Fill records to put in the persisted indexed catalogs
+
+        The new records are filled a column at a time from the input arrays.
+
+        @param[in] catalog  afwTable.SourceCatalog in a reference catalog to append the new records to
+        @param[in] arr  A numpy structured array of rows constructed from the input catalogs
+        @param[in] ids  A numpy array of unique ids, one per row
+        @param[in] key_map  Map of catalog keys to use in filling the records
+        @return the filled catalog; a new contiguous catalog if the input catalog was empty
+        """
+        new_catalog = afwTable.SourceCatalog(catalog.schema)
+        new_catalog.reserve(len(arr))
+        new_catalog.resize(len(arr))
+        coord_key = afwTable.SourceTable.getCoordKey()
+        ra, dec = self.compute_coord_arrays(arr[self.config.ra_name], arr[self.config.dec_name])
+        new_catalog[coord_key.getRa()] = ra
+        new_catalog[coord_key.getDec()] = dec
+        if 'coord_x' in key_map:
+            cos_dec = np.cos(dec)
+            new_catalog[key_map['coord_x']] = cos_dec*np.cos(ra)
+            new_catalog[key_map['coord_y']] = cos_dec*np.sin(ra)
+            new_catalog[key_map['coord_z']] = np.sin(dec)
+        new_catalog[afwTable.SourceTable.getIdKey()] = np.asarray(ids, dtype=np.int64)
         # No parents
-        record.setParent(-1)
+        new_catalog[afwTable.SourceTable.getParentKey()] = np.full(len(arr), -1, dtype=np.int64)
 
-        self._set_flags(record, row, key_map)
-        self._set_mags(record, row, key_map)
-        self._set_extra(record, row, key_map)
-        return rec_num
+        self._set_flags(new_catalog, arr, key_map)
+        self._set_mags(new_catalog, arr, key_map)
+        self._set_extra(new_catalog, arr, key_map)
+        if 'htm_sub_id' in key_map:
+            if self._sub_htm is None:
+                self._sub_htm = esutil.htm.HTM(self.config.dataset_config.sub_index_depth)
+            new_catalog[key_map['htm_sub_id']] = self._sub_htm.lookup_id(
+                np.asarray(arr[self.config.ra_name], dtype=np.float64),
+                np.asarray(arr[self.config.dec_name], dtype=np.float64)).astype(np.int64)
+        if len(catalog) == 0:
+            return new_catalog
+        catalog.extend(new_catalog, deep=True)
+        return catalog
 
     def get_catalog(self, dataId, schema):
         """!Get a catalog from the butler or create it if it doesn't exist
@@ -327,4 +1383,14 @@ class IngestIndexedReferenceTask(pipeBase.CmdLineTask):
                 key_map[flag] = schema.addField(flag, 'Flag')
         for col in self.config.extra_col_names:
             key_map[col] = add_field(col)
+        if self.config.dataset_config.add_unit_vectors:
+            for axis in ('x', 'y', 'z'):
+                name = 'coord_' + axis
+                key_map[name] = schema.addField(name, type=np.float64,
+                                                doc='%s component of the ICRS unit vector' % (axis,))
+        if self.config.dataset_config.sub_index_depth > 0:
+            key_map['htm_sub_id'] = schema.addField(
+                'htm_sub_id', type=np.int64,
+                doc='HTM id at depth %d; the rows of each shard are sorted by it' %
+                    (self.config.dataset_config.sub_index_depth,))
         return schema, key_map
@@ -23,11 +23,24 @@
 
 __all__ = ["LoadIndexedReferenceObjectsConfig", "LoadIndexedReferenceObjectsTask"]
 
+import collections
+import concurrent.futures
+import functools
+import threading
+
+import esutil
+import numpy as np
+
 from lsst.meas.algorithms import getRefFluxField, LoadReferenceObjectsTask, LoadReferenceObjectsConfig
+import lsst.afw.geom as afwGeom
 import lsst.afw.table as afwTable
+from lsst.afw.image import fluxFromABMag
 import lsst.pex.config as pexConfig
 import lsst.pipe.base as pipeBase
+from .columnarShard import get_columnar_shard_path, read_columnar_shard
+from .htmIndexer import HtmIndexer, AdaptiveHtmIndexer
 from .indexerRegistry import IndexerRegistry
+from .shardManifest import get_shard_manifest_path, read_shard_manifest
 
 
 class LoadIndexedReferenceObjectsConfig(LoadReferenceObjectsConfig):
@@ -36,6 +49,101 @@ class LoadIndexedReferenceObjectsConfig(LoadReferenceObjectsConfig):
         default='cal_ref_cat',
         doc='Name of the ingested reference dataset'
     )
+    shard_cache_bytes = pexConfig.RangeField(
+        dtype=int,
+        default=0,
+        min=0,
+        doc='Maximum number of bytes of record data in shards to keep in memory between loads, '
+            'so that overlapping regions are read once.  0 disables the cache.'
+    )
+    cover_cache_quantum = pexConfig.RangeField(
+        dtype=float,
+        default=0.0,
+        min=0.0,
+        doc='Quantization (arcsec) of the centers and radii of the circles whose pixel covers are '
+            'remembered between loads, if the indexer supports it; larger values make more loads '
+            'reuse a cover at the cost of a few extra boundary pixels.  0 disables the cache.'
+    )
+    cover_cache_size = pexConfig.RangeField(
+        dtype=int,
+        default=1000,
+        min=1,
+        doc='Maximum number of pixel covers to remember, if cover_cache_quantum is nonzero.'
+    )
+    prefetch_threads = pexConfig.RangeField(
+        dtype=int,
+        default=2,
+        min=1,
+        doc='Number of background threads that read the shards requested by prefetch.  '
+            'Access to the butler is serialized, so FITS shards are read one at a time.'
+    )
+    load_columns = pexConfig.ListField(
+        dtype=str,
+        default=[],
+        doc='Names of the fields to read from columnar shards, in addition to id and coord; '
+            'the other fields of the loaded objects are left unset (NaN or 0).  '
+            'If empty, all fields are read.  Ignored for shards in FITS format.  Every name must be '
+            'that of a field (not an alias) of the reference catalog.'
+    )
+
+
+class _ShardCache:
+    """!Least recently used cache of reference catalog shards, bounded by size in bytes
+
+    The cache may be used from several threads.
+    """
+
+    def __init__(self, max_bytes):
+        """!Construct a _ShardCache
+
+        @param[in] max_bytes  Maximum total size of the cached shards
+        """
+        self.max_bytes = max_bytes
+        self._shards = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.n_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """!Return a cached shard and mark it as most recently used
+
+        @param[in] key  Key of the shard
+        @return the shard, or None if it is not cached
+        """
+        with self._lock:
+            if key not in self._shards:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._shards.move_to_end(key)
+            return self._shards[key][0]
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._shards
+
+    def put(self, key, shard, n_bytes):
+        """!Add a shard, evicting the least recently used shards to make room
+
+        A shard larger than the cache is not added.
+
+        @param[in] key  Key of the shard
+        @param[in] shard  The shard
+        @param[in] n_bytes  Size of the shard
+        """
+        if n_bytes > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._shards:
+                self.n_bytes -= self._shards.pop(key)[1]
+            while self._shards and self.n_bytes + n_bytes > self.max_bytes:
+                _, (_, evicted_bytes) = self._shards.popitem(last=False)
+                self.n_bytes -= evicted_bytes
+                self.evictions += 1
+            self._shards[key] = (shard, n_bytes)
+            self.n_bytes += n_bytes
 
 
 class LoadIndexedReferenceObjectsTask(LoadReferenceObjectsTask):
@@ -46,19 +154,138 @@ class LoadIndexedReferenceObjectsTask(LoadReferenceObjectsTask):
         LoadReferenceObjectsTask.__init__(self, *args, **kwargs)
         dataset_config = butler.get("ref_cat_config", name=self.config.ref_dataset_name, immediate=True)
         self.indexer = IndexerRegistry[dataset_config.indexer.name](dataset_config.indexer.active)
+        if self.config.cover_cache_quantum > 0 and hasattr(self.indexer, 'enable_cover_cache'):
+            self.indexer.enable_cover_cache(self.config.cover_cache_quantum*afwGeom.arcseconds,
+                                            self.config.cover_cache_size)
         # This needs to come from the loader config, not the dataset_config since directory aliases can
         # change the path where the shards are found.
         self.ref_dataset_name = self.config.ref_dataset_name
         self.butler = butler
+        # Did the ingest record a manifest of the populated shards?  It is read by
+        # _get_shard_rows when first needed.
+        self.has_manifest = dataset_config.has_manifest
+        self._shard_rows = None
+        self.shard_format = dataset_config.shard_format
+        # Flux field by which the rows of each shard are sorted, brightest first, or None
+        self.sort_flux_field = None
+        if dataset_config.sort_flux_column:
+            self.sort_flux_field = dataset_config.sort_flux_column + "_flux"
+        # Does each shard have the unit vectors of its rows?
+        self.has_unit_vectors = dataset_config.add_unit_vectors
+        # HTM of the cells by which the rows of each shard are sorted, or None
+        self.sub_htm = None
+        self.sub_index_depth = dataset_config.sub_index_depth
+        if dataset_config.sub_index_depth > 0:
+            self.sub_htm = esutil.htm.HTM(dataset_config.sub_index_depth)
+        self._master_schema = None
+        self.shard_cache = None
+        if self.config.shard_cache_bytes > 0:
+            self.shard_cache = _ShardCache(self.config.shard_cache_bytes)
+        # Background reads started by prefetch that have not finished, keyed by pixel id
+        self._prefetches = {}
+        # reentrant, because a callback added to a finished future runs at once in the adding thread
+        self._prefetch_lock = threading.RLock()
+        self._prefetch_executor = None
+        # Number of shards a load found being read by prefetch
+        self.prefetch_hits = 0
+        # The Gen2 butler is not known to be thread-safe, so the prefetch threads and the
+        # loads take turns using it
+        self._butler_lock = threading.Lock()
+        if self.config.load_columns:
+            field_names = self._get_master_schema().getNames()
+            unknown = [name for name in self.config.load_columns if name not in field_names]
+            if unknown:
+                raise ValueError("config.load_columns lists fields %s that are not in reference catalog %s; "
+                                 "its fields are %s" % (unknown, self.ref_dataset_name, sorted(field_names)))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """!Stop the prefetch threads, after waiting for the reads they have started
+
+        The loader may still be used; a later prefetch starts new threads.
+        """
+        with self._prefetch_lock:
+            executor = self._prefetch_executor
+            self._prefetch_executor = None
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+    def prefetch(self, ctrCoord, radius):
+        """!Start reading the shards that overlap a circular sky region into the shard cache
+
+        The shards are read by a pool of config.prefetch_threads background threads, so that
+        a later load of the region only has to trim them.  A load that needs a shard that is
+        still being read waits for it.  Shards that are already cached or being read are not
+        read again.
+
+        The threads overlap reading with other work only while the main thread does not hold
+        the Python global interpreter lock, e.g. while it waits for I/O or runs C++ code that
+        releases it.  Only one thread at a time uses the butler, so FITS shards are read one at
+        a time; columnar shard data is read outside the butler.  Call close, or use the loader
+        as a context manager, to stop the threads.
+
+        @param[in] ctrCoord  ICRS center of the region (an lsst.afw.geom.SpherePoint)
+        @param[in] radius  radius of the region (an lsst.afw.geom.Angle)
+        @return a list of concurrent.futures.Future, one per shard being read, whose results
+            are the shards
+        @throw RuntimeError if config.shard_cache_bytes is 0
+        """
+        if self.shard_cache is None:
+            raise RuntimeError("prefetch requires a shard cache; set config.shard_cache_bytes")
+        # read the master schema in this thread, so that the readers do not race to read it
+        self._get_master_schema()
+        shard_rows = self._get_shard_rows()
+        id_list, _ = self.indexer.get_pixel_ids(ctrCoord, radius)
+        futures = []
+        with self._prefetch_lock:
+            if self._prefetch_executor is None:
+                self._prefetch_executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=self.config.prefetch_threads)
+            for pixel_id in id_list:
+                if shard_rows is not None and shard_rows.get(pixel_id, 0) == 0:
+                    continue
+                if pixel_id in self._prefetches or (self.ref_dataset_name, pixel_id) in self.shard_cache:
+                    continue
+                future = self._prefetch_executor.submit(self._prefetch_shard, pixel_id)
+                self._prefetches[pixel_id] = future
+                future.add_done_callback(functools.partial(self._end_prefetch, pixel_id))
+                futures.append(future)
+        return futures
+
+    def _prefetch_shard(self, pixel_id):
+        """!Read a shard into the shard cache; run by the prefetch threads
+
+        @param[in] pixel_id  Integer pixel id of the shard
+        @return the shard as a SourceCatalog, or None if it does not exist
+        """
+        shard = self._read_shard(pixel_id)
+        if shard is not None:
+            self.shard_cache.put((self.ref_dataset_name, pixel_id), shard,
+                                 len(shard)*shard.schema.getRecordSize())
+        return shard
+
+    def _end_prefetch(self, pixel_id, future):
+        """!Forget a finished prefetch; its shard is in the shard cache, unless since evicted"""
+        with self._prefetch_lock:
+            if self._prefetches.get(pixel_id) is future:
+                del self._prefetches[pixel_id]
 
     @pipeBase.timeMethod
-    def loadSkyCircle(self, ctrCoord, radius, filterName=None):
+    def loadSkyCircle(self, ctrCoord, radius, filterName=None, magLimit=None, nBrightest=None):
         """!Load reference objects that overlap a circular sky region
 
         @param[in] ctrCoord  center of search region (an lsst.afw.geom.Coord)
         @param[in] radius  radius of search region (an lsst.afw.geom.Angle)
         @param[in] filterName  name of filter, or None for the default filter;
-            used for flux values in case we have flux limits (which are not yet implemented)
+            used for flux values and the flux limits
+        @param[in] magLimit  faintest AB magnitude to load in the filter, or None for no limit
+        @param[in] nBrightest  maximum number of objects to load, or None for no limit;
+            if there are more objects in the circle the brightest in the filter are kept
 
         @return an lsst.pipe.base.Struct containing:
         - refCat a catalog of reference objects with the
@@ -67,70 +294,355 @@ class LoadIndexedReferenceObjectsTask(LoadReferenceObjectsTask):
             hasCentroid is False for all objects.
         - fluxField = name of flux field for specified filterName.  None if refCat is None.
         """
-        id_list, boundary_mask = self.indexer.get_pixel_ids(ctrCoord, radius)
-        shards = self.get_shards(id_list)
-        refCat = self.butler.get('ref_cat',
-                                 dataId=self.indexer.make_data_id('master_schema', self.ref_dataset_name),
-                                 immediate=True)
-        self._addFluxAliases(refCat.schema)
-        fluxField = getRefFluxField(schema=refCat.schema, filterName=filterName)
-        for shard, is_on_boundary in zip(shards, boundary_mask):
-            if shard is None:
-                continue
-            if is_on_boundary:
-                refCat.extend(self._trim_to_circle(shard, ctrCoord, radius))
-            else:
-                refCat.extend(shard)
+        return self.loadSkyCircles([(ctrCoord, radius)], filterName, magLimit, nBrightest)[0]
+
+    @pipeBase.timeMethod
+    def loadSkyCircles(self, circles, filterName=None, magLimit=None, nBrightest=None):
+        """!Load reference objects that overlap each of several circular sky regions
+
+        The shards touching any of the circles are read once, and the records of each
+        shard are copied to the catalog of every circle they fall in.  If the shards are
+        columnar and there is no shard cache, the row groups of a shard on the boundary of
+        every circle it touches are read only if they may overlap one of those circles.
+
+        If the ingest sorted the shards by the flux of the filter, only the bright prefix of
+        each shard is trimmed and copied when there is a flux limit.  If it sorted the shards
+        by HTM cell, only the rows of the cells that overlap a circle are trimmed; the cover of
+        each circle by cells is computed and sorted once, and for HTM shards only the part of
+        it within each shard is searched.
+
+        @param[in] circles  list of (ctrCoord, radius) pairs: ICRS center of search region
+            (an lsst.afw.geom.SpherePoint) and radius of search region (an lsst.afw.geom.Angle)
+        @param[in] filterName  name of filter, or None for the default filter;
+            used for flux values and the flux limits
+        @param[in] magLimit  faintest AB magnitude to load in the filter, or None for no limit
+        @param[in] nBrightest  maximum number of objects to load per circle, or None for no limit
 
+        @return a list of lsst.pipe.base.Struct, one per circle, as returned by loadSkyCircle
+        """
+        schema = self._get_master_schema()
+        fluxField = getRefFluxField(schema=schema, filterName=filterName)
+        # the name of the flux field fluxField is an alias of, if it is one
+        flux_field_name = schema.find(fluxField).field.getName()
+        min_flux = None if magLimit is None else fluxFromABMag(magLimit)
+        is_sorted = flux_field_name == self.sort_flux_field
+
+        covers = []
+        for ctrCoord, radius in circles:
+            id_list, boundary_mask = self.indexer.get_pixel_ids(ctrCoord, radius)
+            covers.append((id_list, list(boundary_mask)))
+        pixel_ids = list(collections.OrderedDict.fromkeys(
+            pixel_id for id_list, _ in covers for pixel_id in id_list))
+        circle_lists = None
+        min_fluxes = None
+        if self.shard_format == 'columnar' and self.shard_cache is None:
+            # the circles each pixel is on the boundary of, or None if it is inside any circle
+            circle_lists = {}
+            for circle, (id_list, boundary_mask) in zip(circles, covers):
+                for pixel_id, is_on_boundary in zip(id_list, boundary_mask):
+                    if not is_on_boundary:
+                        circle_lists[pixel_id] = None
+                    elif circle_lists.setdefault(pixel_id, []) is not None:
+                        circle_lists[pixel_id].append(circle)
+            circle_lists = [circle_lists[pixel_id] for pixel_id in pixel_ids]
+            if min_flux is not None:
+                min_fluxes = {flux_field_name: min_flux}
+        shards = dict(zip(pixel_ids, self.get_shards(pixel_ids, circle_lists, min_fluxes)))
+        if is_sorted and min_flux is not None:
+            shards = {pixel_id: self._get_bright_prefix(shard, flux_field_name, min_flux)
+                      for pixel_id, shard in shards.items()}
+
+        results = []
+        for (ctrCoord, radius), (id_list, boundary_mask) in zip(circles, covers):
+            pieces = []
+            sub_cover = None
+            for pixel_id, is_on_boundary in zip(id_list, boundary_mask):
+                shard = shards[pixel_id]
+                if shard is None:
+                    continue
+                if is_on_boundary:
+                    if self.sub_htm is not None:
+                        if sub_cover is None:
+                            sub_cover = np.sort(self.sub_htm.intersect(
+                                ctrCoord.getLongitude().asDegrees(), ctrCoord.getLatitude().asDegrees(),
+                                radius.asDegrees(), inclusive=True))
+                        shard = self._select_sub_cells(shard, self._get_shard_cells(pixel_id, sub_cover))
+                    shard = self._trim_to_circle(shard, ctrCoord, radius)
+                if is_sorted and nBrightest is not None:
+                    # trimming keeps the order, so the brightest rows are still first
+                    shard = shard[:nBrightest]
+                pieces.append(shard)
+            refCat = self._make_ref_cat(schema, pieces)
+            results.append(pipeBase.Struct(
+                refCat=self._applyFluxLimits(refCat, fluxField, magLimit, nBrightest),
+                fluxField=fluxField,
+            ))
+        return results
+
+    def _get_master_schema(self):
+        """!Get the schema of the reference catalog, with flux aliases added
+
+        The master schema is read once and then reused.
+
+        @return the schema (an lsst.afw.table.Schema)
+        """
+        if self._master_schema is None:
+            with self._butler_lock:
+                refCat = self.butler.get('ref_cat',
+                                         dataId=self.indexer.make_data_id('master_schema',
+                                                                          self.ref_dataset_name),
+                                         immediate=True)
+            self._addFluxAliases(refCat.schema)
+            self._master_schema = refCat.schema
+        return self._master_schema
+
+    def _make_ref_cat(self, schema, pieces):
+        """!Copy catalogs of reference objects into one catalog with centroid fields
+
+        @param[in] schema  schema of the reference catalog, from _get_master_schema
+        @param[in] pieces  list of catalogs with that schema
+        @return a contiguous SimpleCatalog containing all the records of the pieces, with
+            fields centroid_x, centroid_y and hasCentroid added
+        """
         # add and initialize centroid and hasCentroid fields (these are added
         # after loading to avoid wasting space in the saved catalogs)
         # the new fields are automatically initialized to (nan, nan) and False
         # so no need to set them explicitly
-        mapper = afwTable.SchemaMapper(refCat.schema, True)
-        mapper.addMinimalSchema(refCat.schema, True)
+        mapper = afwTable.SchemaMapper(schema, True)
+        mapper.addMinimalSchema(schema, True)
         mapper.editOutputSchema().addField("centroid_x", type=float)
         mapper.editOutputSchema().addField("centroid_y", type=float)
         mapper.editOutputSchema().addField("hasCentroid", type="Flag")
+        # copy each record once, directly into a catalog allocated for all of them
         expandedCat = afwTable.SimpleCatalog(mapper.getOutputSchema())
-        expandedCat.extend(refCat, mapper=mapper)
-        del refCat  # avoid accidentally returning the unexpanded reference catalog
+        expandedCat.reserve(sum(len(piece) for piece in pieces))
+        for piece in pieces:
+            expandedCat.extend(piece, mapper=mapper)
 
         # make sure catalog is contiguous
         if not expandedCat.isContiguous():
             expandedCat = expandedCat.copy(deep=True)
+        return expandedCat
 
-        # return reference catalog
-        return pipeBase.Struct(
-            refCat=expandedCat,
-            fluxField=fluxField,
-        )
-
-    def get_shards(self, id_list):
+    def get_shards(self, id_list, circle_lists=None, min_fluxes=None):
         """!Get all shards that touch a circular aperture
 
+        If the ingest recorded a manifest of the populated shards it is used to skip
+        empty pixels; otherwise the butler is asked whether each shard exists.
+        If config.shard_cache_bytes is nonzero, shards are kept in a least recently used
+        cache, and its hit, miss and eviction counts are put in the task metadata.
+        Shards still being read by prefetch are waited for rather than read again, and counted
+        in the task metadata as shardPrefetchHits rather than as cache hits or misses.
+
         @param[in] id_list  A list of integer pixel ids
-        @param[out] a list of SourceCatalogs for each pixel, None if not data exists
+        @param[in] circle_lists  A list with one entry per pixel id of a list of (ctrCoord, radius)
+            circles or None, or None; for columnar shards, only the row groups that may overlap
+            the circles are read
+        @param[in] min_fluxes  dict of flux field name: minimum flux, or None; for columnar
+            shards, only the row groups with a row as bright as every minimum flux are read
+        @param[out] a list of SourceCatalogs for each pixel, None if not data exists;
+            partially read shards are not cached
         """
         shards = []
-        for pixel_id in id_list:
-            if self.butler.datasetExists('ref_cat',
-                                         dataId=self.indexer.make_data_id(pixel_id, self.ref_dataset_name)):
-                shards.append(self.butler.get('ref_cat',
-                                              dataId=self.indexer.make_data_id(pixel_id,
-                                                                               self.ref_dataset_name),
-                                              immediate=True))
+        shard_rows = self._get_shard_rows()
+        if circle_lists is None:
+            circle_lists = [None]*len(id_list)
+        for pixel_id, circles in zip(id_list, circle_lists):
+            if shard_rows is not None and shard_rows.get(pixel_id, 0) == 0:
+                shards.append(None)
+                continue
+            if circles is not None or min_fluxes:
+                shards.append(self._read_shard(pixel_id, circles, min_fluxes))
+                continue
+            if self.shard_cache is not None:
+                with self._prefetch_lock:
+                    future = self._prefetches.get(pixel_id)
+                if future is not None:
+                    # a prefetch is reading the shard into the cache
+                    shards.append(future.result())
+                    self.prefetch_hits += 1
+                    continue
+                shard = self.shard_cache.get((self.ref_dataset_name, pixel_id))
+                if shard is not None:
+                    shards.append(shard)
+                    continue
+            shard = self._read_shard(pixel_id)
+            if shard is not None and self.shard_cache is not None:
+                n_bytes = len(shard)*shard.schema.getRecordSize()
+                self.shard_cache.put((self.ref_dataset_name, pixel_id), shard, n_bytes)
+            shards.append(shard)
+        if self.shard_cache is not None:
+            self.metadata.set("shardCacheHits", self.shard_cache.hits)
+            self.metadata.set("shardCacheMisses", self.shard_cache.misses)
+            self.metadata.set("shardCacheEvictions", self.shard_cache.evictions)
+            self.metadata.set("shardCacheBytes", self.shard_cache.n_bytes)
+            self.metadata.set("shardPrefetchHits", self.prefetch_hits)
         return shards
 
+    def _get_shard_rows(self):
+        """!Return the number of rows in each populated shard, reading the manifest if needed
+
+        @return a dict of pixel id: number of rows, or None if the ingest did not record a manifest
+        """
+        if not self.has_manifest:
+            return None
+        if self._shard_rows is None:
+            with self._butler_lock:
+                config_path = self.butler.getUri("ref_cat_config", name=self.ref_dataset_name)
+            self._shard_rows, _ = read_shard_manifest(get_shard_manifest_path(config_path))
+        return self._shard_rows
+
+    def _read_shard(self, pixel_id, circles=None, min_fluxes=None):
+        """!Read a shard
+
+        The shard is assumed to exist if the ingest recorded a manifest.
+
+        @param[in] pixel_id  Integer pixel id of the shard
+        @param[in] circles  list of (ctrCoord, radius) circles, or None; for columnar shards,
+            only the row groups that may overlap one of the circles are read
+        @param[in] min_fluxes  dict of flux field name: minimum flux, or None; for columnar
+            shards, only the row groups with a row as bright as every minimum flux are read
+        @return the shard as a SourceCatalog, or None if it does not exist
+        """
+        dataId = self.indexer.make_data_id(pixel_id, self.ref_dataset_name)
+        with self._butler_lock:
+            if not self.has_manifest and not self.butler.datasetExists('ref_cat', dataId=dataId):
+                return None
+            if self.shard_format != 'columnar':
+                return self.butler.get('ref_cat', dataId=dataId, immediate=True)
+            path = get_columnar_shard_path(self.butler.getUri('ref_cat', dataId=dataId))
+        columns = list(self.config.load_columns) or None
+        if columns is not None:
+            # the loader itself needs these fields
+            if self.has_unit_vectors:
+                columns += ["coord_x", "coord_y", "coord_z"]
+            if self.sub_htm is not None:
+                columns.append("htm_sub_id")
+            if self.sort_flux_field is not None:
+                columns.append(self.sort_flux_field)
+        return read_columnar_shard(path, self._get_master_schema(), columns=columns, circles=circles,
+                                   min_fluxes=min_fluxes)
+
+    @staticmethod
+    def _get_bright_prefix(shard, flux_field, min_flux):
+        """!Return the rows of a shard sorted by flux, brightest first, that are bright enough
+
+        @param[in] shard  SourceCatalog sorted by flux_field, brightest first with NaN last, or None
+        @param[in] flux_field  name of the flux field
+        @param[in] min_flux  minimum flux
+        @return the leading rows of the shard with a flux of at least min_flux, or None if shard is None
+        """
+        if shard is None:
+            return None
+        if not shard.isContiguous():
+            shard = shard.copy(deep=True)
+        return shard[:int(np.searchsorted(-shard[flux_field], -min_flux, side='right'))]
+
+    def _get_shard_cells(self, pixel_id, cell_ids):
+        """!Return the cells of a sorted cover at the depth of htm_sub_id that may hold rows of a shard
+
+        If the shards are HTM trixels, the cells within a trixel are a contiguous range of ids,
+        [pixel_id << 2k, (pixel_id + 1) << 2k) for a trixel k levels shallower than the cells,
+        so they are found by bisection of the cover.  Otherwise all the cells are returned.
+
+        @param[in] pixel_id  Integer pixel id of the shard
+        @param[in] cell_ids  sorted numpy array of HTM ids at the depth of htm_sub_id
+        @return a sorted numpy array of the ids of the cells that may hold rows of the shard
+        """
+        if not isinstance(self.indexer, (HtmIndexer, AdaptiveHtmIndexer)):
+            return cell_ids
+        # an HTM id at depth d has 2d + 4 bits
+        shift = 2*self.sub_index_depth + 4 - int(pixel_id).bit_length()
+        if shift >= 0:
+            first, last = int(pixel_id) << shift, (int(pixel_id) + 1) << shift
+        else:
+            # the shard lies within a single cell
+            first = int(pixel_id) >> -shift
+            last = first + 1
+        start, stop = np.searchsorted(cell_ids, [first, last], side='left')
+        return cell_ids[start:stop]
+
+    @staticmethod
+    def _select_sub_cells(shard, cell_ids):
+        """!Select the rows of a shard sorted by HTM cell that are in a set of cells
+
+        @param[in] shard  SourceCatalog sorted by field htm_sub_id
+        @param[in] cell_ids  sorted numpy array of HTM ids at the depth of htm_sub_id
+        @return a SourceCatalog of the rows of the shard in the cells, in order
+        """
+        if not shard.isContiguous():
+            shard = shard.copy(deep=True)
+        sub_ids = shard["htm_sub_id"]
+        starts = np.searchsorted(sub_ids, cell_ids, side='left')
+        stops = np.searchsorted(sub_ids, cell_ids, side='right')
+        # mark the rows of each range [start, stop) by adding 1 at start and -1 at stop
+        counts = np.zeros(len(shard) + 1, dtype=np.int64)
+        np.add.at(counts, starts, 1)
+        np.add.at(counts, stops, -1)
+        return shard[np.cumsum(counts[:-1]) > 0]
+
     def _trim_to_circle(self, catalog_shard, ctrCoord, radius):
         """!Trim a catalog to a circular aperture.
 
+        If the shards have unit vector fields, the trim compares the chord between each record
+        and the center to the chord of the radius.  Otherwise the separations are computed from
+        the coordinate columns with the same haversine formula as lsst.afw.geom.SpherePoint.separation.
+
         @param[in] catalog_shard  SourceCatalog to be trimmed
         @param[in] ctrCoord  ICRS coord to compare each record to (an lsst.afw.geom.SpherePoint)
         @param[in] radius  afwGeom.Angle indicating maximume separation
         @param[out] a SourceCatalog constructed from records that fall in the circular aperture
         """
-        temp_cat = type(catalog_shard)(catalog_shard.schema)
-        for record in catalog_shard:
-            if record.getCoord().separation(ctrCoord) < radius:
-                temp_cat.append(record)
-        return temp_cat
+        if not catalog_shard.isContiguous():
+            catalog_shard = catalog_shard.copy(deep=True)
+        if self.has_unit_vectors:
+            return catalog_shard[_chord_squared(catalog_shard["coord_x"], catalog_shard["coord_y"],
+                                                catalog_shard["coord_z"], ctrCoord) <
+                                 _chord_squared_of_angle(radius.asRadians())]
+        separation = _separation(catalog_shard["coord_ra"], catalog_shard["coord_dec"], ctrCoord)
+        return catalog_shard[separation < radius.asRadians()]
+
+
+def _chord_squared(x, y, z, coord):
+    """!Compute the squared chord lengths between arrays of unit vectors and a coord
+
+    @param[in] x, y, z  numpy arrays of the components of ICRS unit vectors
+    @param[in] coord  ICRS coord (an lsst.afw.geom.SpherePoint)
+    @return a numpy array of squared chord lengths
+    """
+    ctr_ra = coord.getLongitude().asRadians()
+    ctr_dec = coord.getLatitude().asRadians()
+    dx = x - np.cos(ctr_dec)*np.cos(ctr_ra)
+    dy = y - np.cos(ctr_dec)*np.sin(ctr_ra)
+    dz = z - np.sin(ctr_dec)
+    return dx*dx + dy*dy + dz*dz
+
+
+def _chord_squared_of_angle(angle):
+    """!Return the squared chord length of an angular separation in radians
+
+    Separations of pi or more give a value larger than that of any pair of points.
+    """
+    if angle >= np.pi:
+        return np.inf
+    half_chord = np.sin(0.5*angle)
+    return 4.0*half_chord*half_chord
+
+
+def _separation(ra, dec, coord):
+    """!Compute the angular separations between arrays of positions and a coord
+
+    This evaluates the haversine formula in the same way as
+    lsst.afw.geom.SpherePoint.separation, with the positions as the first point.
+
+    @param[in] ra  numpy array of ICRS RA, in radians
+    @param[in] dec  numpy array of ICRS Dec, in radians
+    @param[in] coord  ICRS coord (an lsst.afw.geom.SpherePoint)
+    @return a numpy array of separations, in radians
+    """
+    ctr_ra = coord.getLongitude().asRadians()
+    ctr_dec = coord.getLatitude().asRadians()
+    sin_dec = np.sin((dec - ctr_dec)/2.0)
+    sin_ra = np.sin((ra - ctr_ra)/2.0)
+    hav = sin_dec*sin_dec + np.cos(dec)*np.cos(ctr_dec)*(sin_ra*sin_ra)
+    return 2.0*np.arcsin(np.sqrt(np.clip(hav, 0.0, 1.0)))
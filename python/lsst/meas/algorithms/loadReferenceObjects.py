@@ -29,6 +29,7 @@ import numpy
 
 import lsst.afw.geom as afwGeom
 import lsst.afw.table as afwTable
+from lsst.afw.image import fluxFromABMag
 import lsst.pex.config as pexConfig
 import lsst.pipe.base as pipeBase
 from lsst.daf.base import PropertyList
@@ -182,7 +183,7 @@ class LoadReferenceObjectsTask(pipeBase.Task, metaclass=abc.ABCMeta):
         self.butler = butler
 
     @pipeBase.timeMethod
-    def loadPixelBox(self, bbox, wcs, filterName=None, calib=None):
+    def loadPixelBox(self, bbox, wcs, filterName=None, calib=None, magLimit=None, nBrightest=None):
         """!Load reference objects that overlap a pixel-based rectangular region
 
         The search algorithm works by searching in a region in sky coordinates whose center is the center
@@ -193,6 +194,9 @@ class LoadReferenceObjectsTask(pipeBase.Task, metaclass=abc.ABCMeta):
         @param[in] wcs  WCS (an lsst.afw.geom.SkyWcs)
         @param[in] filterName  name of camera filter, or None or blank for the default filter
         @param[in] calib  calibration, or None if unknown
+        @param[in] magLimit  faintest AB magnitude to load in the filter, or None for no limit
+        @param[in] nBrightest  maximum number of objects to load, or None for no limit;
+            if there are more objects in the bbox the brightest in the filter are kept
 
         @return an lsst.pipe.base.Struct containing:
         - refCat a catalog of reference objects with the
@@ -201,35 +205,83 @@ class LoadReferenceObjectsTask(pipeBase.Task, metaclass=abc.ABCMeta):
             hasCentroid is False for all objects.
         - fluxField = name of flux field for specified filterName
         """
-        circle = self._calculateCircle(bbox, wcs)
+        return self.loadPixelBoxes([(bbox, wcs)], filterName=filterName, calib=calib,
+                                   magLimit=magLimit, nBrightest=nBrightest)[0]
 
-        # find objects in circle
-        self.log.info("Loading reference objects using center %s and radius %s deg" %
-                      (circle.coord, circle.radius.asDegrees()))
-        loadRes = self.loadSkyCircle(circle.coord, circle.radius, filterName)
-        refCat = loadRes.refCat
-        numFound = len(refCat)
+    @pipeBase.timeMethod
+    def loadPixelBoxes(self, regions, filterName=None, calib=None, magLimit=None, nBrightest=None):
+        """!Load reference objects that overlap each of several pixel-based rectangular regions
 
-        # trim objects outside bbox
-        refCat = self._trimToBBox(refCat=refCat, bbox=circle.bbox, wcs=wcs)
-        numTrimmed = numFound - len(refCat)
-        self.log.debug("trimmed %d out-of-bbox objects, leaving %d", numTrimmed, len(refCat))
-        self.log.info("Loaded %d reference objects", len(refCat))
+        This gives the same results as calling loadPixelBox for each region, but the circles
+        enclosing all of the regions are loaded together by loadSkyCircles, which subclasses
+        may implement more efficiently than one loadSkyCircle per region.
 
-        # make sure catalog is contiguous
-        if not refCat.isContiguous():
-            loadRes.refCat = refCat.copy(deep=True)
+        @param[in] regions  list of (bbox, wcs) pairs: bounding box for pixels
+            (an lsst.afw.geom.Box2I or Box2D) and WCS (an lsst.afw.geom.SkyWcs)
+        @param[in] filterName  name of camera filter, or None or blank for the default filter
+        @param[in] calib  calibration, or None if unknown
+        @param[in] magLimit  faintest AB magnitude to load in the filter, or None for no limit
+        @param[in] nBrightest  maximum number of objects to load per region, or None for no limit
+
+        @return a list of lsst.pipe.base.Struct, one per region, as returned by loadPixelBox
+        """
+        circles = [self._calculateCircle(bbox, wcs) for bbox, wcs in regions]
+
+        # find objects in circles
+        for circle in circles:
+            self.log.info("Loading reference objects using center %s and radius %s deg" %
+                          (circle.coord, circle.radius.asDegrees()))
+        # the brightest objects in a circle may not be in its bbox, so nBrightest is applied after trimming
+        loadResList = self.loadSkyCircles([(circle.coord, circle.radius) for circle in circles], filterName,
+                                          magLimit=magLimit)
+
+        for circle, (bbox, wcs), loadRes in zip(circles, regions, loadResList):
+            refCat = loadRes.refCat
+            numFound = len(refCat)
+
+            # trim objects outside bbox
+            refCat = self._trimToBBox(refCat=refCat, bbox=circle.bbox, wcs=wcs)
+            numTrimmed = numFound - len(refCat)
+            self.log.debug("trimmed %d out-of-bbox objects, leaving %d", numTrimmed, len(refCat))
+            refCat = self._applyFluxLimits(refCat, loadRes.fluxField, nBrightest=nBrightest)
+            self.log.info("Loaded %d reference objects", len(refCat))
+
+            loadRes.refCat = refCat
+        return loadResList
+
+    def loadSkyCircles(self, circles, filterName=None, magLimit=None, nBrightest=None):
+        """!Load reference objects that overlap each of several circular sky regions
+
+        This implementation calls loadSkyCircle for each circle and then applies the flux
+        limits; subclasses may override it to share work between the circles.
+
+        @param[in] circles  list of (ctrCoord, radius) pairs: ICRS center of search region
+            (an lsst.afw.geom.SpherePoint) and radius of search region (an lsst.afw.geom.Angle)
+        @param[in] filterName  name of filter, or None for the default filter;
+            used for flux values and the flux limits
+        @param[in] magLimit  faintest AB magnitude to load in the filter, or None for no limit
+        @param[in] nBrightest  maximum number of objects to load per circle, or None for no limit
 
-        return loadRes
+        @return a list of lsst.pipe.base.Struct, one per circle, as returned by loadSkyCircle
+        """
+        loadResList = [self.loadSkyCircle(ctrCoord, radius, filterName) for ctrCoord, radius in circles]
+        if magLimit is not None or nBrightest is not None:
+            for loadRes in loadResList:
+                loadRes.refCat = self._applyFluxLimits(loadRes.refCat, loadRes.fluxField, magLimit,
+                                                       nBrightest)
+        return loadResList
 
     @abc.abstractmethod
-    def loadSkyCircle(self, ctrCoord, radius, filterName=None):
+    def loadSkyCircle(self, ctrCoord, radius, filterName=None, magLimit=None, nBrightest=None):
         """!Load reference objects that overlap a circular sky region
 
         @param[in] ctrCoord  ICRS center of search region (an lsst.afw.geom.SpherePoint)
         @param[in] radius  radius of search region (an lsst.afw.geom.Angle)
         @param[in] filterName  name of filter, or None for the default filter;
-            used for flux values in case we have flux limits (which are not yet implemented)
+            used for flux values and the flux limits
+        @param[in] magLimit  faintest AB magnitude to load in the filter, or None for no limit
+        @param[in] nBrightest  maximum number of objects to load, or None for no limit;
+            if there are more objects in the circle the brightest in the filter are kept
 
         @return an lsst.pipe.base.Struct containing:
         - refCat a catalog of reference objects with the
@@ -240,6 +292,34 @@ class LoadReferenceObjectsTask(pipeBase.Task, metaclass=abc.ABCMeta):
         """
         return
 
+    @staticmethod
+    def _applyFluxLimits(refCat, fluxField, magLimit=None, nBrightest=None):
+        """!Remove objects fainter than a magnitude limit, and all but the brightest objects
+
+        @param[in] refCat  a catalog of reference objects
+        @param[in] fluxField  name of the flux field to apply the limits to
+        @param[in] magLimit  faintest AB magnitude to keep, or None for no limit
+        @param[in] nBrightest  maximum number of objects to keep, or None for no limit;
+            objects with a NaN flux are kept last
+
+        @return refCat if there are no limits, else a contiguous catalog of the objects
+            within the limits, in their original order
+        """
+        if magLimit is None and nBrightest is None:
+            return refCat
+        if not refCat.isContiguous():
+            refCat = refCat.copy(deep=True)
+        flux = refCat[fluxField]
+        keep = numpy.ones(len(refCat), dtype=bool)
+        if magLimit is not None:
+            keep &= flux >= fluxFromABMag(magLimit)
+        if nBrightest is not None and numpy.sum(keep) > nBrightest:
+            candidates = numpy.flatnonzero(keep)
+            brightest = candidates[numpy.argsort(-flux[candidates], kind="mergesort")[:nBrightest]]
+            keep = numpy.zeros(len(refCat), dtype=bool)
+            keep[brightest] = True
+        return refCat[keep].copy(deep=True)
+
     @staticmethod
     def _trimToBBox(refCat, bbox, wcs):
         """!Remove objects outside a given pixel-based bbox and set centroid and hasCentroid fields
@@ -251,16 +331,18 @@ class LoadReferenceObjectsTask(pipeBase.Task, metaclass=abc.ABCMeta):
         @param[in] bbox  pixel region (an afwImage.Box2D)
         @param[in] wcs  WCS used to convert sky position to pixel position (an lsst.afw.math.WCS)
 
-        @return a catalog of reference objects in bbox, with centroid and hasCentroid fields set
+        @return a contiguous catalog of reference objects in bbox, with centroid and hasCentroid fields set
         """
         afwTable.updateRefCentroids(wcs, refCat)
-        centroidKey = afwTable.Point2DKey(refCat.schema["centroid"])
-        retStarCat = type(refCat)(refCat.table)
-        for star in refCat:
-            point = star.get(centroidKey)
-            if bbox.contains(point):
-                retStarCat.append(star)
-        return retStarCat
+        if not refCat.isContiguous():
+            refCat = refCat.copy(deep=True)
+        # same test as bbox.contains(point): the minimum is included and the maximum is not
+        x = refCat["centroid_x"]
+        y = refCat["centroid_y"]
+        bboxMin = bbox.getMin()
+        bboxMax = bbox.getMax()
+        inBBox = (x >= bboxMin.getX()) & (x < bboxMax.getX()) & (y >= bboxMin.getY()) & (y < bboxMax.getY())
+        return refCat[inBBox].copy(deep=True)
 
     def _addFluxAliases(self, schema):
         """Add aliases for camera filter fluxes to the schema
@@ -410,7 +492,7 @@ class LoadReferenceObjectsTask(pipeBase.Task, metaclass=abc.ABCMeta):
         md.add('FILTER', filterName, 'filter name for photometric data')
         return md
 
-    def joinMatchListWithCatalog(self, matchCat, sourceCat):
+    def joinMatchListWithCatalog(self, matchCat, sourceCat, columnar=False):
         """!Relink an unpersisted match list to sources and reference objects
 
         A match list is persisted and unpersisted as a catalog of IDs produced by
@@ -419,13 +501,27 @@ class LoadReferenceObjectsTask(pipeBase.Task, metaclass=abc.ABCMeta):
         into a match list (an lsst.afw.table.ReferenceMatchVector) with links to source
         records and reference object records.
 
+        If columnar is True no match objects are made; instead the ids of all matches are
+        looked up at once with numpy.searchsorted, and arrays of the indices of the matched
+        records are returned.
+
         @param[in]     matchCat   Unperisted packed match list (an lsst.afw.table.BaseCatalog).
                                   matchCat.table.getMetadata() must contain match metadata,
                                   as returned by the astrometry tasks.
         @param[in,out] sourceCat  Source catalog (an lsst.afw.table.SourceCatalog).
-                                  As a side effect, the catalog will be sorted by ID.
-
-        @return the match list (an lsst.afw.table.ReferenceMatchVector)
+                                  As a side effect, the catalog will be sorted by ID,
+                                  unless columnar is True.
+        @param[in]     columnar   Return arrays of indices instead of a match list?
+
+        @return the match list (an lsst.afw.table.ReferenceMatchVector) if columnar is False,
+        else an lsst.pipe.base.Struct containing:
+        - refCat: the loaded reference objects (a contiguous lsst.afw.table.SimpleCatalog)
+        - sourceCat: the sources; sourceCat itself, or a contiguous copy if it is not contiguous
+        - refIndex: numpy array of the index in refCat of the reference object of each match,
+            or -1 if it was not loaded
+        - sourceIndex: numpy array of the index in sourceCat of the source of each match,
+            or -1 if it is not in sourceCat
+        - distance: numpy array of the distance of each match
         """
         matchmeta = matchCat.table.getMetadata()
         version = matchmeta.getInt('SMATCHV')
@@ -436,6 +532,39 @@ class LoadReferenceObjectsTask(pipeBase.Task, metaclass=abc.ABCMeta):
                                        matchmeta.getDouble('DEC'), afwGeom.degrees)
         rad = matchmeta.getDouble('RADIUS') * afwGeom.degrees
         refCat = self.loadSkyCircle(ctrCoord, rad, filterName).refCat
-        refCat.sort()
-        sourceCat.sort()
+        if columnar:
+            if not matchCat.isContiguous():
+                matchCat = matchCat.copy(deep=True)
+            if not sourceCat.isContiguous():
+                sourceCat = sourceCat.copy(deep=True)
+            return pipeBase.Struct(
+                refCat=refCat,
+                sourceCat=sourceCat,
+                refIndex=_findIds(refCat["id"], matchCat["first"]),
+                sourceIndex=_findIds(sourceCat["id"], matchCat["second"]),
+                distance=numpy.array(matchCat["distance"]),
+            )
+        # unpackMatches finds each id by binary search, so the catalogs must be sorted
+        if not refCat.isSorted():
+            refCat.sort()
+        if not sourceCat.isSorted():
+            sourceCat.sort()
         return afwTable.unpackMatches(matchCat, refCat, sourceCat)
+
+
+def _findIds(ids, targetIds):
+    """!Find the index of each of a set of ids in an array of unique ids
+
+    @param[in] ids  numpy array of unique ids, in any order
+    @param[in] targetIds  numpy array of ids to find
+    @return a numpy array of the index in ids of each target id, or -1 if it is not present
+    """
+    ids = numpy.asarray(ids)
+    targetIds = numpy.asarray(targetIds)
+    if len(ids) == 0:
+        return numpy.full(len(targetIds), -1, dtype=numpy.int64)
+    order = numpy.argsort(ids, kind="mergesort")
+    sortedIds = ids[order]
+    positions = numpy.searchsorted(sortedIds, targetIds)
+    positions[positions == len(sortedIds)] = 0
+    return numpy.where(sortedIds[positions] == targetIds, order[positions], -1)
@@ -0,0 +1,190 @@
+#
+# LSST Data Management System
+#
+# Copyright 2008-2017  AURA/LSST.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <https://www.lsstcorp.org/LegalNotices/>.
+#
+
+__all__ = ["MultiOrderIndexer"]
+
+import abc
+import collections
+
+import numpy as np
+
+
+class MultiOrderIndexer(metaclass=abc.ABCMeta):
+    """!Base class for indexers whose shards are pixels of several levels of a hierarchy
+
+    Every pixel of the hierarchy has four children, and pixel ids are unique across
+    levels, with the children of pixel id numbered 4*id to 4*id + 3.  HTM ids and the
+    NUNIQ scheme for HEALPix pixels both have this form.
+
+    The shards are the pixels at min_level, except that the pixels listed in split_pixels
+    are replaced by their children, recursively, down to at most max_level.  The pixels to
+    split are chosen by counting the points of a catalog with count_points, then calling
+    finish_counts, so that no shard has more than max_rows_per_shard points unless it is
+    at max_level.  update_config records the chosen pixels in the indexer config.
+
+    Subclasses must implement _index_points_at_level and _get_cover_at_level;
+    a subclass that lacks either cannot be instantiated.
+    """
+
+    def __init__(self, min_level, max_level, max_rows_per_shard, split_pixels=()):
+        """!Construct the indexer object
+
+        @param[in] min_level  level of the largest pixels
+        @param[in] max_level  level of the smallest pixels
+        @param[in] max_rows_per_shard  maximum number of points in a shard above max_level
+        @param[in] split_pixels  ids of the pixels that are replaced by their children
+        """
+        if max_level < min_level:
+            raise ValueError("max_level %s must not be less than min_level %s" % (max_level, min_level))
+        self.min_level = min_level
+        self.max_level = max_level
+        self.max_rows_per_shard = max_rows_per_shard
+        self.split_pixels = np.array(sorted(split_pixels), dtype=np.int64)
+        self._counts = collections.Counter()
+
+    def get_pixel_ids(self, ctrCoord, radius):
+        """!Get all shards that touch a circular aperture
+
+        @param[in] ctrCoord  afwGeom.SpherePoint ICRS center of the aperture
+        @param[in] radius  afwGeom.Angle object of the aperture radius
+        @param[out] the numpy array of the ids of the shards and a numpy boolean array,
+                    indicating whether the shard touches the boundary (True) or is fully contained (False).
+        """
+        ra = ctrCoord.getLongitude().asDegrees()
+        dec = ctrCoord.getLatitude().asDegrees()
+        pixel_id_list = []
+        boundary_mask_list = []
+        parents = None
+        for level in range(self.min_level, self.max_level + 1):
+            ids, covered_ids = self._get_cover_at_level(ra, dec, radius.asDegrees(), level)
+            ids = np.asarray(ids, dtype=np.int64)
+            if parents is not None:
+                ids = ids[np.isin(ids >> 2, parents)]
+            if level < self.max_level:
+                is_split = np.isin(ids, self.split_pixels)
+            else:
+                is_split = np.zeros(len(ids), dtype=bool)
+            leaves = ids[~is_split]
+            pixel_id_list.append(leaves)
+            boundary_mask_list.append(~np.isin(leaves, covered_ids))
+            parents = ids[is_split]
+            if len(parents) == 0:
+                break
+        return np.concatenate(pixel_id_list), np.concatenate(boundary_mask_list)
+
+    def index_points(self, ra_list, dec_list):
+        """!Generate shard ids for each row in an input file
+
+        @param[in] ra_list  List of RA coordinate in degrees
+        @param[in] dec_list  List of Dec coordinate in degrees
+        @param[out] A numpy array of pixel ids
+        """
+        ids = np.asarray(self._index_points_at_level(ra_list, dec_list, self.max_level), dtype=np.int64)
+        pixel_ids = ids >> 2*(self.max_level - self.min_level)
+        for level in range(self.min_level, self.max_level):
+            is_split = np.isin(pixel_ids, self.split_pixels)
+            if not is_split.any():
+                break
+            pixel_ids[is_split] = ids[is_split] >> 2*(self.max_level - level - 1)
+        return pixel_ids
+
+    def count_points(self, ra_list, dec_list):
+        """!Count points of a catalog, to choose the pixels to split in finish_counts
+
+        @param[in] ra_list  List of RA coordinate in degrees
+        @param[in] dec_list  List of Dec coordinate in degrees
+        """
+        ids = self._index_points_at_level(ra_list, dec_list, self.max_level)
+        ids, counts = np.unique(ids, return_counts=True)
+        self._counts.update(dict(zip(ids.tolist(), counts.tolist())))
+
+    def finish_counts(self):
+        """!Choose the pixels to split from the points counted by count_points
+
+        A pixel is split if it has more than max_rows_per_shard points, it is above max_level,
+        and it is at min_level or its parent is split.  The counts are then reset.
+
+        @return the numpy array of the ids of the split pixels
+        """
+        ids = np.array(list(self._counts.keys()), dtype=np.int64)
+        counts = np.array(list(self._counts.values()), dtype=np.int64)
+        split_pixel_list = []
+        # points in pixels that are still being split
+        active = np.ones(len(ids), dtype=bool)
+        for level in range(self.min_level, self.max_level):
+            ancestors = ids[active] >> 2*(self.max_level - level)
+            unique_ancestors, inverse = np.unique(ancestors, return_inverse=True)
+            level_counts = np.bincount(inverse, weights=counts[active])
+            split = unique_ancestors[level_counts > self.max_rows_per_shard]
+            if len(split) == 0:
+                break
+            split_pixel_list.append(split)
+            active[active] = np.isin(ancestors, split)
+        self.split_pixels = np.sort(np.concatenate(split_pixel_list)) if split_pixel_list else \
+            np.array([], dtype=np.int64)
+        self._counts = collections.Counter()
+        return self.split_pixels
+
+    def update_config(self, config):
+        """!Record the split pixels in an indexer config
+
+        @param[in,out] config  config of the indexer, with a split_pixels field
+        """
+        config.split_pixels = [int(pixel_id) for pixel_id in self.split_pixels]
+
+    @staticmethod
+    def make_data_id(pixel_id, dataset_name):
+        """!Make a data id.  Meant to be overridden.
+        @param[in] pixel_id  An identifier for the pixel in question.
+        @param[in] dataset_name  Name of the dataset to use.
+        @param[out] dataId (dictionary)
+        """
+        if pixel_id is None:
+            # NoneType doesn't format, so make dummy pixel
+            pixel_id = 0
+        return {'pixel_id': pixel_id, 'name': dataset_name}
+
+    @abc.abstractmethod
+    def _index_points_at_level(self, ra_list, dec_list, level):
+        """!Compute the ids of the pixels at one level containing a set of points
+
+        @param[in] ra_list  List of RA coordinate in degrees
+        @param[in] dec_list  List of Dec coordinate in degrees
+        @param[in] level  level of the pixels
+        @param[out] A numpy array of pixel ids
+        """
+        return
+
+    @abc.abstractmethod
+    def _get_cover_at_level(self, ra, dec, radius, level):
+        """!Get the pixels at one level that touch a circle, and those fully inside it
+
+        @param[in] ra  RA of the center of the circle, in degrees
+        @param[in] dec  Dec of the center of the circle, in degrees
+        @param[in] radius  radius of the circle, in degrees
+        @param[in] level  level of the pixels
+        @param[out] a numpy array of the ids of the pixels that touch the circle, and
+                    one of the ids of those fully inside it; the first may include pixels
+                    that do not touch the circle, and the second may omit pixels that are inside it
+        """
+        return
@@ -23,6 +23,7 @@
 
 __all__ = ["ReadFitsCatalogConfig", "ReadFitsCatalogTask"]
 
+import numpy as np
 from astropy.io import fits
 
 import lsst.pex.config as pexConfig
@@ -92,27 +93,100 @@ class ReadFitsCatalogTask(pipeBase.Task):
     _DefaultName = 'readCatalog'
     ConfigClass = ReadFitsCatalogConfig
 
-    def run(self, filename):
+    def run(self, filename, columns=None):
         """Read an object catalog from the specified FITS file
 
+        The file is memory mapped.  If columns is specified only those columns are converted
+        from their FITS representation, and a plain numpy structured array is returned with
+        string columns converted to unicode.
+
         @param[in] filename  path to FITS file
+        @param[in] columns  list of the names (after renaming by column_map) of the columns
+            to return, or None for all columns
         @return a numpy structured array containing the specified columns
         """
-        with fits.open(filename) as f:
-            hdu = f[self.config.hdu]
-            if hdu.data is None:
-                raise RuntimeError("No data found in %s HDU %s" % (filename, self.config.hdu))
-            if hdu.is_image:
-                raise RuntimeError("%s HDU %s is an image" % (filename, self.config.hdu))
+        with fits.open(filename, memmap=True) as f:
+            hdu = self._get_table_hdu(f, filename, columns)
+
+            if columns is not None:
+                return self._read_rows(hdu, 0, len(hdu.data), columns)
 
             if not self.config.column_map:
                 # take the data as it is
                 return hdu.data
 
-            missingnames = set(self.config.column_map.keys()) - set(hdu.columns.names)
-            if missingnames:
-                raise RuntimeError("Columns %s in column_map were not found in %s" % (missingnames, filename))
-
             for inname, outname in self.config.column_map.items():
                 hdu.columns[inname].name = outname
             return hdu.data
+
+    def iter_chunks(self, filename, rows_per_chunk, columns=None):
+        """Read an object catalog from the specified FITS file a chunk of rows at a time
+
+        The file is memory mapped, so only the rows of one chunk are held in memory at once.
+        Unlike run, each chunk is a plain numpy structured array, with string columns
+        converted to unicode.
+
+        @param[in] filename  path to FITS file
+        @param[in] rows_per_chunk  maximum number of rows in each chunk
+        @param[in] columns  list of the names (after renaming by column_map) of the columns
+            to return, or None for all columns
+        @return an iterator over numpy structured arrays containing the specified columns
+        """
+        with fits.open(filename, memmap=True) as f:
+            hdu = self._get_table_hdu(f, filename, columns)
+            for start in range(0, len(hdu.data), rows_per_chunk):
+                yield self._read_rows(hdu, start, start + rows_per_chunk, columns)
+
+    def _get_table_hdu(self, f, filename, columns=None):
+        """Return the HDU to read, checking that it is a table containing the requested columns
+
+        @param[in] f  an open astropy.io.fits HDUList
+        @param[in] filename  path to FITS file, for error messages
+        @param[in] columns  list of the names (after renaming by column_map) of the columns
+            to read, or None for all columns
+        @return the HDU
+        """
+        hdu = f[self.config.hdu]
+        if hdu.data is None:
+            raise RuntimeError("No data found in %s HDU %s" % (filename, self.config.hdu))
+        if hdu.is_image:
+            raise RuntimeError("%s HDU %s is an image" % (filename, self.config.hdu))
+
+        missingnames = set(self.config.column_map.keys()) - set(hdu.columns.names)
+        if missingnames:
+            raise RuntimeError("Columns %s in column_map were not found in %s" % (missingnames, filename))
+        if columns is not None:
+            outnames = [self.config.column_map.get(name, name) for name in hdu.columns.names]
+            missingnames = set(columns) - set(outnames)
+            if missingnames:
+                raise RuntimeError("Columns %s were not found in %s" % (missingnames, filename))
+        return hdu
+
+    def _read_rows(self, hdu, start, stop, columns=None):
+        """Read a range of rows of a table into a numpy structured array
+
+        Only the requested columns are converted from their FITS representation, and they
+        are written directly to fields with their output names.
+
+        @param[in] hdu  table HDU to read
+        @param[in] start  index of the first row to read
+        @param[in] stop  index one past the last row to read
+        @param[in] columns  list of the names (after renaming by column_map) of the columns
+            to read, or None for all columns
+        @return a numpy structured array containing the specified columns
+        """
+        innames = {self.config.column_map.get(name, name): name for name in hdu.columns.names}
+        if columns is None:
+            columns = [self.config.column_map.get(name, name) for name in hdu.columns.names]
+        rows = hdu.data[start:stop]
+        data = []
+        for outname in columns:
+            column = np.asarray(rows.field(innames[outname]))
+            if column.dtype.kind == 'S':
+                column = column.astype(str)
+            data.append(column)
+        arr = np.empty(len(rows), dtype=[(outname, column.dtype, column.shape[1:])
+                                         for outname, column in zip(columns, data)])
+        for outname, column in zip(columns, data):
+            arr[outname] = column
+        return arr
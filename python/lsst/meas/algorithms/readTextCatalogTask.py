@@ -23,6 +23,8 @@
 
 __all__ = ["ReadTextCatalogConfig", "ReadTextCatalogTask"]
 
+import itertools
+
 import numpy as np
 
 import lsst.pex.config as pexConfig
@@ -47,6 +49,44 @@ class ReadTextCatalogConfig(pexConfig.Config):
         default=',',
         doc='Delimiter to use when reading text reference files.  Comma is default.'
     )
+    parser = pexConfig.ChoiceField(
+        dtype=str,
+        default="genfromtxt",
+        allowed={
+            "genfromtxt": "numpy.genfromtxt, which infers the type of each column from every row",
+            "loadtxt": "numpy.loadtxt with a fixed type for each column, which is much faster for "
+                       "large numeric catalogs.  Types are taken from dtypes, or else inferred from "
+                       "the first sample_lines rows, so every row must be parseable as those types.",
+        },
+        doc="Parser to use to read the text file",
+    )
+    dtypes = pexConfig.DictField(
+        doc="Mapping of column name: numpy type (e.g. 'f8', 'i8', 'U20') for the loadtxt parser. "
+            "Columns not listed have their type inferred from a sample of rows.",
+        keytype=str,
+        itemtype=str,
+        default={},
+    )
+    sample_lines = pexConfig.RangeField(
+        dtype=int,
+        default=1000,
+        min=1,
+        doc="Number of rows used to infer column types for the loadtxt parser."
+    )
+
+
+def _str_to_bool(value):
+    """Convert a string to a bool in the way numpy.genfromtxt does
+
+    @param[in] value  string "True" or "False", in any case
+    @return the bool value
+    """
+    value = value.strip().upper()
+    if value == 'TRUE':
+        return True
+    if value == 'FALSE':
+        return False
+    raise ValueError("Invalid boolean value %r" % (value,))
 
 ## @addtogroup LSST_task_documentation
 ## @{
@@ -103,18 +143,151 @@ class ReadTextCatalogTask(pipeBase.Task):
     _DefaultName = 'readCatalog'
     ConfigClass = ReadTextCatalogConfig
 
-    def run(self, filename):
+    def run(self, filename, columns=None):
         """Read an object catalog from the specified text file
 
         @param[in] filename  path to text file
+        @param[in] columns  list of the names of the columns to return, or None for all columns
         @return a numpy structured array containing the specified columns
         """
         names = True
         if self.config.colnames:
             names = self.config.colnames
-        arr = np.genfromtxt(filename, dtype=None, skip_header=self.config.header_lines,
+        return self._parse(filename, names=names, skip_header=self.config.header_lines, columns=columns)
+
+    def iter_chunks(self, filename, rows_per_chunk, columns=None):
+        """Read an object catalog from the specified text file in chunks of rows
+
+        Only one chunk of the file is held in memory at a time.  The column types are
+        inferred separately for each chunk, so string columns may have different widths,
+        and integer columns may become floating point, in different chunks.
+
+        @param[in] filename  path to text file
+        @param[in] rows_per_chunk  maximum number of rows in each chunk
+        @param[in] columns  list of the names of the columns to return, or None for all columns
+        @return an iterator over numpy structured arrays containing the specified columns
+        """
+        names = True
+        n_lines = rows_per_chunk + 1  # include the line with the column names
+        if self.config.colnames:
+            names = self.config.colnames
+            n_lines = rows_per_chunk
+        with open(filename) as f:
+            lines = itertools.islice(f, self.config.header_lines, None)
+            while True:
+                chunk_lines = list(itertools.islice(lines, n_lines))
+                if not chunk_lines:
+                    break
+                arr = self._parse(chunk_lines, names=names, skip_header=0, columns=columns)
+                if names is True:
+                    header = self._parse_genfromtxt(chunk_lines[:2], names=True, skip_header=0)
+                    if header.dtype.names is not None:
+                        # later chunks do not include the line with the column names
+                        names = list(header.dtype.names)
+                        n_lines = rows_per_chunk
+                if len(arr) > 0:
+                    yield arr
+
+    def _parse(self, source, names, skip_header, columns=None):
+        """Parse text into a numpy structured array, using the parser set in the config
+
+        @param[in] source  path to text file, or list of lines of text
+        @param[in] names  list of column names, or True to read them from the first line
+        @param[in] skip_header  number of lines to skip before reading
+        @param[in] columns  list of the names of the columns to return, or None for all columns
+        @return a numpy structured array containing the specified columns
+        """
+        if self.config.parser == "loadtxt":
+            return self._parse_loadtxt(source, names=names, skip_header=skip_header, columns=columns)
+        arr = self._parse_genfromtxt(source, names=names, skip_header=skip_header)
+        if columns is None or arr.dtype.names is None:
+            return arr
+        self._check_columns(columns, arr.dtype.names)
+        selected = np.empty(len(arr), dtype=[(name, arr.dtype[name]) for name in columns])
+        for name in columns:
+            selected[name] = arr[name]
+        return selected
+
+    def _check_columns(self, columns, names):
+        """Raise ValueError if any requested column is not in the input
+
+        @param[in] columns  list of the names of the columns requested
+        @param[in] names  list of the names of the columns in the input
+        """
+        missingnames = set(columns) - set(names)
+        if missingnames:
+            raise ValueError("Columns %s were not found in the input" % (missingnames,))
+
+    def _parse_loadtxt(self, source, names, skip_header, columns=None):
+        """Parse text into a numpy structured array with numpy.loadtxt
+
+        The column names and any types not given in config.dtypes are taken from parsing
+        the first config.sample_lines rows with numpy.genfromtxt.  String columns with
+        an inferred type are sized to their longest value, as numpy.genfromtxt does.
+        Only the requested columns are converted.
+
+        @param[in] source  path to text file, or list of lines of text
+        @param[in] names  list of column names, or True to read them from the first line
+        @param[in] skip_header  number of lines to skip before reading
+        @param[in] columns  list of the names of the columns to return, or None for all columns
+        @return a numpy structured array containing the specified columns
+        """
+        n_sample = self.config.sample_lines + 1  # include the line with the column names
+        if isinstance(source, str):
+            with open(source) as f:
+                sample = list(itertools.islice(f, skip_header, skip_header + n_sample))
+        else:
+            sample = source[skip_header:skip_header + n_sample]
+        sample_arr = self._parse_genfromtxt(sample, names=names, skip_header=0)
+        if sample_arr.dtype.names is None:
+            return sample_arr
+
+        missingnames = set(self.config.dtypes.keys()) - set(sample_arr.dtype.names)
+        if missingnames:
+            raise ValueError("Columns %s in dtypes were not found in the input" % (missingnames,))
+        if columns is None:
+            columns = sample_arr.dtype.names
+        self._check_columns(columns, sample_arr.dtype.names)
+        usecols = [sample_arr.dtype.names.index(name) for name in columns]
+        dtype = []
+        converters = {}
+        for i, name in zip(usecols, columns):
+            if name in self.config.dtypes:
+                value = np.dtype(self.config.dtypes[name])
+            else:
+                value = sample_arr.dtype[name]
+                if value.kind == 'U':
+                    # read as Python strings, then size the column once all rows have been read
+                    value = np.dtype(object)
+            if value.kind == 'b':
+                converters[i] = _str_to_bool
+            dtype.append((name, value))
+        arr = np.loadtxt(source, dtype=dtype, delimiter=self.config.delimiter,
+                         skiprows=skip_header + (1 if names is True else 0),
+                         usecols=usecols, converters=converters, ndmin=1)
+
+        newDtype = []
+        for name in arr.dtype.names:
+            value = arr.dtype[name]
+            if value.kind == 'O':
+                value = np.dtype('|U{}'.format(max([1] + [len(item) for item in arr[name]])))
+            newDtype.append((name, value))
+        return arr.astype(newDtype)
+
+    def _parse_genfromtxt(self, source, names, skip_header):
+        """Parse text into a numpy structured array with numpy.genfromtxt
+
+        @param[in] source  path to text file, or list of lines of text
+        @param[in] names  list of column names, or True to read them from the first line
+        @param[in] skip_header  number of lines to skip before reading
+        @return a numpy structured array containing the specified columns
+        """
+        arr = np.genfromtxt(source, dtype=None, skip_header=skip_header,
                             delimiter=self.config.delimiter,
                             names=names)
+        if arr.dtype.names is None:
+            # no data was found
+            return np.atleast_1d(arr)
         # This is to explicitly convert the bytes type into unicode for any column that is read in as bytes
         # string
         newDtype = []
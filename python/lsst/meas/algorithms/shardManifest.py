@@ -0,0 +1,85 @@
+#
+# LSST Data Management System
+#
+# Copyright 2008-2017  AURA/LSST.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <https://www.lsstcorp.org/LegalNotices/>.
+#
+"""!Manifest of the populated shards of a reference catalog
+
+The manifest is a numpy .npz file next to the persisted dataset config (ref_cat_config),
+holding the pixel id, number of rows and size on disk of every populated shard as three
+arrays sorted by pixel id.  An all-sky catalog has millions of shards, so the manifest is
+kept out of the dataset config, which every loader reads, and a loader reads it only when
+it first looks up a shard.
+"""
+
+__all__ = ["get_shard_manifest_path", "write_shard_manifest", "read_shard_manifest"]
+
+import os
+
+import numpy as np
+
+
+def get_shard_manifest_path(config_path):
+    """!Return the path of the shard manifest of a reference catalog
+
+    @param[in] config_path  path of the dataset config (ref_cat_config) persisted by the butler
+    @return the path of the .npz file holding the manifest
+    """
+    return os.path.join(os.path.dirname(config_path), "manifest.npz")
+
+
+def write_shard_manifest(path, shard_rows, shard_bytes):
+    """!Write a shard manifest
+
+    The manifest is written to a temporary file in the same directory, which then replaces
+    any existing file at path, so that an interrupted write leaves the old manifest intact.
+
+    @param[in] path  path of the .npz file to write
+    @param[in] shard_rows  dict of pixel id: number of rows in each populated shard
+    @param[in] shard_bytes  dict of pixel id: size on disk in bytes of each populated shard;
+        must have the same keys as shard_rows
+    """
+    pixel_ids = np.array(sorted(shard_rows.keys()), dtype=np.int64)
+    n_rows = np.array([shard_rows[pixel_id] for pixel_id in pixel_ids.tolist()], dtype=np.int64)
+    n_bytes = np.array([shard_bytes[pixel_id] for pixel_id in pixel_ids.tolist()], dtype=np.int64)
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = path + ".tmp"
+    try:
+        with open(tmp_path, "wb") as tmp_file:
+            np.savez_compressed(tmp_file, pixel_id=pixel_ids, n_rows=n_rows, n_bytes=n_bytes)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def read_shard_manifest(path):
+    """!Read a shard manifest
+
+    @param[in] path  path of the .npz file to read
+    @return a dict of pixel id: number of rows and a dict of pixel id: size on disk in bytes,
+        for each populated shard
+    """
+    with np.load(path) as data:
+        pixel_ids = data["pixel_id"].tolist()
+        shard_rows = dict(zip(pixel_ids, data["n_rows"].tolist()))
+        shard_bytes = dict(zip(pixel_ids, data["n_bytes"].tolist()))
+    return shard_rows, shard_bytes
@@ -127,6 +127,38 @@ class DetectionTestCase(lsst.utils.tests.TestCase):
         checkExposure(original, False, True)
         checkExposure(original, True, True)
 
+    def testSmoothImagePlaneOnly(self):
+        """Test smoothing only the image plane against smoothing the full masked image"""
+        bbox = afwGeom.Box2I(afwGeom.Point2I(256, 100), afwGeom.Extent2I(128, 127))
+        numX = 5
+        numY = 5
+        coordList = self.makeCoordList(bbox=bbox, numX=numX, numY=numY, minCounts=5000, maxCounts=50000,
+                                       sigma=1.5)
+        sky = 2000
+        exposure = plantSources(bbox=bbox, kwid=11, sky=sky, coordList=coordList, addPoissonNoise=True)
+
+        middles = {}
+        for smoothImagePlaneOnly in (False, True):
+            config = SourceDetectionTask.ConfigClass()
+            config.reEstimateBackground = False
+            config.smoothImagePlaneOnly = smoothImagePlaneOnly
+            schema = afwTable.SourceTable.makeMinimalSchema()
+            task = SourceDetectionTask(config=config, schema=schema)
+            res = task.detectFootprints(exposure.clone(), sigma=2.2)
+            self.assertEqual(res.numPos, numX * numY)
+            self.assertEqual(res.numNeg, 0)
+
+            # where the variance is uniform, scaling it is the same as smoothing it
+            maskedImage = exposure.getMaskedImage().clone()
+            maskedImage.getVariance().set(sky)
+            psf = task.getPsf(exposure, sigma=2.2)
+            middles[smoothImagePlaneOnly] = task.convolveImage(maskedImage, psf).middle
+
+        full, imageOnly = middles[False], middles[True]
+        self.assertEqual(imageOnly.getBBox(), full.getBBox())
+        self.assertFloatsAlmostEqual(imageOnly.image.array, full.image.array, rtol=1e-6, atol=1e-3)
+        self.assertFloatsAlmostEqual(imageOnly.variance.array, full.variance.array, rtol=1e-5)
+
 
 class TestMemory(lsst.utils.tests.MemoryTestCase):
     pass
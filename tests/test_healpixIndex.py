@@ -0,0 +1,188 @@
+#
+# LSST Data Management System
+#
+# Copyright 2008-2017  AURA/LSST.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <https://www.lsstcorp.org/LegalNotices/>.
+#
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+import lsst.afw.geom as afwGeom
+import lsst.daf.persistence as dafPersist
+from lsst.meas.algorithms import (IngestIndexedReferenceTask, LoadIndexedReferenceObjectsTask,
+                                  LoadIndexedReferenceObjectsConfig)
+from lsst.meas.algorithms import IndexerRegistry
+from lsst.meas.algorithms.shardManifest import get_shard_manifest_path, read_shard_manifest
+import lsst.utils
+import lsst.utils.tests
+
+try:
+    import healpy
+except ImportError:
+    healpy = None
+
+obs_test_dir = lsst.utils.getPackageDir('obs_test')
+input_dir = os.path.join(obs_test_dir, "data", "input")
+
+
+def make_coord(ra, dec):
+    """Make an ICRS coord given its RA, Dec in degrees."""
+    return afwGeom.SpherePoint(ra, dec, afwGeom.degrees)
+
+
+def read_manifest(butler, name):
+    """Return the shard rows and shard bytes dicts of the manifest of a reference catalog."""
+    return read_shard_manifest(get_shard_manifest_path(butler.getUri("ref_cat_config", name=name)))
+
+
+@unittest.skipIf(healpy is None, "healpy is not available")
+class HealpixIndexTestCase(lsst.utils.tests.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.out_path = tempfile.mkdtemp()
+        np.random.seed(123)
+        size = 2000
+        ident = np.arange(1, size + 1)
+        ra = np.random.random(size)*360.
+        dec = np.degrees(np.arcsin(2.*np.random.random(size) - 1.))
+        # a dense clump, to be split into smaller pixels by the multi-order indexer
+        ra[:500] = 93. + np.random.normal(scale=0.5, size=500)
+        dec[:500] = -30. + np.random.normal(scale=0.5, size=500)
+        mag = 16. + np.random.random(size)*4.
+        arr = np.array(list(zip(ident, ra, dec, mag)),
+                       dtype=[('id', int), ('ra', float), ('dec', float), ('a', float)])
+        cls.sky_catalog = arr
+        cls.sky_catalog_file = os.path.join(cls.out_path, "ref.txt")
+        np.savetxt(cls.sky_catalog_file, arr, delimiter=",", header="id,ra,dec,a",
+                   fmt=["%i", "%.8g", "%.8g", "%.4g"])
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.out_path, ignore_errors=True)
+        del cls.sky_catalog
+
+    def makeConfig(self, indexer_name, **indexer_config):
+        """Make an ingest config for the test catalog with an indexer."""
+        config = IngestIndexedReferenceTask.ConfigClass()
+        config.dataset_config.indexer.name = indexer_name
+        for name, value in indexer_config.items():
+            setattr(config.dataset_config.indexer.active, name, value)
+        config.ra_name = 'ra'
+        config.dec_name = 'dec'
+        config.id_name = 'id'
+        config.mag_column_list = ['a']
+        return config
+
+    def ingest(self, indexer_name, repo_name, **indexer_config):
+        """Ingest the test catalog with an indexer and return a butler for the output repo."""
+        config = self.makeConfig(indexer_name, **indexer_config)
+        repo_path = os.path.join(self.out_path, repo_name)
+        IngestIndexedReferenceTask.parseAndRun(args=[input_dir, "--output", repo_path,
+                                                     self.sky_catalog_file], config=config)
+        return dafPersist.Butler(repo_path)
+
+    def assertLoadsCircles(self, butler):
+        """Assert that loadSkyCircle finds exactly the objects within each circle."""
+        loader = LoadIndexedReferenceObjectsTask(butler=butler, config=LoadIndexedReferenceObjectsConfig())
+        coords = [make_coord(ra, dec) for ra, dec in zip(self.sky_catalog['ra'], self.sky_catalog['dec'])]
+        for ra, dec, radius in ((93., -30., 0.3), (93., -30., 2.), (0., 90., 5.), (210., 10., 8.)):
+            cent = make_coord(ra, dec)
+            radius = radius*afwGeom.degrees
+            des_ids = [ident for ident, coord in zip(self.sky_catalog['id'], coords)
+                       if coord.separation(cent) < radius]
+            refCat = loader.loadSkyCircle(cent, radius, filterName='a').refCat
+            self.assertEqual(sorted(refCat['id']), sorted(des_ids))
+
+    def testHealpix(self):
+        """Test ingesting and loading with the single-order HEALPix indexer."""
+        butler = self.ingest("HEALPIX", "healpix", order=5)
+        dataset_config = butler.get("ref_cat_config", name="cal_ref_cat", immediate=True)
+        self.assertEqual(dataset_config.indexer.name, "HEALPIX")
+        shard_rows, _ = read_manifest(butler, "cal_ref_cat")
+        self.assertTrue(all(0 <= pixel_id < 12*4**5 for pixel_id in shard_rows))
+        self.assertLoadsCircles(butler)
+
+    def testMultiOrderHealpix(self):
+        """Test that the multi-order HEALPix indexer limits the size of shards."""
+        max_rows = 50
+        butler = self.ingest("MULTI_ORDER_HEALPIX", "multi_order", min_order=2, max_order=7,
+                             max_rows_per_shard=max_rows)
+        dataset_config = butler.get("ref_cat_config", name="cal_ref_cat", immediate=True)
+        split_pixels = set(dataset_config.indexer.active.split_pixels)
+        self.assertGreater(len(split_pixels), 0)
+        shard_rows, _ = read_manifest(butler, "cal_ref_cat")
+        for pixel_id, n_rows in shard_rows.items():
+            self.assertNotIn(pixel_id, split_pixels)
+            order = int(np.log2(pixel_id//4))//2
+            if order < 7:
+                self.assertLessEqual(n_rows, max_rows)
+        self.assertEqual(sum(shard_rows.values()), len(self.sky_catalog))
+        self.assertLoadsCircles(butler)
+
+    def testExtendMultiOrder(self):
+        """Test that a catalog cannot be extended by an ingest that chooses different pixels."""
+        indexer_config = dict(min_order=2, max_order=7, max_rows_per_shard=50)
+        butler = self.ingest("MULTI_ORDER_HEALPIX", "multi_order_extend", **indexer_config)
+        shard_rows, _ = read_manifest(butler, "cal_ref_cat")
+        # without the clump no pixel needs to be split
+        uniform_file = os.path.join(self.out_path, "uniform.txt")
+        np.savetxt(uniform_file, self.sky_catalog[500:], delimiter=",", header="id,ra,dec,a",
+                   fmt=["%i", "%.8g", "%.8g", "%.4g"])
+        task = IngestIndexedReferenceTask(config=self.makeConfig("MULTI_ORDER_HEALPIX", **indexer_config),
+                                          butler=butler)
+        with self.assertRaises(RuntimeError):
+            task.create_indexed_catalog([uniform_file])
+        # nothing was written
+        self.assertEqual(read_manifest(butler, "cal_ref_cat")[0], shard_rows)
+        self.assertLoadsCircles(butler)
+
+    def testMultiOrderIndexPoints(self):
+        """Test that every point is indexed to a shard of the cover of a circle containing it."""
+        config = IndexerRegistry["MULTI_ORDER_HEALPIX"].ConfigClass()
+        config.min_order = 1
+        config.max_order = 6
+        config.max_rows_per_shard = 100
+        indexer = IndexerRegistry["MULTI_ORDER_HEALPIX"](config)
+        indexer.count_points(self.sky_catalog['ra'], self.sky_catalog['dec'])
+        indexer.finish_counts()
+        pixel_ids = indexer.index_points(self.sky_catalog['ra'], self.sky_catalog['dec'])
+        for ra, dec in zip(self.sky_catalog['ra'][:20], self.sky_catalog['dec'][:20]):
+            id_list, boundary_mask = indexer.get_pixel_ids(make_coord(ra, dec), 0.1*afwGeom.degrees)
+            self.assertIn(indexer.index_points([ra], [dec])[0], id_list)
+            self.assertEqual(len(id_list), len(boundary_mask))
+        self.assertFalse(np.any(np.isin(pixel_ids, indexer.split_pixels)))
+
+
+class TestMemory(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
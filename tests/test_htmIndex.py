@@ -21,21 +21,32 @@
 # see <https://www.lsstcorp.org/LegalNotices/>.
 #
 
+import concurrent.futures
+import json
+import multiprocessing
 import os
 import tempfile
 import shutil
 import unittest
+import unittest.mock
 import string
 from collections import Counter
 
+import esutil
 import numpy as np
 
 import lsst.afw.table as afwTable
 import lsst.afw.geom as afwGeom
 import lsst.daf.persistence as dafPersist
+from lsst.afw.image import fluxFromABMag
 from lsst.meas.algorithms import (IngestIndexedReferenceTask, LoadIndexedReferenceObjectsTask,
                                   LoadIndexedReferenceObjectsConfig, getRefFluxField)
 from lsst.meas.algorithms import IndexerRegistry
+from lsst.meas.algorithms.columnarShard import (get_columnar_shard_path, read_columnar_shard,
+                                                write_columnar_shard)
+from lsst.meas.algorithms.ingestIndexReferenceTask import _init_worker, _load_spilled, _run_bucket_file
+from lsst.meas.algorithms.multiOrderIndexer import MultiOrderIndexer
+from lsst.meas.algorithms.shardManifest import get_shard_manifest_path, read_shard_manifest
 import lsst.utils
 
 obs_test_dir = lsst.utils.getPackageDir('obs_test')
@@ -49,6 +60,11 @@ def make_coord(ra, dec):
     return afwGeom.SpherePoint(ra, dec, afwGeom.degrees)
 
 
+def read_manifest(butler, name):
+    """Return the shard rows and shard bytes dicts of the manifest of a reference catalog."""
+    return read_shard_manifest(get_shard_manifest_path(butler.getUri('ref_cat_config', name=name)))
+
+
 class HtmIndexTestCase(lsst.utils.tests.TestCase):
 
     @staticmethod
@@ -157,6 +173,26 @@ class HtmIndexTestCase(lsst.utils.tests.TestCase):
                 numWithSources += 1
         self.assertGreater(numWithSources, 0)
 
+    def testCoverCache(self):
+        """Test that cached covers include every pixel and never mark a boundary pixel as inside."""
+        indexer = IndexerRegistry['HTM'](IndexerRegistry['HTM'].ConfigClass())
+        cached_indexer = IndexerRegistry['HTM'](IndexerRegistry['HTM'].ConfigClass())
+        cached_indexer.enable_cover_cache(6.*afwGeom.arcminutes, max_entries=5)
+        for ra, dec in zip(self.test_ras, self.test_decs):
+            for delta in (0., 0.01, 0.03):
+                cent = make_coord(ra + delta, max(dec - delta, -90.))
+                radius = self.search_radius + delta*afwGeom.degrees
+                id_list, boundary_mask = indexer.get_pixel_ids(cent, radius)
+                covered_id_list = indexer.htm.intersect(ra + delta, max(dec - delta, -90.),
+                                                        radius.asDegrees(), inclusive=False)
+                self.assertEqual(list(boundary_mask), [pixel_id not in covered_id_list
+                                                       for pixel_id in id_list])
+                cached_id_list, cached_boundary_mask = cached_indexer.get_pixel_ids(cent, radius)
+                self.assertTrue(set(id_list) <= set(cached_id_list))
+                inside = set(np.array(cached_id_list)[~np.array(cached_boundary_mask)])
+                self.assertTrue(inside <= set(covered_id_list))
+        self.assertLessEqual(len(cached_indexer._cover_cache), 5)
+
     def testAgainstPersisted(self):
         pix_id = 2222
         dataset_name = IngestIndexedReferenceTask.ConfigClass().dataset_config.ref_dataset_name
@@ -174,6 +210,261 @@ class HtmIndexTestCase(lsst.utils.tests.TestCase):
         for kk in ex1:
             np.testing.assert_array_equal(ex1[kk], ex2[kk])
 
+    def makeConfig(self, withFlags=False):
+        """Make an ingest config matching the one used to make the test repo,
+        optionally also ingesting the flag columns."""
+        config = IngestIndexedReferenceTask.ConfigClass()
+        if withFlags:
+            config.is_photometric_name = 'is_phot'
+            config.is_resolved_name = 'is_res'
+            config.is_variable_name = 'is_var'
+        config.dataset_config.indexer.active.depth = self.depth
+        config.ra_name = 'ra_icrs'
+        config.dec_name = 'dec_icrs'
+        config.mag_column_list = ['a', 'b']
+        config.id_name = 'id'
+        config.mag_err_column_map = {'a': 'a_err', 'b': 'b_err'}
+        return config
+
+    def assertShardsEqual(self, repo_path, pix_ids=(2222,), ref_repo_path=None):
+        """Assert that shards in a repo match the shards in a reference repo,
+        by default the test repo."""
+        butler = dafPersist.Butler(repo_path)
+        ref_butler = self.test_butler if ref_repo_path is None else dafPersist.Butler(ref_repo_path)
+        dataset_name = IngestIndexedReferenceTask.ConfigClass().dataset_config.ref_dataset_name
+        for pix_id in pix_ids:
+            data_id = self.indexer.make_data_id(pix_id, dataset_name)
+            ex1 = butler.get('ref_cat', data_id).extract('*')
+            ex2 = ref_butler.get('ref_cat', data_id).extract('*')
+            self.assertEqual(set(ex1.keys()), set(ex2.keys()))
+            for kk in ex1:
+                np.testing.assert_array_equal(ex1[kk], ex2[kk])
+
+    def assertFlagsMatchInput(self, catalog):
+        """Assert that the flags of reference objects match those of the input catalog."""
+        rows = {int(row['id']): row for row in self.sky_catalog}
+        self.assertGreater(len(catalog), 0)
+        for flag, column in (('photometric', 'is_phot'), ('resolved', 'is_res'), ('variable', 'is_var')):
+            values = [record.get(flag) for record in catalog]
+            self.assertEqual(values, [bool(rows[record.getId()][column]) for record in catalog])
+            # both values must occur for the comparison to mean anything
+            self.assertEqual(set(values), {False, True})
+
+    def testIngestSpill(self):
+        """Test that spilling buffered rows to disk does not change the shards."""
+        config = self.makeConfig()
+        config.max_rows_in_memory = 100
+        output_path = os.path.join(self.out_path, "output_spill")
+        IngestIndexedReferenceTask.parseAndRun(args=[input_dir, "--output", output_path,
+                                                     self.sky_catalog_file], config=config)
+        self.assertShardsEqual(output_path)
+
+    def testIngestChunked(self):
+        """Test that reading the input a chunk at a time does not change the shards."""
+        for n_processes in (1, 2):
+            config = self.makeConfig()
+            config.rows_per_chunk = 7
+            config.n_processes = n_processes
+            output_path = os.path.join(self.out_path, "output_chunked_%d" % (n_processes,))
+            IngestIndexedReferenceTask.parseAndRun(args=[input_dir, "--output", output_path,
+                                                         self.sky_catalog_file], config=config)
+            self.assertShardsEqual(output_path)
+
+    def testIngestParallel(self):
+        """Test that ingesting with several processes gives the same shards."""
+        config = self.makeConfig()
+        config.n_processes = 2
+        output_path = os.path.join(self.out_path, "output_parallel")
+        IngestIndexedReferenceTask.parseAndRun(args=[input_dir, "--output", output_path,
+                                                     self.sky_catalog_file], config=config)
+        self.assertShardsEqual(output_path)
+
+        # ids assigned in input order must not depend on the number of processes
+        for n_processes in (1, 3):
+            config = self.makeConfig()
+            config.id_name = None
+            config.n_processes = n_processes
+            IngestIndexedReferenceTask.parseAndRun(
+                args=[input_dir, "--output", os.path.join(self.out_path, "output_noid_%d" % (n_processes,)),
+                      self.sky_catalog_file, self.sky_catalog_file], config=config)
+        self.assertShardsEqual(os.path.join(self.out_path, "output_noid_3"),
+                               ref_repo_path=os.path.join(self.out_path, "output_noid_1"))
+
+        # the workers are made from the config and the output root, so they need not be forked
+        config = self.makeConfig()
+        task = IngestIndexedReferenceTask(config=config, butler=dafPersist.Butler(output_path),
+                                          output_root=output_path)
+        spill_dir = tempfile.mkdtemp(dir=self.out_path)
+        with multiprocessing.get_context('spawn').Pool(1, initializer=_init_worker,
+                                                       initargs=(task._get_worker_config(),
+                                                                 output_path)) as pool:
+            # the worker reads the file itself and returns only the names of its spill files
+            dtype, n_rows, pieces = pool.apply(_run_bucket_file, ((self.sky_catalog_file, spill_dir),))
+        arr = self.sky_catalog
+        self.assertEqual(n_rows, len(arr))
+        self.assertIn('ra_icrs', dtype.names)
+        index_list = self.indexer.index_points(arr['ra_icrs'], arr['dec_icrs'])
+        self.assertEqual(set(pieces), set(index_list))
+        # all the rows are spilled by one flush, so to one file, sorted by pixel id
+        spans = [span for pixel_id in sorted(pieces) for span in pieces[pixel_id]]
+        self.assertEqual(len({path for path, _, _ in spans}), 1)
+        self.assertEqual([start for _, start, _ in spans], [0] + [stop for _, _, stop in spans[:-1]])
+        for pixel_id, spans in pieces.items():
+            spilled_ids = np.concatenate([_load_spilled({}, *span)[1] for span in spans])
+            np.testing.assert_array_equal(spilled_ids, arr['id'][index_list == pixel_id])
+
+    def testIngestResume(self):
+        """Test resuming an interrupted ingest from a checkpoint."""
+        output_path = os.path.join(self.out_path, "output_resume")
+        checkpoint_file = os.path.join(self.out_path, "resume_checkpoint.json")
+        config = self.makeConfig()
+        config.checkpoint_file = checkpoint_file
+        IngestIndexedReferenceTask.parseAndRun(args=[input_dir, "--output", output_path,
+                                                     self.sky_catalog_file], config=config)
+        self.assertShardsEqual(output_path)
+        with open(checkpoint_file) as f:
+            checkpoint = json.load(f)
+        self.assertEqual(checkpoint['files'], [os.path.abspath(self.sky_catalog_file)])
+        self.assertEqual(checkpoint['pending'], [])
+
+        # Simulate an ingest of another file that died while writing shard 2222
+        pix_id = 2222
+        butler = dafPersist.Butler(output_path)
+        data_id = self.indexer.make_data_id(pix_id, self.default_dataset_name)
+        shard = butler.get('ref_cat', data_id)
+        shard.extend(self.test_butler.get('ref_cat', data_id), deep=True)
+        butler.put(shard, 'ref_cat', data_id)
+        checkpoint['pending'] = [pix_id]
+        with open(checkpoint_file, 'w') as f:
+            json.dump(checkpoint, f)
+
+        # The committed file is skipped and the partially written shard is rolled back
+        config = self.makeConfig()
+        config.checkpoint_file = checkpoint_file
+        IngestIndexedReferenceTask.parseAndRun(args=[input_dir, "--output", output_path,
+                                                     self.sky_catalog_file], config=config)
+        self.assertShardsEqual(output_path)
+
+    def writeCatalogFile(self, path, rows, val3):
+        """Write rows of the sky catalog to a text file, with a value for column val3 in every row."""
+        with open(path, 'w') as f:
+            f.write("id,ra_icrs,dec_icrs,a,a_err,b,b_err,val3\n")
+            for row in rows:
+                f.write("%d,%.10g,%.10g,%.10g,%.10g,%.10g,%.10g,%s\n" %
+                        (row['id'], row['ra_icrs'], row['dec_icrs'], row['a'], row['a_err'], row['b'],
+                         row['b_err'], val3))
+
+    def testIngestBoolExtraColumn(self):
+        """Test that a bool extra column is ingested as a Flag field and read back."""
+        path = os.path.join(self.out_path, "ref_bool.txt")
+        with open(path, 'w') as f:
+            f.write("id,ra_icrs,dec_icrs,a,a_err,b,b_err,is_bright\n")
+            for row in self.sky_catalog:
+                f.write("%d,%.10g,%.10g,%.10g,%.10g,%.10g,%.10g,%s\n" %
+                        (row['id'], row['ra_icrs'], row['dec_icrs'], row['a'], row['a_err'], row['b'],
+                         row['b_err'], bool(row['is_phot'])))
+        config = self.makeConfig()
+        config.extra_col_names = ['is_bright']
+        output_path = os.path.join(self.out_path, "output_bool_extra")
+        IngestIndexedReferenceTask.parseAndRun(args=[input_dir, "--output", output_path, path],
+                                               config=config)
+        loader = LoadIndexedReferenceObjectsTask(butler=dafPersist.Butler(output_path))
+        refCat = loader.loadSkyCircle(make_coord(93.0, -30.0), 30.0*afwGeom.degrees, filterName='a').refCat
+        self.assertEqual(refCat.schema.find('is_bright').field.getTypeString(), 'Flag')
+        rows = {int(row['id']): row for row in self.sky_catalog}
+        values = [record.get('is_bright') for record in refCat]
+        self.assertEqual(values, [bool(rows[record.getId()]['is_phot']) for record in refCat])
+        # both values must occur for the comparison to mean anything
+        self.assertEqual(set(values), {False, True})
+
+    def testIngestSchemaOnce(self):
+        """Test that the master schema is written once, and later chunks must fit it."""
+        narrow_file = os.path.join(self.out_path, "ref_narrow.txt")
+        wide_file = os.path.join(self.out_path, "ref_wide.txt")
+        self.writeCatalogFile(narrow_file, self.sky_catalog[:500], "ab")
+        self.writeCatalogFile(wide_file, self.sky_catalog[500:], "abcdefghij")
+        both_file = os.path.join(self.out_path, "ref_narrow_wide.txt")
+        with open(both_file, 'w') as f, open(narrow_file) as narrow, open(wide_file) as wide:
+            f.write(narrow.read())
+            f.write("".join(wide.readlines()[1:]))
+        expected = {int(row['id']): "ab" if i < 500 else "abcdefghij"
+                    for i, row in enumerate(self.sky_catalog)}
+
+        def assertValuesMatch(output_path):
+            butler = dafPersist.Butler(output_path)
+            shard_rows, _ = read_manifest(butler, self.default_dataset_name)
+            n_rows = 0
+            for pixel_id in shard_rows:
+                shard = butler.get('ref_cat', self.indexer.make_data_id(pixel_id, self.default_dataset_name))
+                self.assertEqual([record.get('val3') for record in shard],
+                                 [expected[record.getId()] for record in shard])
+                n_rows += len(shard)
+            self.assertEqual(n_rows, len(self.sky_catalog))
+
+        def makeConfig(checkpoint_file=None):
+            config = self.makeConfig()
+            config.extra_col_names = ['val3']
+            config.rows_per_chunk = 100
+            config.checkpoint_file = checkpoint_file
+            config.files_per_checkpoint = 1
+            return config
+
+        # Chunks of one batch whose inferred string widths differ: the schema fits the widest
+        config = makeConfig()
+        output_path = os.path.join(self.out_path, "output_schema_chunks")
+        IngestIndexedReferenceTask.parseAndRun(args=[input_dir, "--output", output_path, both_file],
+                                               config=config)
+        assertValuesMatch(output_path)
+
+        # Checkpointed batches: narrower strings in a later batch fit the schema of the first
+        config = makeConfig(os.path.join(self.out_path, "schema_checkpoint_1.json"))
+        output_path = os.path.join(self.out_path, "output_schema_batches")
+        IngestIndexedReferenceTask.parseAndRun(args=[input_dir, "--output", output_path,
+                                                     wide_file, narrow_file], config=config)
+        assertValuesMatch(output_path)
+
+        # but wider strings in a later batch do not, and would be truncated
+        config = makeConfig(os.path.join(self.out_path, "schema_checkpoint_2.json"))
+        output_path = os.path.join(self.out_path, "output_schema_too_wide")
+        with self.assertRaises(RuntimeError):
+            IngestIndexedReferenceTask.parseAndRun(args=[input_dir, "--output", output_path,
+                                                         narrow_file, wide_file], config=config)
+
+        # A resumed ingest checks new batches against the persisted schema rather than replacing it
+        checkpoint_file = os.path.join(self.out_path, "schema_checkpoint_3.json")
+        output_path = os.path.join(self.out_path, "output_schema_resume")
+        IngestIndexedReferenceTask.parseAndRun(args=[input_dir, "--output", output_path, wide_file],
+                                               config=makeConfig(checkpoint_file))
+        IngestIndexedReferenceTask.parseAndRun(args=[input_dir, "--output", output_path,
+                                                     wide_file, narrow_file],
+                                               config=makeConfig(checkpoint_file))
+        assertValuesMatch(output_path)
+        master_schema = dafPersist.Butler(output_path).get(
+            'ref_cat', self.indexer.make_data_id('master_schema', self.default_dataset_name)).schema
+        self.assertEqual(master_schema.find('val3').field.getSize(),
+                         np.dtype('U10').itemsize)
+
+        checkpoint_file = os.path.join(self.out_path, "schema_checkpoint_4.json")
+        output_path = os.path.join(self.out_path, "output_schema_resume_too_wide")
+        IngestIndexedReferenceTask.parseAndRun(args=[input_dir, "--output", output_path, narrow_file],
+                                               config=makeConfig(checkpoint_file))
+        with self.assertRaises(RuntimeError):
+            IngestIndexedReferenceTask.parseAndRun(args=[input_dir, "--output", output_path,
+                                                         narrow_file, wide_file],
+                                                   config=makeConfig(checkpoint_file))
+
+    def testComputeCoordArrays(self):
+        """Test that vectorized coords match those of compute_coord."""
+        ra = np.concatenate([self.sky_catalog['ra_icrs'], [-10., 360., 720.5]])
+        dec = np.concatenate([self.sky_catalog['dec_icrs'], [-90., 90., 0.]])
+        ra_rad, dec_rad = IngestIndexedReferenceTask.compute_coord_arrays(ra, dec)
+        for i, (ra_deg, dec_deg) in enumerate(zip(ra, dec)):
+            coord = make_coord(ra_deg, dec_deg)
+            self.assertEqual(ra_rad[i], coord.getRa().asRadians())
+            self.assertEqual(dec_rad[i], coord.getDec().asRadians())
+        with self.assertRaises(ValueError):
+            IngestIndexedReferenceTask.compute_coord_arrays([0.], [91.])
+
     def testIngest(self):
         """Test IngestIndexedReferenceTask."""
         default_config = IngestIndexedReferenceTask.ConfigClass()
@@ -233,6 +524,9 @@ class HtmIndexTestCase(lsst.utils.tests.TestCase):
         loader = LoadIndexedReferenceObjectsTask(butler=butler, config=config)
         cat = loader.loadSkyCircle(cent, self.search_radius, filterName='a')
         self.assertTrue(len(cat) > 0)
+        # a larger circle, to load objects with every combination of flags
+        refCat = loader.loadSkyCircle(make_coord(93.0, -30.0), 30.0*afwGeom.degrees, filterName='a').refCat
+        self.assertFlagsMatchInput(refCat)
 
         # test that a catalog can be loaded even with a name not used for ingestion
         butler = dafPersist.Butler(self.test_repo_path)
@@ -242,6 +536,390 @@ class HtmIndexTestCase(lsst.utils.tests.TestCase):
         cat = loader.loadSkyCircle(cent, self.search_radius, filterName='a')
         self.assertTrue(len(cat) > 0)
 
+    def testShardManifest(self):
+        """Test that the ingest records the populated shards and the loader uses them."""
+        dataset_config = self.test_butler.get('ref_cat_config', name=self.default_dataset_name,
+                                              immediate=True)
+        self.assertTrue(dataset_config.has_manifest)
+        # the manifest is a separate file, not part of the dataset config
+        self.assertNotIn('shard_rows', dataset_config.toDict())
+        shard_rows, shard_bytes = read_manifest(self.test_butler, self.default_dataset_name)
+        self.assertEqual(sum(shard_rows.values()), len(self.sky_catalog))
+        self.assertEqual(set(shard_rows.keys()), set(shard_bytes.keys()))
+        for pixel_id, n_rows in shard_rows.items():
+            data_id = self.indexer.make_data_id(pixel_id, self.default_dataset_name)
+            self.assertEqual(len(self.test_butler.get('ref_cat', data_id)), n_rows)
+            self.assertEqual(shard_bytes[pixel_id],
+                             os.path.getsize(self.test_butler.getUri('ref_cat', dataId=data_id)))
+
+        # the loader reads the manifest when it first looks up a shard
+        loader = LoadIndexedReferenceObjectsTask(butler=self.test_butler)
+        self.assertIsNone(loader._shard_rows)
+        self.assertEqual(loader._get_shard_rows(), shard_rows)
+        probe_loader = LoadIndexedReferenceObjectsTask(butler=self.test_butler)
+        probe_loader.has_manifest = False
+        self.assertIsNone(probe_loader._get_shard_rows())
+        for tupl in self.comp_cats:
+            id_list, boundary_mask = self.indexer.get_pixel_ids(make_coord(*tupl), self.search_radius)
+            shards = loader.get_shards(id_list)
+            probe_shards = probe_loader.get_shards(id_list)
+            self.assertEqual(len(shards), len(id_list))
+            self.assertEqual(len(probe_shards), len(id_list))
+            for shard, probe_shard in zip(shards, probe_shards):
+                if probe_shard is None:
+                    self.assertIsNone(shard)
+                else:
+                    self.assertEqual(list(shard['id']), list(probe_shard['id']))
+
+    def testAdaptiveDepth(self):
+        """Test that the adaptive HTM indexer limits the size of shards and loads the same objects."""
+        max_rows = 30
+        config = self.makeConfig()
+        config.dataset_config.indexer.name = 'ADAPTIVE_HTM'
+        config.dataset_config.indexer.active.min_depth = 2
+        config.dataset_config.indexer.active.max_depth = 6
+        config.dataset_config.indexer.active.max_rows_per_shard = max_rows
+        output_path = os.path.join(self.out_path, "output_adaptive")
+        IngestIndexedReferenceTask.parseAndRun(args=[input_dir, "--output", output_path,
+                                                     self.sky_catalog_file], config=config)
+        butler = dafPersist.Butler(output_path)
+        dataset_config = butler.get('ref_cat_config', name=self.default_dataset_name, immediate=True)
+        split_pixels = set(dataset_config.indexer.active.split_pixels)
+        self.assertGreater(len(split_pixels), 0)
+        shard_rows, _ = read_manifest(butler, self.default_dataset_name)
+        self.assertEqual(sum(shard_rows.values()), len(self.sky_catalog))
+        for pixel_id, n_rows in shard_rows.items():
+            self.assertNotIn(pixel_id, split_pixels)
+            if pixel_id >= 8*4**3:
+                # a trixel deeper than min_depth is only used if its parent is split
+                self.assertIn(pixel_id >> 2, split_pixels)
+            if pixel_id < 8*4**6:
+                self.assertLessEqual(n_rows, max_rows)
+
+        loader = LoadIndexedReferenceObjectsTask(butler=butler)
+        for tupl, idList in self.comp_cats.items():
+            lcat = loader.loadSkyCircle(make_coord(*tupl), self.search_radius, filterName='a')
+            self.assertEqual(Counter(lcat.refCat['id']), Counter(idList))
+
+        # a later ingest that would split different trixels cannot extend the catalog
+        sparse_file = os.path.join(self.out_path, "ref_sparse.txt")
+        with open(self.sky_catalog_file) as f:
+            lines = f.readlines()
+        with open(sparse_file, 'w') as f:
+            f.writelines(lines[:101])
+        task = IngestIndexedReferenceTask(config=config, butler=butler)
+        with self.assertRaises(RuntimeError):
+            task.create_indexed_catalog([sparse_file])
+        self.assertEqual(read_manifest(butler, self.default_dataset_name)[0], shard_rows)
+
+    def testMultiOrderIndexerIsAbstract(self):
+        """Test that a multi-order indexer without the per-level hooks cannot be made."""
+        class IncompleteIndexer(MultiOrderIndexer):
+            def _index_points_at_level(self, ra_list, dec_list, level):
+                return np.zeros(len(ra_list), dtype=np.int64)
+
+        with self.assertRaises(TypeError):
+            IncompleteIndexer(2, 4, 10)
+
+    def testColumnarShards(self):
+        """Test that columnar shards hold the same rows and load the same objects."""
+        config = self.makeConfig(withFlags=True)
+        config.dataset_config.shard_format = 'columnar'
+        config.dataset_config.row_group_size = 5
+        output_path = os.path.join(self.out_path, "output_columnar")
+        IngestIndexedReferenceTask.parseAndRun(args=[input_dir, "--output", output_path,
+                                                     self.sky_catalog_file], config=config)
+        butler = dafPersist.Butler(output_path)
+        data_id = self.indexer.make_data_id(2222, self.default_dataset_name)
+        self.assertEqual(len(butler.get('ref_cat', data_id)), 0)
+        fits_path = butler.getUri('ref_cat', dataId=data_id)
+        _, shard_bytes = read_manifest(butler, self.default_dataset_name)
+        self.assertEqual(shard_bytes[2222],
+                         os.path.getsize(fits_path) + os.path.getsize(get_columnar_shard_path(fits_path)))
+        shard = read_columnar_shard(get_columnar_shard_path(butler.getUri('ref_cat', dataId=data_id)),
+                                    butler.get('ref_cat', data_id).schema)
+
+        # a write that dies part way through leaves the old shard readable
+        def interrupted_savez(file, **kwargs):
+            file.write(b'PK\x03\x04')
+            raise IOError("Simulated failure while writing a shard")
+
+        with unittest.mock.patch('numpy.savez_compressed', side_effect=interrupted_savez):
+            with self.assertRaises(IOError):
+                write_columnar_shard(get_columnar_shard_path(fits_path), shard[:3], 5)
+        self.assertFalse(os.path.exists(get_columnar_shard_path(fits_path) + '.tmp'))
+        self.assertEqual(len(read_columnar_shard(get_columnar_shard_path(fits_path), shard.schema)),
+                         len(shard))
+        ex1 = shard.extract('*')
+        ex2 = self.test_butler.get('ref_cat', data_id).extract('*')
+        # the test repo has no flags
+        self.assertEqual(set(ex1.keys()), set(ex2.keys()) | {'photometric', 'resolved', 'variable'})
+        for kk in ex2:
+            np.testing.assert_array_equal(ex1[kk], ex2[kk])
+
+        cached_config = LoadIndexedReferenceObjectsConfig()
+        cached_config.shard_cache_bytes = 1 << 30
+        projected_config = LoadIndexedReferenceObjectsConfig()
+        projected_config.load_columns = ['a_flux']
+        loaders = [LoadIndexedReferenceObjectsTask(butler=butler),
+                   LoadIndexedReferenceObjectsTask(butler=butler, config=cached_config),
+                   LoadIndexedReferenceObjectsTask(butler=butler, config=projected_config)]
+        # unknown columns are rejected when the loader is made, not silently dropped
+        bad_config = LoadIndexedReferenceObjectsConfig()
+        bad_config.load_columns = ['a_flux', 'a_flx']
+        with self.assertRaises(ValueError) as context:
+            LoadIndexedReferenceObjectsTask(butler=butler, config=bad_config)
+        self.assertIn("fields ['a_flx'] that are not", str(context.exception))
+        ref_loader = LoadIndexedReferenceObjectsTask(butler=self.test_butler)
+        for tupl, idList in self.comp_cats.items():
+            cent = make_coord(*tupl)
+            ref_cat = ref_loader.loadSkyCircle(cent, self.search_radius, filterName='a').refCat
+            for loader in loaders:
+                refCat = loader.loadSkyCircle(cent, self.search_radius, filterName='a').refCat
+                self.assertEqual(Counter(refCat['id']), Counter(idList))
+                order = np.argsort(refCat['id'])
+                ref_order = np.argsort(ref_cat['id'])
+                np.testing.assert_array_equal(refCat['a_flux'][order], ref_cat['a_flux'][ref_order])
+                if loader is loaders[2]:
+                    self.assertTrue(np.all(np.isnan(refCat['b_flux'])))
+                else:
+                    np.testing.assert_array_equal(refCat['b_flux'][order], ref_cat['b_flux'][ref_order])
+
+        # flags survive being written to and read back from columnar shards
+        for loader in loaders[:2]:
+            self.assertFlagsMatchInput(loader.loadSkyCircle(make_coord(93.0, -30.0), 30.0*afwGeom.degrees,
+                                                            filterName='a').refCat)
+
+        # row groups outside a circle are not read
+        cent = make_coord(93.0, -30.1)
+        radius = 0.5*afwGeom.degrees
+        id_list, boundary_mask = self.indexer.get_pixel_ids(cent, radius)
+        for pixel_id in id_list:
+            full_shard = loaders[0]._read_shard(pixel_id)
+            if full_shard is None:
+                continue
+            partial_shard = loaders[0]._read_shard(pixel_id, [(cent, radius)])
+            self.assertLessEqual(len(partial_shard), len(full_shard))
+            self.assertEqual([record.getId() for record in
+                              loaders[0]._trim_to_circle(partial_shard, cent, radius)],
+                             [record.getId() for record in
+                              loaders[0]._trim_to_circle(full_shard, cent, radius)])
+
+    def testMagLimit(self):
+        """Test loading with a magnitude limit and a maximum number of objects from flux-sorted shards."""
+        config = self.makeConfig(withFlags=True)
+        config.dataset_config.sort_flux_column = 'c'
+        with self.assertRaises(ValueError):
+            config.validate()
+        config.dataset_config.sort_flux_column = 'a'
+        output_path = os.path.join(self.out_path, "output_sorted")
+        IngestIndexedReferenceTask.parseAndRun(args=[input_dir, "--output", output_path,
+                                                     self.sky_catalog_file], config=config)
+        butler = dafPersist.Butler(output_path)
+        dataset_config = butler.get('ref_cat_config', name=self.default_dataset_name, immediate=True)
+        self.assertEqual(dataset_config.sort_flux_column, 'a')
+        for pixel_id in read_manifest(butler, self.default_dataset_name)[0]:
+            data_id = self.indexer.make_data_id(pixel_id, self.default_dataset_name)
+            flux = butler.get('ref_cat', data_id)['a_flux']
+            self.assertTrue(np.all(np.diff(flux) <= 0))
+
+        sorted_loader = LoadIndexedReferenceObjectsTask(butler=butler)
+        self.assertEqual(sorted_loader.sort_flux_field, 'a_flux')
+        # sorting the shards keeps the flags with their records
+        self.assertFlagsMatchInput(sorted_loader.loadSkyCircle(make_coord(93.0, -30.0), 30.0*afwGeom.degrees,
+                                                               filterName='a').refCat)
+        loader = LoadIndexedReferenceObjectsTask(butler=self.test_butler)
+        self.assertIsNone(loader.sort_flux_field)
+        mag_limit = 18.
+        min_flux = fluxFromABMag(mag_limit)
+        for tupl in self.comp_cats:
+            cent = make_coord(*tupl)
+            ref_cat = loader.loadSkyCircle(cent, self.search_radius, filterName='a').refCat
+            ref_flux = ref_cat['a_flux']
+            bright_ids = set(ref_cat['id'][ref_flux >= min_flux])
+            brightest_flux = np.sort(ref_flux)[::-1][:5]
+            for test_loader in (loader, sorted_loader):
+                refCat = test_loader.loadSkyCircle(cent, self.search_radius, filterName='a',
+                                                   magLimit=mag_limit).refCat
+                self.assertEqual(set(refCat['id']), bright_ids)
+                refCat = test_loader.loadSkyCircle(cent, self.search_radius, filterName='a',
+                                                   nBrightest=5).refCat
+                # compare fluxes rather than ids, in case of ties
+                np.testing.assert_array_equal(np.sort(refCat['a_flux'])[::-1], brightest_flux)
+                # the limits apply to the flux of the requested filter
+                refCat = test_loader.loadSkyCircle(cent, self.search_radius, filterName='b',
+                                                   magLimit=mag_limit).refCat
+                self.assertTrue(np.all(refCat['b_flux'] >= min_flux))
+
+        # the brightest objects are chosen from those in the bbox, not the circle enclosing it
+        bbox = afwGeom.Box2I(afwGeom.Point2I(30, -5), afwGeom.Extent2I(1000, 1004))
+        cdMatrix = afwGeom.makeCdMatrix(scale=40.*afwGeom.degrees/1004)
+        wcs = afwGeom.makeSkyWcs(crval=make_coord(93., -30.1), crpix=afwGeom.Box2D(bbox).getCenter(),
+                                 cdMatrix=cdMatrix)
+        ref_cat = loader.loadPixelBox(bbox=bbox, wcs=wcs, filterName='a').refCat
+        self.assertGreater(len(ref_cat), 3)
+        brightest_flux = np.sort(ref_cat['a_flux'])[::-1][:3]
+        for test_loader in (loader, sorted_loader):
+            refCat = test_loader.loadPixelBox(bbox=bbox, wcs=wcs, filterName='a', nBrightest=3).refCat
+            np.testing.assert_array_equal(np.sort(refCat['a_flux'])[::-1], brightest_flux)
+
+    def testSubIndex(self):
+        """Test that rows sorted by HTM cell load the same objects."""
+        config = self.makeConfig(withFlags=True)
+        config.dataset_config.sub_index_depth = 7
+        config.dataset_config.sort_flux_column = 'a'
+        with self.assertRaises(ValueError):
+            config.validate()
+        config.dataset_config.sort_flux_column = None
+        output_path = os.path.join(self.out_path, "output_sub_index")
+        IngestIndexedReferenceTask.parseAndRun(args=[input_dir, "--output", output_path,
+                                                     self.sky_catalog_file], config=config)
+        butler = dafPersist.Butler(output_path)
+        for pixel_id in read_manifest(butler, self.default_dataset_name)[0]:
+            data_id = self.indexer.make_data_id(pixel_id, self.default_dataset_name)
+            shard = butler.get('ref_cat', data_id)
+            self.assertTrue(np.all(np.diff(shard['htm_sub_id']) >= 0))
+            np.testing.assert_array_equal(shard['htm_sub_id'],
+                                          esutil.htm.HTM(7).lookup_id(np.degrees(shard['coord_ra']),
+                                                                      np.degrees(shard['coord_dec'])))
+
+        # a checkpointed ingest sorts the shards after the last batch
+        config = self.makeConfig(withFlags=True)
+        config.dataset_config.sub_index_depth = 7
+        config.checkpoint_file = os.path.join(self.out_path, "sub_index_checkpoint.json")
+        checkpoint_path = os.path.join(self.out_path, "output_sub_index_checkpoint")
+        IngestIndexedReferenceTask.parseAndRun(args=[input_dir, "--output", checkpoint_path,
+                                                     self.sky_catalog_file], config=config)
+        self.assertShardsEqual(checkpoint_path, ref_repo_path=output_path)
+
+        loader = LoadIndexedReferenceObjectsTask(butler=butler)
+        self.assertIsNotNone(loader.sub_htm)
+        # only the cells of the cover within a shard are searched
+        cent = make_coord(93.0, -30.0)
+        cover = np.sort(esutil.htm.HTM(7).intersect(93.0, -30.0, 10.0, inclusive=True))
+        id_list, _ = self.indexer.get_pixel_ids(cent, 10.0*afwGeom.degrees)
+        for pixel_id in id_list:
+            np.testing.assert_array_equal(loader._get_shard_cells(pixel_id, cover),
+                                          cover[(cover >> 2*(7 - self.depth)) == pixel_id])
+        # sorting the shards keeps the flags with their records
+        self.assertFlagsMatchInput(loader.loadSkyCircle(make_coord(93.0, -30.0), 30.0*afwGeom.degrees,
+                                                        filterName='a').refCat)
+        ref_loader = LoadIndexedReferenceObjectsTask(butler=self.test_butler)
+        for tupl, idList in self.comp_cats.items():
+            cent = make_coord(*tupl)
+            lcat = loader.loadSkyCircle(cent, self.search_radius, filterName='a')
+            self.assertEqual(Counter(lcat.refCat['id']), Counter(idList))
+            for radius in (0.5*afwGeom.degrees, 10.*afwGeom.degrees):
+                refCat = loader.loadSkyCircle(cent, radius, filterName='a').refCat
+                ref_cat = ref_loader.loadSkyCircle(cent, radius, filterName='a').refCat
+                self.assertEqual(Counter(refCat['id']), Counter(ref_cat['id']))
+
+    def testUnitVectors(self):
+        """Test that stored unit vectors match the coordinates and trim shards like the separations."""
+        config = self.makeConfig()
+        config.dataset_config.add_unit_vectors = True
+        output_path = os.path.join(self.out_path, "output_unit_vectors")
+        IngestIndexedReferenceTask.parseAndRun(args=[input_dir, "--output", output_path,
+                                                     self.sky_catalog_file], config=config)
+        butler = dafPersist.Butler(output_path)
+        loader = LoadIndexedReferenceObjectsTask(butler=butler)
+        self.assertTrue(loader.has_unit_vectors)
+        cent = make_coord(93.0, -30.1)
+        id_list, boundary_mask = self.indexer.get_pixel_ids(cent, self.search_radius)
+        for shard in loader.get_shards(id_list):
+            if shard is None:
+                continue
+            for record in shard:
+                vector = record.getCoord().getVector()
+                self.assertAlmostEqual(record.get("coord_x"), vector.x(), places=15)
+                self.assertAlmostEqual(record.get("coord_y"), vector.y(), places=15)
+                self.assertAlmostEqual(record.get("coord_z"), vector.z(), places=15)
+            for radius in (self.search_radius, 0.5*self.search_radius, 0.*afwGeom.degrees):
+                trimmed = loader._trim_to_circle(shard, cent, radius)
+                des_ids = [record.getId() for record in shard
+                           if record.getCoord().separation(cent) < radius]
+                self.assertEqual([record.getId() for record in trimmed], des_ids)
+
+        for tupl, idList in self.comp_cats.items():
+            lcat = loader.loadSkyCircle(make_coord(*tupl), self.search_radius, filterName='a')
+            self.assertEqual(Counter(lcat.refCat['id']), Counter(idList))
+
+    def testShardCache(self):
+        """Test that cached shards are read once and give the same catalogs."""
+        config = LoadIndexedReferenceObjectsConfig()
+        config.shard_cache_bytes = 1 << 30
+        loader = LoadIndexedReferenceObjectsTask(butler=self.test_butler, config=config)
+        uncached_loader = LoadIndexedReferenceObjectsTask(butler=self.test_butler)
+        self.assertIsNone(uncached_loader.shard_cache)
+        cent = make_coord(93.0, -90.0)
+        lcat1 = loader.loadSkyCircle(cent, self.search_radius, filterName='a')
+        misses = loader.shard_cache.misses
+        self.assertGreater(misses, 0)
+        self.assertEqual(loader.shard_cache.hits, 0)
+        lcat2 = loader.loadSkyCircle(cent, self.search_radius, filterName='a')
+        self.assertEqual(loader.shard_cache.misses, misses)
+        self.assertEqual(loader.shard_cache.hits, misses)
+        self.assertEqual(loader.metadata.get("shardCacheHits"), misses)
+        ref_cat = uncached_loader.loadSkyCircle(cent, self.search_radius, filterName='a').refCat
+        for lcat in (lcat1, lcat2):
+            self.assertEqual(list(lcat.refCat['id']), list(ref_cat['id']))
+
+        # a cache too small to hold every shard evicts the least recently used
+        config = LoadIndexedReferenceObjectsConfig()
+        config.shard_cache_bytes = loader.shard_cache.n_bytes - 1
+        loader = LoadIndexedReferenceObjectsTask(butler=self.test_butler, config=config)
+        loader.loadSkyCircle(cent, self.search_radius, filterName='a')
+        self.assertLessEqual(loader.shard_cache.n_bytes, config.shard_cache_bytes)
+        self.assertGreater(loader.shard_cache.evictions, 0)
+
+    def testPrefetch(self):
+        """Test that prefetched shards are read into the cache and used by a later load."""
+        loader = LoadIndexedReferenceObjectsTask(butler=self.test_butler)
+        with self.assertRaises(RuntimeError):
+            loader.prefetch(make_coord(93.0, -30.1), self.search_radius)
+
+        config = LoadIndexedReferenceObjectsConfig()
+        config.shard_cache_bytes = 1 << 30
+        config.prefetch_threads = 3
+        with LoadIndexedReferenceObjectsTask(butler=self.test_butler, config=config) as prefetch_loader:
+            for tupl, idList in self.comp_cats.items():
+                cent = make_coord(*tupl)
+                futures = prefetch_loader.prefetch(cent, self.search_radius)
+                # shards already cached or being read are not read again
+                self.assertEqual(prefetch_loader.prefetch(cent, self.search_radius), [])
+                concurrent.futures.wait(futures)
+                misses = prefetch_loader.shard_cache.misses
+                lcat = prefetch_loader.loadSkyCircle(cent, self.search_radius, filterName='a')
+                self.assertEqual(prefetch_loader.shard_cache.misses, misses)
+                self.assertEqual(Counter(lcat.refCat['id']), Counter(idList))
+        self.assertIsNone(prefetch_loader._prefetch_executor)
+
+        # a load can start before the prefetches finish; each shard it waits for is
+        # counted as a prefetch hit, and each it finds in the cache as a cache hit
+        prefetch_loader = LoadIndexedReferenceObjectsTask(butler=self.test_butler, config=config)
+        cent = make_coord(93.0, -30.1)
+        futures = prefetch_loader.prefetch(cent, self.search_radius)
+        lcat = prefetch_loader.loadSkyCircle(cent, self.search_radius, filterName='a')
+        prefetch_loader.close()
+        self.assertEqual(Counter(lcat.refCat['id']), Counter(self.comp_cats[(93.0, -30.1)]))
+        self.assertEqual(prefetch_loader.metadata.get("shardCacheMisses"), 0)
+        self.assertEqual(prefetch_loader.metadata.get("shardCacheHits") +
+                         prefetch_loader.metadata.get("shardPrefetchHits"), len(futures))
+
+    def testTrimToCircle(self):
+        """Test that the vectorized trim keeps the records SpherePoint.separation selects."""
+        loader = LoadIndexedReferenceObjectsTask(butler=self.test_butler)
+        cent = make_coord(93.0, -30.1)
+        id_list, boundary_mask = self.indexer.get_pixel_ids(cent, self.search_radius)
+        for shard in loader.get_shards(id_list):
+            if shard is None:
+                continue
+            for radius in (self.search_radius, 0.5*self.search_radius, 0.*afwGeom.degrees):
+                trimmed = loader._trim_to_circle(shard, cent, radius)
+                des_ids = [record.getId() for record in shard
+                           if record.getCoord().separation(cent) < radius]
+                self.assertEqual([record.getId() for record in trimmed], des_ids)
+
     def testLoadIndexedReferenceConfig(self):
         """Make sure LoadIndexedReferenceConfig has needed fields."""
         """
@@ -258,6 +936,7 @@ class HtmIndexTestCase(lsst.utils.tests.TestCase):
             cent = make_coord(*tupl)
             lcat = loader.loadSkyCircle(cent, self.search_radius, filterName='a')
             self.assertFalse("camFlux" in lcat.refCat.schema)
+            self.assertTrue(lcat.refCat.isContiguous())
             self.assertEqual(Counter(lcat.refCat['id']), Counter(idList))
             if len(lcat.refCat) > 0:
                 # make sure there are no duplicate ids
@@ -285,9 +964,56 @@ class HtmIndexTestCase(lsst.utils.tests.TestCase):
             result = loader.loadPixelBox(bbox=bbox, wcs=wcs, filterName="a")
             self.assertFalse("camFlux" in result.refCat.schema)
             self.assertGreaterEqual(len(result.refCat), len(idList))
+            self.assertTrue(result.refCat.isContiguous())
             numFound += len(result.refCat)
+
+            # the trim must keep the same records as testing each centroid with Box2D.contains
+            circle = loader._calculateCircle(bbox, wcs)
+            refCat = loader.loadSkyCircle(circle.coord, circle.radius, filterName="a").refCat
+            trimmed = loader._trimToBBox(refCat, circle.bbox, wcs)
+            self.assertTrue(trimmed.isContiguous())
+            centroidKey = afwTable.Point2DKey(refCat.schema["centroid"])
+            desIds = [star.getId() for star in refCat if circle.bbox.contains(star.get(centroidKey))]
+            self.assertEqual(list(trimmed["id"]), desIds)
+            self.assertEqual(list(result.refCat["id"]), desIds)
         self.assertGreater(numFound, 0)
 
+    def testLoadBatch(self):
+        """Test that loading several regions at once matches loading them one at a time,
+        reading each shard once."""
+        loader = LoadIndexedReferenceObjectsTask(butler=self.test_butler)
+        read_ids = []
+        read_shard = loader._read_shard
+
+        def counting_read_shard(pixel_id):
+            read_ids.append(pixel_id)
+            return read_shard(pixel_id)
+        loader._read_shard = counting_read_shard
+
+        circles = [(make_coord(93.0, dec), self.search_radius) for dec in (-90., -89., -87.)]
+        results = loader.loadSkyCircles(circles, filterName='a')
+        self.assertEqual(len(read_ids), len(set(read_ids)))
+        self.assertEqual(len(results), len(circles))
+        for (cent, radius), result in zip(circles, results):
+            des_result = loader.loadSkyCircle(cent, radius, filterName='a')
+            self.assertEqual(result.fluxField, des_result.fluxField)
+            self.assertTrue(result.refCat.isContiguous())
+            self.assertEqual(list(result.refCat['id']), list(des_result.refCat['id']))
+
+        bbox = afwGeom.Box2I(afwGeom.Point2I(30, -5), afwGeom.Extent2I(1000, 1004))
+        pixel_scale = 2*self.search_radius/max(bbox.getHeight(), bbox.getWidth())
+        cdMatrix = afwGeom.makeCdMatrix(scale=pixel_scale)
+        regions = [(bbox, afwGeom.makeSkyWcs(crval=cent, crpix=afwGeom.Box2D(bbox).getCenter(),
+                                             cdMatrix=cdMatrix))
+                   for cent, _ in circles]
+        del read_ids[:]
+        results = loader.loadPixelBoxes(regions, filterName='a')
+        self.assertEqual(len(read_ids), len(set(read_ids)))
+        for (bbox, wcs), result in zip(regions, results):
+            des_result = loader.loadPixelBox(bbox, wcs, filterName='a')
+            self.assertEqual(list(result.refCat['id']), list(des_result.refCat['id']))
+            self.assertTrue(np.all(result.refCat['hasCentroid']))
+
     def testDefaultFilterAndFilterMap(self):
         """Test defaultFilter and filterMap parameters of LoadIndexedReferenceObjectsConfig."""
         config = LoadIndexedReferenceObjectsConfig()
@@ -24,8 +24,13 @@
 import itertools
 import unittest
 
+import numpy as np
+
+import lsst.afw.geom as afwGeom
 import lsst.afw.table as afwTable
+from lsst.afw.image import fluxFromABMag
 from lsst.meas.algorithms import LoadReferenceObjectsTask, getRefFluxField, getRefFluxKeys
+import lsst.pipe.base as pipeBase
 import lsst.utils.tests
 
 
@@ -66,6 +71,75 @@ class TestLoadReferenceObjects(lsst.utils.tests.TestCase):
                     self.assertEqual(fluxSigmaField in refSchema, addFluxSigma)
                     self.assertEqual(getRefFluxField(refSchema, filterName), filterName + "_flux")
 
+    def testLoadSkyCircles(self):
+        """Test that the default loadSkyCircles calls loadSkyCircle for each circle."""
+        class RecordingLoader(LoadReferenceObjectsTask):
+            def loadSkyCircle(self, ctrCoord, radius, filterName):
+                return (ctrCoord, radius, filterName)
+
+        loader = RecordingLoader()
+        circles = [("center1", 1.0), ("center2", 2.0)]
+        self.assertEqual(loader.loadSkyCircles(circles, filterName="r"),
+                         [("center1", 1.0, "r"), ("center2", 2.0, "r")])
+
+    def testApplyFluxLimits(self):
+        """Test selecting reference objects by magnitude and by brightness rank."""
+        schema = LoadReferenceObjectsTask.makeMinimalSchema(filterNameList=["r"])
+        refCat = afwTable.SimpleCatalog(schema)
+        fluxes = [fluxFromABMag(mag) for mag in (18.0, 21.0, 16.0, float("nan"), 19.0)]
+        for i, flux in enumerate(fluxes):
+            record = refCat.addNew()
+            record.setId(i + 1)
+            record.set("r_flux", flux)
+        self.assertIs(LoadReferenceObjectsTask._applyFluxLimits(refCat, "r_flux"), refCat)
+        selected = LoadReferenceObjectsTask._applyFluxLimits(refCat, "r_flux", magLimit=19.0)
+        self.assertEqual(list(selected["id"]), [1, 3, 5])
+        selected = LoadReferenceObjectsTask._applyFluxLimits(refCat, "r_flux", nBrightest=2)
+        self.assertEqual(list(selected["id"]), [1, 3])
+        selected = LoadReferenceObjectsTask._applyFluxLimits(refCat, "r_flux", nBrightest=5)
+        self.assertEqual(list(selected["id"]), [1, 2, 3, 4, 5])
+        selected = LoadReferenceObjectsTask._applyFluxLimits(refCat, "r_flux", magLimit=20.0, nBrightest=1)
+        self.assertEqual(list(selected["id"]), [3])
+
+    def testJoinMatchListWithCatalog(self):
+        """Test the match list and columnar joins of a packed match catalog."""
+        refSchema = LoadReferenceObjectsTask.makeMinimalSchema(filterNameList=["r"])
+        refCat = afwTable.SimpleCatalog(refSchema)
+        for refId in (7, 3, 9, 1):
+            refCat.addNew().setId(refId)
+
+        class FixedLoader(LoadReferenceObjectsTask):
+            def loadSkyCircle(self, ctrCoord, radius, filterName):
+                return pipeBase.Struct(refCat=refCat.copy(deep=True), fluxField="r_flux")
+
+        sourceCat = afwTable.SourceCatalog(afwTable.SourceTable.makeMinimalSchema())
+        for sourceId in (20, 40, 10, 30):
+            sourceCat.addNew().setId(sourceId)
+        pairs = [(9, 10, 0.5), (1, 40, 1.5), (3, 30, 2.5)]
+        matches = afwTable.ReferenceMatchVector()
+        for refId, sourceId, distance in pairs:
+            ref = [record for record in refCat if record.getId() == refId][0]
+            source = [record for record in sourceCat if record.getId() == sourceId][0]
+            matches.append(afwTable.ReferenceMatch(ref, source, distance))
+        matchCat = afwTable.packMatches(matches)
+        loader = FixedLoader()
+        matchCat.table.setMetadata(loader.getMetadataCircle(afwGeom.SpherePoint(10, 20, afwGeom.degrees),
+                                                            1.0*afwGeom.degrees, "r"))
+
+        joined = loader.joinMatchListWithCatalog(matchCat, sourceCat.copy(deep=True), columnar=True)
+        self.assertEqual(list(joined.refCat["id"][joined.refIndex]), [p[0] for p in pairs])
+        self.assertEqual(list(joined.sourceCat["id"][joined.sourceIndex]), [p[1] for p in pairs])
+        self.assertFloatsAlmostEqual(joined.distance, np.array([p[2] for p in pairs]))
+
+        unpacked = loader.joinMatchListWithCatalog(matchCat, sourceCat.copy(deep=True))
+        self.assertEqual([(m.first.getId(), m.second.getId()) for m in unpacked],
+                         [(p[0], p[1]) for p in pairs])
+
+        # a source that is not in the source catalog has index -1
+        del sourceCat[2]
+        joined = loader.joinMatchListWithCatalog(matchCat, sourceCat, columnar=True)
+        self.assertEqual(list(joined.sourceIndex < 0), [True, False, False])
+
     def testFilterAliasMap(self):
         """Make a schema with filter aliases."""
         for defaultFilter in ("", "r", "camr"):
@@ -128,6 +128,41 @@ class ReadFitsCatalogTaskTestCase(lsst.utils.tests.TestCase):
         arr = task.run(FitsPath)
         self.assertTrue(np.array_equal(arr, self.arr2))
 
+    def testIterChunks(self):
+        """Test that reading in chunks gives the same rows as run, with renamed columns"""
+        column_map = {"name": "source", "ra": "ra_deg"}
+        config = ReadFitsCatalogTask.ConfigClass()
+        config.hdu = 2
+        config.column_map = column_map
+        task = ReadFitsCatalogTask(config=config)
+        chunks = list(task.iter_chunks(FitsPath, rows_per_chunk=1))
+        self.assertEqual([len(chunk) for chunk in chunks], [1, 1])
+        arr = np.concatenate(chunks)
+        self.assertEqual(arr.dtype.names,
+                         tuple(column_map.get(name, name) for name in self.arr2.dtype.names))
+        self.assertEqual(arr.dtype["source"].kind, "U")
+        for inname in self.arr2.dtype.names:
+            outname = column_map.get(inname, inname)
+            self.assertTrue(np.array_equal(self.arr2[inname], arr[outname]))
+
+    def testColumns(self):
+        """Test reading a subset of columns, named after renaming"""
+        config = ReadFitsCatalogTask.ConfigClass()
+        config.column_map = {"ra": "ra_deg"}
+        task = ReadFitsCatalogTask(config=config)
+        columns = ["flux", "ra_deg", "resolved"]
+        arr = task.run(FitsPath, columns=columns)
+        self.assertEqual(arr.dtype.names, tuple(columns))
+        self.assertTrue(np.array_equal(arr["ra_deg"], self.arr1["ra"]))
+        for name in ("flux", "resolved"):
+            self.assertTrue(np.array_equal(arr[name], self.arr1[name]))
+        chunks = list(task.iter_chunks(FitsPath, rows_per_chunk=1, columns=columns))
+        self.assertTrue(np.array_equal(np.concatenate(chunks), arr))
+
+        for badColumns in (["ra"], ["other"]):
+            with self.assertRaises(RuntimeError):
+                task.run(FitsPath, columns=badColumns)
+
     def testBadPath(self):
         """Test that an invalid path causes an error"""
         task = ReadFitsCatalogTask()
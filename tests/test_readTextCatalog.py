@@ -92,6 +92,72 @@ class ReadTextCatalogTaskTestCase(lsst.utils.tests.TestCase):
         for inname, outname in zip(self.arr.dtype.names, colnames):
             self.assertTrue(np.array_equal(self.arr[inname], arr[outname]))
 
+    def testIterChunks(self):
+        """Test that reading in chunks gives the same rows as reading the whole file
+        """
+        task = ReadTextCatalogTask()
+        chunks = list(task.iter_chunks(TextPath, rows_per_chunk=1))
+        self.assertEqual([len(chunk) for chunk in chunks], [1, 1])
+        for chunk in chunks:
+            self.assertEqual(chunk.dtype.names, self.arr.dtype.names)
+        self.assertTrue(np.array_equal(np.concatenate(chunks), self.arr))
+
+        colnames = ("id", "ra_deg", "dec_deg", "total_counts", "total_flux", "is_resolved")
+        config = ReadTextCatalogTask.ConfigClass()
+        config.colnames = colnames
+        config.header_lines = 1
+        task = ReadTextCatalogTask(config=config)
+        chunks = list(task.iter_chunks(TextPath, rows_per_chunk=5))
+        self.assertEqual(len(chunks), 1)
+        self.assertEqual(chunks[0].dtype.names, colnames)
+        self.assertTrue(np.array_equal(chunks[0], task.run(TextPath)))
+
+    def testLoadtxtParser(self):
+        """Test that the loadtxt parser gives identical arrays to the default parser
+        """
+        colnames = ("id", "ra_deg", "dec_deg", "total_counts", "total_flux", "is_resolved")
+        for colnames, header_lines in (([], 0), (colnames, 1)):
+            config = ReadTextCatalogTask.ConfigClass()
+            config.colnames = colnames
+            config.header_lines = header_lines
+            desArr = ReadTextCatalogTask(config=config).run(TextPath)
+            config.parser = "loadtxt"
+            config.sample_lines = 1
+            task = ReadTextCatalogTask(config=config)
+            arr = task.run(TextPath)
+            self.assertEqual(arr.dtype, desArr.dtype)
+            self.assertEqual(arr.tobytes(), desArr.tobytes())
+            chunks = list(task.iter_chunks(TextPath, rows_per_chunk=1))
+            self.assertEqual(np.concatenate(chunks).tobytes(), desArr.tobytes())
+
+        config = ReadTextCatalogTask.ConfigClass()
+        config.parser = "loadtxt"
+        config.dtypes = {"ra": "f4"}
+        arr = ReadTextCatalogTask(config=config).run(TextPath)
+        self.assertEqual(arr.dtype["ra"], np.dtype("f4"))
+        self.assertTrue(np.array_equal(arr["ra"], self.arr["ra"]))
+
+        config.dtypes = {"invalidname": "f4"}
+        with self.assertRaises(ValueError):
+            ReadTextCatalogTask(config=config).run(TextPath)
+
+    def testColumns(self):
+        """Test reading a subset of columns with each parser
+        """
+        columns = ["flux", "name"]
+        for parser in ("genfromtxt", "loadtxt"):
+            config = ReadTextCatalogTask.ConfigClass()
+            config.parser = parser
+            task = ReadTextCatalogTask(config=config)
+            arr = task.run(TextPath, columns=columns)
+            self.assertEqual(arr.dtype.names, tuple(columns))
+            for name in columns:
+                self.assertTrue(np.array_equal(arr[name], self.arr[name]))
+            chunks = list(task.iter_chunks(TextPath, rows_per_chunk=1, columns=columns))
+            self.assertTrue(np.array_equal(np.concatenate(chunks), arr))
+            with self.assertRaises(ValueError):
+                task.run(TextPath, columns=["invalidname"])
+
     def testBadPath(self):
         """Test that an invalid path causes an error"""
         task = ReadTextCatalogTask()